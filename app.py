@@ -1,16 +1,34 @@
 import streamlit as st
 import streamlit.components.v1 as components
 import pandas as pd
-import requests
+import numpy as np
+import pyarrow as pa
+import aiohttp
+import jinja2
+import asyncio
 import concurrent.futures
 import time
 import hashlib
 import re
 import io
+import math
+import mmap
+import os
 import json
+import random
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import unicodedata
+import uuid
 import zipfile
-from collections import Counter
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
 from dateutil.relativedelta import relativedelta
 
 # Biblioteca de PDF (Requer: xhtml2pdf no requirements.txt)
@@ -38,6 +56,60 @@ def extrair_palavras_chave(texto, limite=10):
     top_words = [word for word, count in contagem.most_common(limite)]
     return " ".join(top_words)
 
+# --- MOTOR DE CORRESPONDÊNCIA DE ITENS (ÍNDICE INVERTIDO + BM25) ---
+STOPWORDS_BUSCA = {"de", "da", "do", "das", "dos", "para", "com", "sem", "e", "o", "a", "os", "as", "em", "um", "uma", "no", "na", "por", "aquisicao", "contratacao"}
+
+def normalizar_texto(texto):
+    texto = unicodedata.normalize("NFKD", str(texto).lower())
+    return "".join(c for c in texto if not unicodedata.combining(c))
+
+# Radicalizador leve para português (plural e gênero), aplicado igualmente à consulta e às descrições.
+# As formas acentuadas cobrem quem chama radical_pt sem passar por normalizar_texto.
+SUFIXOS_PLURAL = [("ões", "ão"), ("ães", "ão"), ("éis", "el"), ("óis", "ol"), ("oes", "ao"), ("aes", "ao"), ("ais", "al"), ("eis", "el"), ("ois", "ol"), ("uis", "ul"),
+                  ("ns", "m"), ("res", "r"), ("les", "l"), ("zes", "z"), ("s", "")]
+
+def radical_pt(palavra):
+    if len(palavra) <= 3 or not palavra.isalpha(): return palavra
+    for sufixo, troca in SUFIXOS_PLURAL:
+        if palavra.endswith(sufixo):
+            palavra = palavra[:-len(sufixo)] + troca
+            break
+    if len(palavra) > 4 and palavra[-1] in "aoe": palavra = palavra[:-1]
+    return palavra
+
+def tokenizar_pt(texto):
+    return [radical_pt(t) for t in re.findall(r"[a-z0-9]+", normalizar_texto(texto)) if t not in STOPWORDS_BUSCA]
+
+class IndiceInvertido:
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.tamanhos = {}
+
+    def adicionar(self, doc_id, texto):
+        tokens = tokenizar_pt(texto)
+        self.tamanhos[doc_id] = len(tokens)
+        for termo, freq in Counter(tokens).items():
+            self.postings.setdefault(termo, {})[doc_id] = freq
+
+    def buscar(self, consulta, minimo=1.0):
+        # Retorna [(doc_id, score BM25)] dos documentos que contêm ao menos `minimo` (fração) dos termos
+        termos = list(dict.fromkeys(tokenizar_pt(consulta)))
+        if not termos: return [(d, 0.0) for d in self.tamanhos]
+        n_docs = len(self.tamanhos)
+        media_tam = (sum(self.tamanhos.values()) / n_docs) if n_docs else 0
+        scores, acertos = Counter(), Counter()
+        for termo in termos:
+            docs = self.postings.get(termo, {})
+            idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc_id, freq in docs.items():
+                norm = self.k1 * (1 - self.b + self.b * self.tamanhos[doc_id] / (media_tam or 1))
+                scores[doc_id] += idf * freq * (self.k1 + 1) / (freq + norm)
+                acertos[doc_id] += 1
+        exigidos = max(1, math.ceil(minimo * len(termos) - 1e-9))
+        return sorted(((d, sc) for d, sc in scores.items() if acertos[d] >= exigidos), key=lambda x: -x[1])
+
 # --- FUNÇÕES DE FORMATAÇÃO E UTILIDADES ---
 def formatar_moeda_simples(valor):
     try:
@@ -58,10 +130,13 @@ def formata_origem_pdf(origem):
         return f"<a href='{origem_str}' style='color: blue; text-decoration: underline;'>Acessar Fonte</a>"
     return origem_str
 
-def gerar_hash_item(row):
-    lote = "Único" if pd.isna(row.get('Lote')) or str(row.get('Lote')).strip() == "" else str(row.get('Lote')).strip()
-    item = str(row.get('Item', '')).strip()
-    return hashlib.md5(f"{lote}_{item}".encode()).hexdigest()[:10]
+def hashes_itens(df):
+    # Identificador estável de cada item do TR (lote + número), calculado para a tabela inteira de uma vez
+    if df.empty: return pd.Series(index=df.index, dtype=object)
+    lote = df['Lote'].astype(object).map(str).str.strip()
+    lote = lote.where(df['Lote'].notna() & (lote != ""), "Único")
+    item = df['Item'].astype(object).map(str).str.strip()
+    return pd.Series([hashlib.md5(f"{l}_{i}".encode()).hexdigest()[:10] for l, i in zip(lote, item)], index=df.index, dtype=object)
 
 # Validações BR
 def validar_formatar_cpf_cnpj(doc):
@@ -86,6 +161,84 @@ def validar_link(link):
     if not link: return True
     return re.match(r"^https?://", str(link)) is not None
 
+# --- ESTIMADORES ESTATÍSTICOS ---
+# Registro de estimadores: cada um recebe os preços de todos os itens (agrupados por código) e o parâmetro
+# escolhido na barra lateral, e devolve os limites inferior/superior de aceitação de cada item.
+ESTIMADORES = {}
+
+def registrar_estimador(nome, parametro, padrao, minimo, maximo, passo, metodologia):
+    def decorar(fn):
+        ESTIMADORES[nome] = {"fn": fn, "parametro": parametro, "padrao": padrao, "minimo": minimo, "maximo": maximo, "passo": passo, "metodologia": metodologia}
+        return fn
+    return decorar
+
+def agrupar_ordenados(valores, codigos, n):
+    # Ordena por (item, valor): cada item vira um bloco contíguo [inicio, inicio + contagem)
+    ordenados = valores[np.lexsort((valores, codigos))]
+    contagem = np.bincount(codigos, minlength=n)
+    return ordenados, np.cumsum(contagem) - contagem, contagem
+
+def quantil_grupos(grupos, q):
+    ordenados, inicio, contagem = grupos
+    pos = (contagem - 1) * q
+    base = np.floor(pos).astype(int)
+    i = inicio + base
+    prox = np.minimum(i + 1, inicio + contagem - 1)
+    return ordenados[i] + (pos - base) * (ordenados[prox] - ordenados[i])
+
+@registrar_estimador("Mediana ±X% e Média", "Faixa em torno da mediana (%)", 25.0, 5.0, 50.0, 5.0,
+                     "Foram considerados válidos os preços entre {p:g}% abaixo e {p:g}% acima da mediana da amostra; o valor de referência é a média aritmética desses preços.")
+def estimador_mediana_faixa(valores, codigos, grupos, p):
+    mediana = quantil_grupos(grupos, 0.5)
+    return mediana * (1 - p / 100), mediana * (1 + p / 100)
+
+@registrar_estimador("Cercas de Tukey (IQR)", "Multiplicador do intervalo interquartil", 1.5, 0.5, 3.0, 0.25,
+                     "Foram descartados os preços fora das cercas de Tukey (Q1 − {p:g}×IQR e Q3 + {p:g}×IQR); o valor de referência é a média aritmética dos preços restantes.")
+def estimador_tukey(valores, codigos, grupos, p):
+    q1, q3 = quantil_grupos(grupos, 0.25), quantil_grupos(grupos, 0.75)
+    return q1 - p * (q3 - q1), q3 + p * (q3 - q1)
+
+@registrar_estimador("Escore-z Robusto (MAD)", "Limite do escore-z robusto", 3.5, 1.0, 6.0, 0.5,
+                     "Foram descartados os preços com escore-z robusto (baseado no desvio absoluto mediano) acima de {p:g}; o valor de referência é a média aritmética dos preços restantes.")
+def estimador_mad(valores, codigos, grupos, p):
+    mediana = quantil_grupos(grupos, 0.5)
+    desvios = np.abs(valores - mediana[codigos])
+    mad = quantil_grupos(agrupar_ordenados(desvios, codigos, len(mediana)), 0.5)
+    return mediana - p * mad / 0.6745, mediana + p * mad / 0.6745
+
+@registrar_estimador("Média Aparada", "Aparo em cada extremo (%)", 10.0, 0.0, 25.0, 5.0,
+                     "Foram descartados {p:g}% dos preços em cada extremo da amostra ordenada; o valor de referência é a média aparada dos preços restantes.")
+def estimador_media_aparada(valores, codigos, grupos, p):
+    ordenados, inicio, contagem = grupos
+    corte = np.floor(contagem * p / 100).astype(int)
+    corte = np.minimum(corte, (contagem - 1) // 2)
+    return ordenados[inicio + corte], ordenados[inicio + contagem - 1 - corte]
+
+@registrar_estimador("Corte Iterativo Sigma", "Desvios-padrão tolerados", 2.0, 1.0, 4.0, 0.5,
+                     "Foram descartados iterativamente os preços a mais de {p:g} desvios-padrão da média, até a amostra estabilizar; o valor de referência é a média aritmética dos preços restantes.")
+def estimador_sigma_iterativo(valores, codigos, grupos, p, max_iteracoes=50):
+    # Todas as amostras avançam juntas a cada iteração; os desvios são centrados na mediana para evitar cancelamento numérico
+    n = len(grupos[2])
+    centro = quantil_grupos(grupos, 0.5)
+    desvios = valores - centro[codigos]
+    aceito = np.ones(len(valores), dtype=bool)
+    for _ in range(max_iteracoes):
+        k = np.bincount(codigos, weights=aceito, minlength=n)
+        s1 = np.bincount(codigos, weights=np.where(aceito, desvios, 0.0), minlength=n)
+        s2 = np.bincount(codigos, weights=np.where(aceito, desvios ** 2, 0.0), minlength=n)
+        media = np.divide(s1, k, out=np.zeros(n), where=k > 0)
+        dp = np.sqrt(np.maximum(np.divide(s2, k, out=np.zeros(n), where=k > 0) - media ** 2, 0.0))
+        folga = 1e-9 * np.abs(centro) + p * dp
+        li, ls = centro + media - folga, centro + media + folga
+        novo = (valores >= li[codigos]) & (valores <= ls[codigos])
+        if np.array_equal(novo, aceito): break
+        aceito = novo
+    return li, ls
+
+def descrever_metodologia(regra, parametro):
+    estimador = ESTIMADORES[regra]
+    return f"{regra} — {estimador['parametro']}: {parametro:g}. " + estimador['metodologia'].format(p=parametro)
+
 # --- 2. CSS & DESIGN COMPACTO ---
 st.markdown("""
 <style>
@@ -121,17 +274,125 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- 3. MEMÓRIA DE SESSÃO E ESTRUTURAS ---
-cols_pncp = ["Válido?", "Data", "Empresa/Órgão", "Item", "Qtd", "Preço", "Valor Unitário", "Origem", "Tipo"]
-cols_rastreio = ["Data do Contato", "Horário", "Empresa", "CNPJ/CPF", "Tipo de fonte", "Descrição da fonte", "Link da fonte", "Nome do Contato", "E-mail", "Telefone", "Situação", "Preço", "Valor Unitário"]
+cols_pncp = ["Válido?", "Data", "Empresa/Órgão", "Item", "Qtd", "Preço", "Origem", "Tipo"]
+cols_rastreio = ["Data do Contato", "Horário", "Empresa", "CNPJ/CPF", "Tipo de fonte", "Descrição da fonte", "Link da fonte", "Nome do Contato", "E-mail", "Telefone", "Situação", "Preço"]
 cols_historico_busca = ["Data/Hora", "Termo Pesquisado", "Novos Registros"]
+cols_tr = ["Lote", "Item", "Descrição", "Métrica", "Tipo", "Quantidade"]
+
+# Armazém colunar: todas as cotações PNCP do projeto numa única tabela tipada e ordenada por item.
+# Cada item ocupa um intervalo contíguo de linhas, então sua visão é uma fatia sem cópia; textos repetidos
+# (órgão, descrição, link, data) são categóricos e o preço fica só como float, formatado apenas na exibição.
+# Cada cotação traz a 'Chave' do item no edital (cnpj/ano/sequencial/numeroItem); o conjunto de chaves por item
+# torna a mesclagem um upsert: a mesma cotação vinda de outra busca não entra duas vezes.
+class ArmazemPrecos:
+    categoricas = ["Data", "Empresa/Órgão", "Item", "Origem", "Tipo"]
+
+    def __init__(self, df=None):
+        self.tabela = self._tipar(pd.DataFrame(columns=["Hash"] + cols_pncp + ["Chave"]))
+        self.faixas = {}
+        self.chaves = {}
+        if df is not None and not df.empty: self.anexar(df)
+
+    @classmethod
+    def _tipar(cls, df):
+        df = df.reindex(columns=["Hash"] + cols_pncp + ["Chave"])
+        return df.assign(**{
+            "Válido?": df["Válido?"].fillna(True).astype(bool),
+            "Qtd": pd.to_numeric(df["Qtd"], errors='coerce').astype("float32"),
+            "Preço": pd.to_numeric(df["Preço"], errors='coerce').astype("float64"),
+            "Chave": df["Chave"].astype(object),
+            **{c: df[c].astype("category") for c in ["Hash"] + cls.categoricas}
+        })
+
+    def _indexar_chaves(self, df):
+        for h, chave in zip(df["Hash"], df["Chave"]):
+            if isinstance(chave, str): self.chaves.setdefault(h, set()).add(chave)
+
+    def _organizar(self, tabela):
+        # Ordenação estável por item: preserva a ordem de chegada dentro de cada item
+        codigos = tabela["Hash"].cat.codes.to_numpy()
+        self.tabela = tabela.iloc[np.argsort(codigos, kind="stable")].reset_index(drop=True)
+        contagem = np.bincount(self.tabela["Hash"].cat.codes.to_numpy(), minlength=len(tabela["Hash"].cat.categories))
+        fim = np.cumsum(contagem)
+        self.faixas = {h: (int(f - c), int(f)) for h, c, f in zip(tabela["Hash"].cat.categories, contagem, fim) if c}
+
+    def anexar(self, df):
+        # df no formato longo (coluna 'Hash'); uma única reorganização por chamada, então anexe em lote
+        novos = self._tipar(df)
+        self._organizar(self._tipar(pd.concat([self.tabela, novos], ignore_index=True)))
+        self._indexar_chaves(novos)
+
+    @classmethod
+    def da_tabela(cls, tabela):
+        # Tabela já tipada (ex.: lida de um projeto nativo): só recalcula as faixas e as chaves de cada item
+        armazem = cls()
+        armazem._organizar(cls._tipar(tabela))
+        armazem._indexar_chaves(armazem.tabela)
+        return armazem
+
+    def filtrar_novas(self, lotes):
+        # lotes: [(hash_item, linhas)]; descarta as linhas cuja chave já está no item ou se repete nos próprios lotes
+        vistas, saida = set(), []
+        for h, linhas in lotes:
+            existentes, novas = self.chaves.get(h, ()), []
+            for linha in linhas:
+                chave = linha.get("Chave")
+                if chave is not None:
+                    if chave in existentes or (h, chave) in vistas: continue
+                    vistas.add((h, chave))
+                novas.append(linha)
+            if novas: saida.append((h, novas))
+        return saida
+
+    def chaves_por_item(self, hashes):
+        # Cópia para a thread do job: itens já conhecidos não precisam ter o valor homologado consultado de novo
+        return {h: frozenset(self.chaves.get(h, ())) for h in hashes}
+
+    def fatia(self, h):
+        inicio, fim = self.faixas.get(h, (0, 0))
+        return self.tabela.iloc[inicio:fim, 1:]
+
+    def selecionar(self, hashes):
+        # Linhas (com 'Hash') de vários itens, montadas a partir das faixas, sem varrer a tabela
+        faixas = [self.faixas[h] for h in hashes if h in self.faixas]
+        if not faixas: return self.tabela.iloc[0:0]
+        return self.tabela.iloc[np.concatenate([np.arange(inicio, fim) for inicio, fim in faixas])]
+
+    def quantidade(self, h):
+        inicio, fim = self.faixas.get(h, (0, 0))
+        return fim - inicio
+
+    def definir_validade(self, indices, valores):
+        self.tabela.loc[indices, "Válido?"] = np.asarray(valores, dtype=bool)
+
+    def definir_validade_por_chave(self, h, marcas):
+        # marcas: {Chave: válido}; linhas do item sem marca (ou sem chave) ficam como estão
+        fatia = self.fatia(h)
+        valores = fatia["Chave"].map(marcas)
+        alvo = valores.notna().to_numpy()
+        self.definir_validade(fatia.index[alvo], valores[alvo].to_numpy(dtype=bool))
+
+    def exportar(self, hashes=None):
+        tabela = self.tabela if hashes is None else self.tabela[self.tabela["Hash"].isin(list(hashes))]
+        return tabela[cols_pncp + ["Hash", "Chave"]].astype({c: object for c in ["Hash"] + self.categoricas})
 
 if 'tr_objeto_salvo' not in st.session_state: st.session_state['tr_objeto_salvo'] = False
 if 'tr_itens_salvos' not in st.session_state: st.session_state['tr_itens_salvos'] = False
 if 'objeto_contratacao' not in st.session_state: st.session_state['objeto_contratacao'] = ""
 if 'keywords_extraidas' not in st.session_state: st.session_state['keywords_extraidas'] = ""
-if 'df_tr' not in st.session_state: st.session_state['df_tr'] = pd.DataFrame(columns=["Lote", "Item", "Descrição", "Métrica", "Tipo", "Quantidade"])
+# O TR mantém a coluna 'Hash' e o índice hash → linha ('indice_tr'); os dois só são refeitos quando a estrutura muda
+def definir_tr(df):
+    df = df.assign(Hash=hashes_itens(df))
+    st.session_state['df_tr'] = df
+    st.session_state['indice_tr'] = dict(zip(df['Hash'], df.index))
+    return df
+
+if 'df_tr' not in st.session_state: definir_tr(pd.DataFrame(columns=cols_tr))
 if 'banco_precos' not in st.session_state: st.session_state['banco_precos'] = {}
-if 'acao_ativa' not in st.session_state: st.session_state['acao_ativa'] = (None, None)
+if 'acao_ativa' not in st.session_state: st.session_state['acao_ativa'] = {}
+if 'rascunhos_validacao' not in st.session_state: st.session_state['rascunhos_validacao'] = {}
+if 'jobs_pncp' not in st.session_state: st.session_state['jobs_pncp'] = []
+if 'armazem_pncp' not in st.session_state: st.session_state['armazem_pncp'] = ArmazemPrecos()
 
 if 'df_processos' not in st.session_state:
     st.session_state['df_processos'] = pd.DataFrame([
@@ -144,15 +405,29 @@ if 'df_processos' not in st.session_state:
     ])
 
 opcoes_origem_decreto = ["VI - Pesquisa direta c/ fornecedores", "I - Base estadual NFe", "II - Portal de Compras GO", "III - PNCP / Ferramentas específicas", "IV - Mídia / Tabelas / Sítios eletrônicos", "V - Contratações similares da adm. pública"]
+# Tabelas de domínio do PNCP usadas nos filtros da busca (código da modalidade -> nome publicado nos editais)
+MODALIDADES_PNCP = {1: "Leilão - Eletrônico", 2: "Diálogo Competitivo", 3: "Concurso", 4: "Concorrência - Eletrônica", 5: "Concorrência - Presencial", 6: "Pregão - Eletrônico", 7: "Pregão - Presencial", 8: "Dispensa de Licitação", 9: "Inexigibilidade", 10: "Manifestação de Interesse", 11: "Pré-qualificação", 12: "Credenciamento", 13: "Leilão - Presencial"}
+UFS_BRASIL = ["AC", "AL", "AM", "AP", "BA", "CE", "DF", "ES", "GO", "MA", "MG", "MS", "MT", "PA", "PB", "PE", "PI", "PR", "RJ", "RN", "RO", "RR", "RS", "SC", "SE", "SP", "TO"]
 opcoes_situacao = ["Solicitação de proposta enviada", "Confirmação de recebimento da solicitação", "Proposta recebida", "Não enviou proposta comercial", "Proposta recebida com equívoco", "Proposta retificada recebida"]
 
 # Sidebar
 with st.sidebar:
     st.markdown("### Parâmetros Estatísticos")
     st.text_input("Considerar PNCP:", value="Apenas Homologados", disabled=True)
-    regra_calculo = st.selectbox("Parâmetro de Cálculo", ["Preços válidos - Mediana ±25% e Média"])
-    meses_corte = st.slider("Período de PNCP/Atas", min_value=12, max_value=60, value=24, step=6, format="%d meses")
+    regra_calculo = st.selectbox("Parâmetro de Cálculo", list(ESTIMADORES))
+    estimador = ESTIMADORES[regra_calculo]
+    parametro_calculo = st.number_input(estimador['parametro'], min_value=estimador['minimo'], max_value=estimador['maximo'], value=estimador['padrao'], step=estimador['passo'], key=f"parametro_{regra_calculo}")
+    meses_corte = st.slider("Período de PNCP/Atas", min_value=12, max_value=60, value=24, step=6, format="%d meses", help="Vale também para a busca: editais publicados antes do período são descartados antes de consultar seus itens.")
+    with st.expander("Filtros da Busca PNCP"):
+        ufs_pncp = st.multiselect("UF", UFS_BRASIL)
+        modalidades_pncp = st.multiselect("Modalidade", list(MODALIDADES_PNCP.values()))
+        orgao_pncp = st.text_input("Órgão (nome ou CNPJ)")
     paginas_pncp = st.number_input("Volume Busca PNCP (Páginas)", min_value=1, max_value=5, value=3)
+    corresp_minima = st.slider("Correspondência Mínima dos Termos", min_value=50, max_value=100, value=100, step=5, format="%d%%", help="Percentual dos termos de busca (sem acentos, plural ou gênero) que a descrição do item precisa conter.")
+    tempo_max_busca = st.number_input("Tempo Máximo por Busca (s)", min_value=0, max_value=1800, value=180, step=30, help="A busca para ao atingir o limite e informa o que deixou de consultar. 0 = sem limite.")
+    meta_amostras = st.number_input("Meta de Amostras por Item", min_value=0, max_value=500, value=0, step=5, help="A busca termina assim que cada item atinge a quantidade de cotações. 0 = sem meta.")
+    busca_especulativa = st.checkbox("Busca Especulativa", value=False, help="Dispara as tentativas Exata, Flexível e Ampliada ao mesmo tempo e aproveita a mais rigorosa que retornar editais. Mais rápido para descrições vagas, ao custo de mais requisições.")
+    fonte_pncp = st.radio("Fonte dos Dados PNCP", ["API PNCP (ao vivo)", "Espelho Local"], help="O Espelho Local responde buscas offline a partir dos editais já sincronizados na Aba 4.")
     
     st.markdown("---")
     st.markdown("### 🔑 Assistente de Palavras-Chave")
@@ -166,65 +441,506 @@ with st.sidebar:
         st.info("Salve o Objeto na Aba 1 para gerar as palavras-chave.")
 
 # --- 4. ENGINE PNCP "CASCATA INTELIGENTE" ---
+PNCP_API = "https://pncp.gov.br/api"
+CACHE_PNCP_ARQUIVO = os.environ.get("PNCP_CACHE_PATH", ".cache_pncp.sqlite")
+
+# Validade do cache por endpoint (segundos): resultados homologados quase não mudam, páginas de busca sim
+TTL_PNCP = {"busca": 60 * 60, "itens": 7 * 24 * 3600, "resultados": 30 * 24 * 3600}
+
+def ttl_endpoint_pncp(url):
+    if url.rstrip("/").endswith("/resultados"): return TTL_PNCP["resultados"]
+    if url.rstrip("/").endswith("/itens"): return TTL_PNCP["itens"]
+    return TTL_PNCP["busca"]
+
+# Filtros de edital aplicados na própria busca, antes de qualquer consulta a /itens: UF e modalidade seguem como
+# parâmetros da API de busca; período e órgão, sem parâmetro equivalente, são triados sobre o resultado da busca
+def filtros_busca_pncp(meses=None, ufs=(), modalidades=(), orgao=""):
+    filtros = {}
+    if meses: filtros["desde"] = (datetime.now(fuso_br) - relativedelta(months=meses)).strftime("%Y-%m-%d")
+    if ufs: filtros["ufs"] = sorted(ufs)
+    if modalidades: filtros["modalidades"] = {cod: nome for cod, nome in MODALIDADES_PNCP.items() if nome in modalidades}
+    if orgao.strip(): filtros["orgao"] = orgao.strip()
+    return filtros
+
+def params_filtros_pncp(filtros):
+    params = {}
+    if filtros.get("ufs"): params["ufs"] = ",".join(filtros["ufs"])
+    if filtros.get("modalidades"): params["modalidades"] = ",".join(map(str, filtros["modalidades"]))
+    return params
+
+def edital_nos_filtros(edital, filtros):
+    # A triagem confere também UF e modalidade: o resultado pode vir do espelho local ou do cache sem esses parâmetros
+    if filtros.get("desde") and str(edital.get("data_publicacao_pncp") or "")[:10] < filtros["desde"]: return False
+    if filtros.get("ufs") and edital.get("uf") not in filtros["ufs"]: return False
+    modalidades = filtros.get("modalidades")
+    if modalidades and edital.get("modalidade_licitacao_id") not in modalidades and edital.get("modalidade_licitacao_nome") not in modalidades.values(): return False
+    if filtros.get("orgao"):
+        # Com 8 dígitos ou mais o filtro é tratado como CNPJ (ou sua raiz); senão, como trecho do nome do órgão
+        digitos = re.sub(r"\D", "", filtros["orgao"])
+        if len(digitos) >= 8: return re.sub(r"\D", "", str(edital.get("orgao_cnpj") or edital.get("cnpj") or "")).startswith(digitos)
+        return normalizar_texto(filtros["orgao"]) in normalizar_texto(edital.get("orgao_nome") or "")
+    return True
+
+# Cache persistente (SQLite) das respostas JSON da API, chaveado por URL + parâmetros
+class CachePNCP:
+    def __init__(self, caminho=CACHE_PNCP_ARQUIVO):
+        self.caminho = caminho
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(caminho, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS respostas (chave TEXT PRIMARY KEY, url TEXT, gravado_em REAL, corpo TEXT)")
+        self.conn.commit()
+        # A limpeza usa a mesma validade por endpoint da leitura
+        self.conn.create_function("ttl_endpoint", 1, ttl_endpoint_pncp, deterministic=True)
+
+    @staticmethod
+    def chave(url, params=None):
+        base = url + "?" + json.dumps(sorted((params or {}).items()), ensure_ascii=False)
+        return hashlib.sha1(base.encode()).hexdigest()
+
+    def obter(self, url, params=None, ttl=None):
+        ttl = ttl if ttl is not None else ttl_endpoint_pncp(url)
+        with self._lock:
+            linha = self.conn.execute("SELECT gravado_em, corpo FROM respostas WHERE chave = ?", (self.chave(url, params),)).fetchone()
+        if not linha or time.time() - linha[0] > ttl: return None
+        return json.loads(linha[1])
+
+    def gravar(self, url, params, dados):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO respostas VALUES (?, ?, ?, ?)", (self.chave(url, params), url, time.time(), json.dumps(dados, ensure_ascii=False)))
+            self.conn.commit()
+
+    def limpar(self, apenas_expirados=True):
+        with self._lock:
+            if apenas_expirados: self.conn.execute("DELETE FROM respostas WHERE gravado_em < ? - ttl_endpoint(url)", (time.time(),))
+            else: self.conn.execute("DELETE FROM respostas")
+            self.conn.commit()
+
+    def total(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM respostas").fetchone()[0]
+
+@st.cache_resource
+def obter_cache_pncp():
+    return CachePNCP()
+
+# Limitador de taxa (token bucket) compartilhado por todas as engines e threads.
+# Adaptativo: reduz a taxa pela metade a cada 429 e volta a subir devagar a cada sucesso.
+class LimitadorTaxa:
+    def __init__(self, taxa=8.0, rajada=16, taxa_min=1.0, taxa_max=20.0):
+        self.taxa = taxa
+        self.rajada = rajada
+        self.taxa_min = taxa_min
+        self.taxa_max = taxa_max
+        self.tokens = float(rajada)
+        self.ultimo = time.monotonic()
+        self.ultima_penalidade = 0.0
+        self._lock = threading.Lock()
+
+    def reservar(self):
+        # Reserva um token e devolve quanto tempo o chamador deve esperar por ele
+        with self._lock:
+            agora = time.monotonic()
+            self.tokens = min(self.rajada, self.tokens + (agora - self.ultimo) * self.taxa)
+            self.ultimo = agora
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.taxa
+
+    async def aguardar(self):
+        espera = self.reservar()
+        if espera > 0: await asyncio.sleep(espera)
+
+    def penalizar(self):
+        # Uma rajada de 429 simultâneos conta como um único sinal de sobrecarga
+        with self._lock:
+            if time.monotonic() - self.ultima_penalidade < 1.0: return
+            self.ultima_penalidade = time.monotonic()
+            self.taxa = max(self.taxa_min, self.taxa / 2)
+
+    def recompensar(self):
+        with self._lock: self.taxa = min(self.taxa_max, self.taxa + 0.1)
+
+# Disjuntor por host: após N falhas seguidas (5xx/rede) as chamadas falham imediatamente durante o resfriamento
+class DisjuntorCircuito:
+    def __init__(self, limite_falhas=5, resfriamento=30):
+        self.limite_falhas = limite_falhas
+        self.resfriamento = resfriamento
+        self.estados = {}
+        self._lock = threading.Lock()
+
+    def permitir(self, host):
+        with self._lock:
+            _, aberto_ate = self.estados.get(host, (0, 0.0))
+            return time.monotonic() >= aberto_ate
+
+    def registrar_sucesso(self, host):
+        with self._lock: self.estados[host] = (0, 0.0)
+
+    def registrar_falha(self, host):
+        with self._lock:
+            falhas, aberto_ate = self.estados.get(host, (0, 0.0))
+            falhas += 1
+            if falhas >= self.limite_falhas: aberto_ate = time.monotonic() + self.resfriamento
+            self.estados[host] = (falhas, aberto_ate)
+
+# Espelho local (SQLite + FTS5) de editais, itens e valores homologados, chaveado por cnpj/ano/seq.
+# Alimentado por sincronizações incrementais e consultado pela engine no modo offline.
+ESPELHO_PNCP_ARQUIVO = os.environ.get("PNCP_ESPELHO_PATH", "espelho_pncp.sqlite")
+
+class EspelhoPNCP:
+    def __init__(self, caminho=ESPELHO_PNCP_ARQUIVO):
+        self.caminho = caminho
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(caminho, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS editais (
+                cnpj TEXT, ano INTEGER, seq INTEGER, orgao_nome TEXT, data_publicacao TEXT, uf TEXT, modalidade TEXT,
+                titulo TEXT, descricao TEXT, itens_texto TEXT, payload TEXT, sincronizado_em TEXT,
+                UNIQUE (cnpj, ano, seq)
+            );
+            CREATE INDEX IF NOT EXISTS idx_editais_data ON editais (data_publicacao);
+            CREATE TABLE IF NOT EXISTS itens (
+                cnpj TEXT, ano INTEGER, seq INTEGER, numero_item INTEGER, descricao TEXT, valor_homologado REAL, payload TEXT,
+                PRIMARY KEY (cnpj, ano, seq, numero_item)
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS editais_fts USING fts5(
+                titulo, descricao, itens_texto, content='editais', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+            );
+            CREATE TRIGGER IF NOT EXISTS editais_ai AFTER INSERT ON editais BEGIN
+                INSERT INTO editais_fts (rowid, titulo, descricao, itens_texto) VALUES (new.rowid, new.titulo, new.descricao, new.itens_texto);
+            END;
+            CREATE TRIGGER IF NOT EXISTS editais_ad AFTER DELETE ON editais BEGIN
+                INSERT INTO editais_fts (editais_fts, rowid, titulo, descricao, itens_texto) VALUES ('delete', old.rowid, old.titulo, old.descricao, old.itens_texto);
+            END;
+            CREATE TRIGGER IF NOT EXISTS editais_au AFTER UPDATE ON editais BEGIN
+                INSERT INTO editais_fts (editais_fts, rowid, titulo, descricao, itens_texto) VALUES ('delete', old.rowid, old.titulo, old.descricao, old.itens_texto);
+                INSERT INTO editais_fts (rowid, titulo, descricao, itens_texto) VALUES (new.rowid, new.titulo, new.descricao, new.itens_texto);
+            END;
+            CREATE TABLE IF NOT EXISTS sync_estado (termo TEXT PRIMARY KEY, ultima_publicacao TEXT, atualizado_em TEXT);
+        """)
+        self.conn.commit()
+
+    def gravar_edital(self, edital, itens_com_valor):
+        cnpj, ano, seq = PNCPEngine._chave_edital(edital)
+        agora = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        with self._lock:
+            self.conn.execute("""
+                INSERT INTO editais (cnpj, ano, seq, orgao_nome, data_publicacao, uf, modalidade, titulo, descricao, itens_texto, payload, sincronizado_em)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (cnpj, ano, seq) DO UPDATE SET
+                    orgao_nome = excluded.orgao_nome, data_publicacao = excluded.data_publicacao, uf = excluded.uf, modalidade = excluded.modalidade,
+                    titulo = excluded.titulo, descricao = excluded.descricao, itens_texto = excluded.itens_texto,
+                    payload = excluded.payload, sincronizado_em = excluded.sincronizado_em
+            """, (cnpj, ano, seq, edital.get("orgao_nome"), edital.get("data_publicacao_pncp"), edital.get("uf"), edital.get("modalidade_licitacao_nome"),
+                  edital.get("title"), edital.get("description"), " ".join(str(it.get("descricao", "")) for it, _ in itens_com_valor),
+                  json.dumps(edital, ensure_ascii=False), agora))
+            self.conn.executemany("INSERT OR REPLACE INTO itens VALUES (?, ?, ?, ?, ?, ?, ?)", [
+                (cnpj, ano, seq, it.get("numeroItem"), it.get("descricao"), valor, json.dumps(it, ensure_ascii=False)) for it, valor in itens_com_valor
+            ])
+            self.conn.commit()
+
+    @staticmethod
+    def _consulta_fts(termo, modo):
+        palavras = re.findall(r"\w+", termo.lower())
+        if not palavras: return None
+        if modo == "frase": return '"' + " ".join(palavras) + '"'
+        return (" OR " if modo == "qualquer" else " ").join(f'"{p}"' for p in palavras)
+
+    def buscar(self, termo, modo="todos", limite=150, filtros=None):
+        # modo: "frase" (Exata), "todos" (Flexível) ou "qualquer" (Ampliada)
+        # Período, UF e modalidade entram no WHERE, antes do LIMIT; o filtro de órgão fica para a triagem da engine
+        consulta = self._consulta_fts(termo, modo)
+        if not consulta: return []
+        filtros = filtros or {}
+        condicoes, valores = ["editais_fts MATCH ?"], [consulta]
+        if filtros.get("desde"):
+            condicoes.append("e.data_publicacao >= ?")
+            valores.append(filtros["desde"])
+        for coluna, aceitos in (("e.uf", filtros.get("ufs")), ("e.modalidade", list((filtros.get("modalidades") or {}).values()))):
+            if aceitos:
+                condicoes.append(f"{coluna} IN ({', '.join('?' * len(aceitos))})")
+                valores.extend(aceitos)
+        with self._lock:
+            linhas = self.conn.execute(f"""
+                SELECT e.payload FROM editais_fts f JOIN editais e ON e.rowid = f.rowid
+                WHERE {' AND '.join(condicoes)} ORDER BY e.data_publicacao DESC LIMIT ?
+            """, (*valores, limite)).fetchall()
+        return [json.loads(l[0]) for l in linhas]
+
+    def itens(self, cnpj, ano, seq):
+        with self._lock:
+            linhas = self.conn.execute("SELECT payload, valor_homologado FROM itens WHERE cnpj = ? AND ano = ? AND seq = ? ORDER BY numero_item", (cnpj, ano, seq)).fetchall()
+        if not linhas: return None
+        itens = []
+        for payload, valor in linhas:
+            item = json.loads(payload)
+            item["valorUnitarioHomologado"] = valor
+            itens.append(item)
+        return itens
+
+    def marca_sincronizacao(self, termo):
+        with self._lock:
+            linha = self.conn.execute("SELECT ultima_publicacao FROM sync_estado WHERE termo = ?", (termo,)).fetchone()
+        return linha[0] if linha else None
+
+    def registrar_sincronizacao(self, termo, ultima_publicacao):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO sync_estado VALUES (?, ?, ?)", (termo, ultima_publicacao, datetime.now(fuso_br).strftime("%d/%m/%Y %H:%M")))
+            self.conn.commit()
+
+    def estatisticas(self):
+        with self._lock:
+            editais = self.conn.execute("SELECT COUNT(*) FROM editais").fetchone()[0]
+            itens = self.conn.execute("SELECT COUNT(*) FROM itens").fetchone()[0]
+            termos = self.conn.execute("SELECT termo, ultima_publicacao, atualizado_em FROM sync_estado ORDER BY termo").fetchall()
+        return editais, itens, pd.DataFrame(termos, columns=["Termo", "Última Publicação Sincronizada", "Sincronizado em"])
+
+@st.cache_resource
+def obter_espelho_pncp():
+    return EspelhoPNCP()
+
+class ErroPNCP(Exception):
+    pass
+
+class BuscaInterrompida(ErroPNCP):
+    pass
+
+# Orçamento de uma busca: prazo de relógio, meta de amostras por item e cancelamento cooperativo.
+# Guarda o que deixou de ser consultado para o relatório final.
+class OrcamentoBusca:
+    def __init__(self, tempo_max=None, meta_amostras=None, cancelar=None):
+        self.tempo_max = tempo_max or None
+        self.meta_amostras = meta_amostras or None
+        self.cancelar = cancelar or threading.Event()
+        self.prazo = None
+        self.alvos = set()
+        self.amostras = Counter()
+        self.ignorados = Counter()
+        self.motivo = None
+
+    def iniciar(self):
+        if self.tempo_max and self.prazo is None: self.prazo = time.monotonic() + self.tempo_max
+
+    def restante(self):
+        return None if self.prazo is None else max(self.prazo - time.monotonic(), 0.0)
+
+    def esgotado(self):
+        if self.motivo: return True
+        if self.cancelar.is_set(): self.motivo = "cancelada pelo usuário"
+        elif self.prazo is not None and time.monotonic() >= self.prazo: self.motivo = "tempo máximo atingido"
+        elif self.meta_amostras and self.alvos and all(self.amostras[a] >= self.meta_amostras for a in self.alvos): self.motivo = "meta de amostras atingida"
+        return self.motivo is not None
+
+    def registrar_amostras(self, alvo, quantidade):
+        self.amostras[alvo] += quantidade
+
+    def ignorar(self, descricao, quantidade=1):
+        if quantidade: self.ignorados[descricao] += quantidade
+
+    def relatorio(self):
+        if not self.motivo: return ""
+        ignorados = ", ".join(f"{qtd} {desc}" for desc, qtd in self.ignorados.items())
+        return f"Busca encerrada ({self.motivo})." + (f" Não consultados: {ignorados}." if ignorados else "")
+
+@st.cache_resource
+def obter_limitador_pncp():
+    return LimitadorTaxa()
+
+@st.cache_resource
+def obter_disjuntor_pncp():
+    return DisjuntorCircuito()
+
+def recursos_pncp(fonte="API PNCP (ao vivo)", **opcoes):
+    recursos = {"cache": obter_cache_pncp(), "limitador": obter_limitador_pncp(), "disjuntor": obter_disjuntor_pncp(), **opcoes}
+    if fonte == "Espelho Local": recursos["espelho"] = obter_espelho_pncp()
+    return recursos
+
+HEADERS_PNCP = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36", "Accept": "application/json"}
+
+# Motor assíncrono: paginação e mineração concorrentes sob um único limite global de conexões.
+# Os métodos síncronos (sem sufixo _async) são a ponte usada pela interface Streamlit.
 class PNCPEngine:
-    def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36", "Accept": "application/json"})
-
-    def buscar_editais_inteligente(self, termo, paginas=3, status_placeholder=None):
-        base_url = "https://pncp.gov.br/api/search/"
+    def __init__(self, cache=None, limitador=None, disjuntor=None, espelho=None, orcamento=None, filtros=None, minimo_correspondencia=1.0, especulativa=False, max_concorrencia=16, max_tentativas=4, backoff_base=0.5, backoff_max=8.0):
+        self.cache = cache
+        self.espelho = espelho
+        self.orcamento = orcamento or OrcamentoBusca()
+        self.filtros = filtros or {}
+        self.minimo_correspondencia = minimo_correspondencia
+        self.especulativa = especulativa
+        self.limitador = limitador or LimitadorTaxa()
+        self.disjuntor = disjuntor or DisjuntorCircuito()
+        self.max_concorrencia = max_concorrencia
+        self.max_tentativas = max_tentativas
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.metricas = Counter()
+        self._http = None
+        self._sem = None
+        self._resultados_em_curso = {}
+        self._indices_editais = {}
+
+    def _rodar(self, coro_fn, *args, **kwargs):
+        async def _principal():
+            self._sem = asyncio.Semaphore(self.max_concorrencia)
+            self._resultados_em_curso = {}
+            self.orcamento.iniciar()
+            conector = aiohttp.TCPConnector(limit=self.max_concorrencia, ttl_dns_cache=300)
+            async with aiohttp.ClientSession(headers=HEADERS_PNCP, connector=conector) as http:
+                self._http = http
+                try: return await coro_fn(*args, **kwargs)
+                finally: self._http = None
+        return asyncio.run(_principal())
+
+    def _espera_retry_after(self, valor):
+        if not valor: return None
+        try: return min(float(valor), 60.0)
+        except ValueError: pass
+        try: return min(max((parsedate_to_datetime(valor) - datetime.now(timezone.utc)).total_seconds(), 0.0), 60.0)
+        except (TypeError, ValueError): return None
+
+    async def _get_json(self, url, params=None, timeout=10):
+        # 200 -> JSON; 4xx (exceto 429) -> None; 429/5xx/rede -> novas tentativas e, esgotadas, ErroPNCP
+        if self.cache:
+            dados = self.cache.obter(url, params)
+            if dados is not None:
+                self.metricas["cache"] += 1
+                return dados
+
+        host = urlparse(url).netloc
+        for tentativa in range(self.max_tentativas):
+            if self.orcamento.esgotado(): raise BuscaInterrompida(self.orcamento.motivo)
+            restante = self.orcamento.restante()
+            limite_tempo = timeout if restante is None else max(min(timeout, restante), 0.1)
+            if not self.disjuntor.permitir(host):
+                self.metricas["circuito_aberto"] += 1
+                raise ErroPNCP(f"Circuito aberto para {host}")
+            await self.limitador.aguardar()
+            espera = None
+            try:
+                async with self._sem:
+                    self.metricas["requisicoes"] += 1
+                    async with self._http.get(url, params=params, timeout=aiohttp.ClientTimeout(total=limite_tempo)) as resp:
+                        if resp.status == 200:
+                            dados = await resp.json(content_type=None)
+                            self.disjuntor.registrar_sucesso(host)
+                            self.limitador.recompensar()
+                            if self.cache: self.cache.gravar(url, params, dados)
+                            return dados
+                        if resp.status != 429 and resp.status < 500:
+                            self.disjuntor.registrar_sucesso(host)
+                            return None
+                        self.metricas[f"http_{resp.status}"] += 1
+                        espera = self._espera_retry_after(resp.headers.get("Retry-After"))
+                        if resp.status == 429: self.limitador.penalizar()
+                        else: self.disjuntor.registrar_falha(host)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                # Timeout provocado pelo fim do orçamento não é falha da API
+                if self.orcamento.esgotado(): raise BuscaInterrompida(self.orcamento.motivo)
+                self.metricas["erros_rede"] += 1
+                self.disjuntor.registrar_falha(host)
+            if tentativa + 1 < self.max_tentativas:
+                self.metricas["retentativas"] += 1
+                # Backoff exponencial com jitter completo, salvo quando o servidor informa Retry-After
+                espera = espera if espera is not None else random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** tentativa))
+                restante = self.orcamento.restante()
+                await asyncio.sleep(espera if restante is None else min(espera, restante))
+        if self.orcamento.esgotado(): raise BuscaInterrompida(self.orcamento.motivo)
+        self.metricas["falhas"] += 1
+        raise ErroPNCP(f"Falha após {self.max_tentativas} tentativas: {url}")
+
+    def resumo_metricas(self):
+        m = self.metricas
+        texto = f"Requisições: {m['requisicoes']} | Cache: {m['cache']} | Retentativas: {m['retentativas']} | Falhas: {m['falhas']}"
+        if m["circuito_aberto"]: texto += f" | Bloqueadas (circuito aberto): {m['circuito_aberto']}"
+        if m["tentativas_canceladas"]: texto += f" | Tentativas especulativas canceladas: {m['tentativas_canceladas']}"
+        return texto
+
+    @staticmethod
+    def _tentativas_busca(termo):
         busca_api = termo.replace('"', '').replace("'", "")
-        
-        # 1. Tentativa Exata (Rigorosa)
-        if status_placeholder: status_placeholder.update(label="🔎 Tentativa 1: Buscando frase exata nos editais...", state="running")
-        editais = self._executar_busca(base_url, busca_api, "edital", paginas)
-        if editais: return editais, "Exata"
-
-        # 2. Tentativa Flexível (Termos soltos)
         stop_words = {"de", "da", "do", "para", "com", "sem", "e", "o", "a", "em", "um", "uma"}
         termos_limpos = [w for w in busca_api.split() if w.lower() not in stop_words]
         busca_flexivel = " ".join(termos_limpos)
-        
-        if busca_flexivel != busca_api:
-            if status_placeholder: status_placeholder.update(label="🔄 Tentativa 2: Refinando termos para busca ampla...", state="running")
-            editais = self._executar_busca(base_url, busca_flexivel, "edital", paginas)
-            if editais: return editais, "Flexível"
 
-        # 3. Tentativa Ampliada (Sem filtro de documento)
-        if status_placeholder: status_placeholder.update(label="⚠️ Tentativa 3: Expandindo para todos os tipos de documentos...", state="running")
-        editais = self._executar_busca(base_url, busca_flexivel, "", paginas)
-        if editais: return editais, "Ampliada"
+        # (rótulo, termo, tipo de documento, frase exata, aviso de status)
+        tentativas = [("Exata", busca_api, "edital", True, "🔎 Tentativa 1: Buscando frase exata nos editais...")]
+        if busca_flexivel != busca_api:
+            tentativas.append(("Flexível", busca_flexivel, "edital", False, "🔄 Tentativa 2: Refinando termos para busca ampla..."))
+        tentativas.append(("Ampliada", busca_flexivel, "", False, "⚠️ Tentativa 3: Expandindo para todos os tipos de documentos..."))
+        return tentativas
+
+    async def buscar_editais_inteligente_async(self, termo, paginas=3, status_placeholder=None):
+        # Cascata: Exata (rigorosa) -> Flexível (termos soltos) -> Ampliada (sem filtro de documento)
+        base_url = f"{PNCP_API}/search/"
+        tentativas = self._tentativas_busca(termo)
+        if self.especulativa: return await self._busca_especulativa(base_url, tentativas, paginas, status_placeholder)
+        for i, (rotulo, busca, tipo_doc, frase, aviso) in enumerate(tentativas):
+            if self.orcamento.esgotado():
+                for rotulo_ignorado, *_ in tentativas[i:]: self.orcamento.ignorar(f"tentativa(s) {rotulo_ignorado}")
+                return [], "Interrompida"
+            if status_placeholder: status_placeholder.update(label=aviso, state="running")
+            editais = await self._executar_busca(base_url, busca, tipo_doc, paginas, frase=frase)
+            if editais: return editais, rotulo
 
         return [], "Falha"
 
-    def _executar_busca(self, url, termo, tipo_doc, paginas):
-        editais_encontrados = []
-        for p in range(1, paginas + 1):
-            params = {"q": termo, "ordenacao": "-dataPublicacaoPncp", "pagina": str(p), "tam_pagina": "50"}
+    async def _busca_especulativa(self, base_url, tentativas, paginas, status_placeholder=None):
+        # Dispara todas as tentativas ao mesmo tempo e aceita a de maior prioridade com resultados;
+        # o rótulo devolvido é o mesmo da cascata sequencial.
+        if status_placeholder: status_placeholder.update(label=f"⚡ Buscando em paralelo: {', '.join(t[0] for t in tentativas)}...", state="running")
+        tarefas = [asyncio.ensure_future(self._executar_busca(base_url, busca, tipo_doc, paginas, frase=frase)) for _, busca, tipo_doc, frase, _ in tentativas]
+        try:
+            for (rotulo, *_), tarefa in zip(tentativas, tarefas):
+                editais = await tarefa
+                if editais: return editais, rotulo
+        finally:
+            pendentes = [t for t in tarefas if not t.done()]
+            self.metricas["tentativas_canceladas"] += len(pendentes)
+            for t in pendentes: t.cancel()
+        return [], "Interrompida" if self.orcamento.esgotado() else "Falha"
+
+    async def _executar_busca(self, url, termo, tipo_doc, paginas, frase=False):
+        if self.espelho:
+            modo = "frase" if frase else ("todos" if tipo_doc else "qualquer")
+            return self._triar_editais(self.espelho.buscar(termo, modo, limite=paginas * 50, filtros=self.filtros))
+
+        async def _pagina(p):
+            params = {"q": termo, "ordenacao": "-dataPublicacaoPncp", "pagina": str(p), "tam_pagina": "50", **params_filtros_pncp(self.filtros)}
             if tipo_doc: params["tipos_documento"] = tipo_doc
             try:
-                resp = self.session.get(url, params=params, timeout=10)
-                if resp.status_code == 200:
-                    items = resp.json().get('items', [])
-                    if not items: break
-                    editais_encontrados.extend(items)
-                else: break
-            except: break
-        return editais_encontrados
-
-    def _obter_valor_homologado_robusto(self, cnpj, ano, seq, item):
+                dados = await self._get_json(url, params=params, timeout=10)
+                return dados.get('items', []) if dados is not None else []
+            except BuscaInterrompida:
+                self.orcamento.ignorar("página(s) de busca")
+                return None
+            except ErroPNCP: return None
+
+        # Todas as páginas saem juntas; a ordem é preservada e o corte acontece na primeira página vazia.
+        # Página que falhou (None) não encerra a paginação: já foi contabilizada nas métricas.
+        editais_encontrados = []
+        for items in await asyncio.gather(*(_pagina(p) for p in range(1, paginas + 1))):
+            if items is None: continue
+            if not items: break
+            editais_encontrados.extend(items)
+        return self._triar_editais(editais_encontrados)
+
+    def _triar_editais(self, editais):
+        if not self.filtros: return editais
+        aceitos = [ed for ed in editais if edital_nos_filtros(ed, self.filtros)]
+        self.metricas["editais_fora_filtro"] += len(editais) - len(aceitos)
+        return aceitos
+
+    async def _obter_valor_homologado_robusto(self, cnpj, ano, seq, item):
         val_homologado = item.get("valorUnitarioHomologado")
         if val_homologado and float(val_homologado) > 0: return float(val_homologado)
         
-        num_item = item.get("numeroItem")
-        url_resultado = f"https://pncp.gov.br/api/pncp/v1/orgaos/{cnpj}/compras/{ano}/{seq}/itens/{num_item}/resultados"
-        try:
-            res_resultado = self.session.get(url_resultado, timeout=4)
-            if res_resultado.status_code == 200:
-                for r in res_resultado.json():
-                    val = r.get("valorUnitarioHomologado")
-                    if val and float(val) > 0: return float(val)
-        except: pass
+        # Itens compartilhados entre buscas do mesmo lote consultam /resultados uma única vez
+        chave = (cnpj, ano, seq, item.get("numeroItem"))
+        if chave not in self._resultados_em_curso:
+            self._resultados_em_curso[chave] = asyncio.ensure_future(self._consultar_resultado(*chave))
+        val = await self._resultados_em_curso[chave]
+        if val > 0: return val
         
         situacao = str(item.get("situacaoCompraItem", ""))
         if situacao in ['4', '6']:
@@ -232,123 +948,814 @@ class PNCPEngine:
             if val_fallback and float(val_fallback) > 0: return float(val_fallback)
         return 0.0
 
-    def minerar_itens(self, edital, termo_busca):
+    @staticmethod
+    def _chave_edital(edital):
+        cnpj = edital.get("orgao_cnpj") or edital.get("cnpj")
+        ano = edital.get("ano")
+        seq = edital.get("numero_sequencial")
+        return (cnpj, ano, seq) if (cnpj and ano and seq) else None
+
+    async def _carregar_edital(self, edital):
+        if self.orcamento.esgotado():
+            self.orcamento.ignorar("edital(is)")
+            return None
         try:
-            orgao = edital.get("orgao", {})
-            cnpj = edital.get("orgao_cnpj") or edital.get("cnpj")
+            chave = self._chave_edital(edital)
+            if not chave: return None
+            cnpj, ano, seq = chave
             razao = edital.get("orgao_nome") or edital.get("razaoSocial") or "N/D"
-            ano = edital.get("ano")
-            seq = edital.get("numero_sequencial")
             data_pub = edital.get("data_publicacao_pncp")[:10]
-            if not (cnpj and ano and seq): return []
-            
-            link_audit = f"https://pncp.gov.br/app/editais/{cnpj}/{ano}/{seq}"
-            url_itens = f"https://pncp.gov.br/api/pncp/v1/orgaos/{cnpj}/compras/{ano}/{seq}/itens"
-            resp = self.session.get(url_itens, timeout=10)
-            
-            itens = []
-            if resp.status_code == 200:
-                stop_words = {"de", "da", "do", "para", "com", "sem", "e", "o", "a", "em", "um", "uma", "aquisicao", "contratacao"}
-                termos_chave = [t for t in termo_busca.lower().split() if t not in stop_words]
-                
-                for item in resp.json():
-                    desc = str(item.get("descricao", "")).lower()
-                    if all(t in desc for t in termos_chave):
-                        val_h = self._obter_valor_homologado_robusto(cnpj, ano, seq, item)
-                        if val_h > 0:
-                            itens.append({
-                                "Data": datetime.strptime(data_pub, "%Y-%m-%d").strftime("%d/%m/%Y"),
-                                "Empresa/Órgão": razao.upper(), 
-                                "Item": item.get("descricao"),
-                                "Qtd": item.get("quantidade"),
-                                "Preço": float(val_h), 
-                                "Valor Unitário": formatar_moeda_ordenavel(val_h), 
-                                "Origem": link_audit,
-                                "Tipo": "PNCP"
-                            })
-            return itens
-        except: return []
+            meta = {
+                "cnpj": cnpj, "ano": ano, "seq": seq, "razao": razao.upper(),
+                "data": datetime.strptime(data_pub, "%Y-%m-%d").strftime("%d/%m/%Y"),
+                "link": f"https://pncp.gov.br/app/editais/{cnpj}/{ano}/{seq}"
+            }
+            url_itens = f"{PNCP_API}/pncp/v1/orgaos/{cnpj}/compras/{ano}/{seq}/itens"
+            itens_edital = self.espelho.itens(cnpj, ano, seq) if self.espelho else await self._get_json(url_itens, timeout=10)
+            if itens_edital is None: return None
+            return meta, itens_edital
+        except BuscaInterrompida:
+            self.orcamento.ignorar("edital(is)")
+            return None
+        except Exception: return None
+
+    async def _extrair_linhas(self, meta, itens_edital, termo_busca, conhecidas=frozenset()):
+        try:
+            # Índice invertido por edital, reaproveitado quando vários termos (busca em lote) consultam o mesmo edital
+            chave = (meta["cnpj"], meta["ano"], meta["seq"])
+            if chave not in self._indices_editais:
+                indice = IndiceInvertido()
+                for pos, item in enumerate(itens_edital): indice.adicionar(pos, item.get("descricao", ""))
+                self._indices_editais[chave] = indice
+            ranking = self._indices_editais[chave].buscar(termo_busca, self.minimo_correspondencia)
+            prefixo = "/".join(map(str, chave))
+            candidatos = [itens_edital[pos] for pos, _ in ranking if f"{prefixo}/{itens_edital[pos].get('numeroItem')}" not in conhecidas]
+
+            # Consultas de resultado de todos os itens do edital em paralelo (antes: cadeia N+1 serial)
+            valores = await asyncio.gather(*(self._obter_valor_homologado_robusto(meta["cnpj"], meta["ano"], meta["seq"], item) for item in candidatos))
+            return [{
+                "Data": meta["data"],
+                "Empresa/Órgão": meta["razao"], 
+                "Item": item.get("descricao"),
+                "Qtd": item.get("quantidade"),
+                "Preço": float(val_h), 
+                "Origem": meta["link"],
+                "Tipo": "PNCP",
+                "Chave": f"{prefixo}/{item.get('numeroItem')}"
+            } for item, val_h in zip(candidatos, valores) if val_h > 0]
+        except Exception: return []
+
+    async def _consultar_resultado(self, cnpj, ano, seq, num_item):
+        if self.espelho: return 0.0
+        url_resultado = f"{PNCP_API}/pncp/v1/orgaos/{cnpj}/compras/{ano}/{seq}/itens/{num_item}/resultados"
+        try:
+            resultados = await self._get_json(url_resultado, timeout=4)
+            for r in resultados or []:
+                val = r.get("valorUnitarioHomologado")
+                if val and float(val) > 0: return float(val)
+        except BuscaInterrompida: self.orcamento.ignorar("consulta(s) de resultado homologado")
+        except Exception: pass
+        return 0.0
 
-# --- 5. ESTATÍSTICA ---
-def processar_precos_regra(df, regra):
-    if df.empty: return df, pd.DataFrame(), 0, 0, 0
-    mediana_geral = df['Preço'].median()
-    limite_inferior = mediana_geral * 0.75
-    limite_superior = mediana_geral * 1.25
-    df_validos = df[(df['Preço'] >= limite_inferior) & (df['Preço'] <= limite_superior)].copy()
-    df_outliers = df[(df['Preço'] < limite_inferior) | (df['Preço'] > limite_superior)].copy()
-    return df_validos, df_outliers, mediana_geral, limite_inferior, limite_superior
-
-def ordenar_validos(df):
-    if df.empty: return df
-    return df.sort_values(by=['Preço'])
-
-def ordenar_outliers(df):
-    if df.empty: return df
-    idx_max = df['Preço'].idxmax()
-    idx_min = df['Preço'].idxmin()
-    row_max = df.loc[[idx_max]]
-    if idx_max == idx_min: return row_max
-    row_min = df.loc[[idx_min]]
-    restante = df.drop([idx_max, idx_min], errors='ignore')
-    return pd.concat([row_max, row_min, restante])
+    def _encerrar_tarefas(self, tarefas, descricao):
+        self.orcamento.ignorar(descricao, sum(1 for t in tarefas if not t.done()))
+        for t in tarefas: t.cancel()
 
-# --- 6. MECANISMO DE PROJETO (BACKUP/RESTORE) ---
-def empacotar_projeto():
-    config_df = pd.DataFrame([{"Key": "objeto_contratacao", "Value": st.session_state.get('objeto_contratacao', '')}])
-    df_tr_export = st.session_state.get('df_tr', pd.DataFrame(columns=["Lote", "Item", "Descrição", "Métrica", "Tipo", "Quantidade"])).copy()
-    if not df_tr_export.empty: df_tr_export['Hash'] = df_tr_export.apply(gerar_hash_item, axis=1)
-
-    pncp_list, man_list, est_list, hist_list = [], [], [], []
-    for h, banco in st.session_state.get('banco_precos', {}).items():
-        if not banco['df_pncp'].empty:
-            df_p = banco['df_pncp'].copy()
-            df_p['Hash'] = h
-            pncp_list.append(df_p)
-        if not banco['df_manual_rastreio'].empty:
-            df_m = banco['df_manual_rastreio'].copy()
-            df_m['Hash'] = h
-            man_list.append(df_m)
-        if not banco['historico_buscas'].empty:
-            df_h = banco['historico_buscas'].copy()
-            df_h['Hash'] = h
-            hist_list.append(df_h)
-            
-        est_list.append({"Hash": h, "estatistica_pronta": banco['estatistica_pronta'], "media_saneada": banco['media_saneada'], "mediana": banco['mediana'], "amostras": banco['amostras']})
+    def buscar_lote(self, pendentes, paginas=3, progresso=None, status_placeholder=None, ao_extrair=None, conhecidas=None):
+        return self._rodar(self.buscar_lote_async, pendentes, paginas, progresso, status_placeholder, ao_extrair, conhecidas)
 
-    df_pncp_export = pd.concat(pncp_list, ignore_index=True) if pncp_list else pd.DataFrame(columns=cols_pncp + ['Hash'])
-    df_man_export = pd.concat(man_list, ignore_index=True) if man_list else pd.DataFrame(columns=cols_rastreio + ['Hash'])
-    df_hist_export = pd.concat(hist_list, ignore_index=True) if hist_list else pd.DataFrame(columns=cols_historico_busca + ['Hash'])
-    df_est_export = pd.DataFrame(est_list) if est_list else pd.DataFrame(columns=["Hash", "estatistica_pronta", "media_saneada", "mediana", "amostras"])
+    async def buscar_lote_async(self, pendentes, paginas=3, progresso=None, status_placeholder=None, ao_extrair=None, conhecidas=None):
+        # pendentes: {hash_item: termo}. Retorna {hash_item: (linhas, tipo_busca)}.
+        # ao_extrair(hash_item, linhas) é chamado a cada edital concluído; esgotado o orçamento, encerra com o que já chegou.
+        # conhecidas: {hash_item: chaves já armazenadas}; esses itens do edital não são consultados nem devolvidos de novo.
+        conhecidas = conhecidas or {}
+        hashes = list(pendentes)
+        tipos, editais_por_item, editais_unicos = {}, {}, {}
 
-    return {"Config": config_df, "TR": df_tr_export, "PNCP": df_pncp_export, "Manual": df_man_export, "Stats": df_est_export, "Historico": df_hist_export}
+        async def _buscar(h):
+            return h, await self.buscar_editais_inteligente_async(pendentes[h], paginas, status_placeholder)
+
+        # 1. Busca de editais de todos os itens em paralelo
+        tarefas = [asyncio.ensure_future(_buscar(h)) for h in hashes]
+        try:
+            for i, fut in enumerate(asyncio.as_completed(tarefas), start=1):
+                h, (editais, tipo) = await fut
+                tipos[h] = tipo
+                editais_por_item[h] = len(editais)
+                for ed in editais:
+                    chave = self._chave_edital(ed)
+                    if chave: editais_unicos.setdefault(chave, ed)
+                if progresso: progresso(0.3 * i / len(hashes), f"🔎 '{pendentes[h]}': {len(editais)} editais (Modo: {tipo})")
+                if self.orcamento.esgotado(): break
+        finally:
+            self._encerrar_tarefas(tarefas, "busca(s) de item")
+
+        # 2. Cada edital é baixado uma única vez e confrontado com todos os itens pendentes
+        resultados = {h: [] for h in hashes}
+
+        async def _processar(ed):
+            carregado = await self._carregar_edital(ed)
+            if not carregado: return
+            meta, itens_edital = carregado
+            linhas_por_item = await asyncio.gather(*(self._extrair_linhas(meta, itens_edital, pendentes[h], conhecidas.get(h, frozenset())) for h in hashes))
+            for h, linhas in zip(hashes, linhas_por_item):
+                resultados[h].extend(linhas)
+                self.orcamento.registrar_amostras(h, len(linhas))
+                if ao_extrair and linhas: ao_extrair(h, linhas)
+
+        # A meta de amostras só considera itens que encontraram algum edital
+        self.orcamento.alvos = {h for h in hashes if editais_por_item.get(h)}
+        total = len(editais_unicos)
+        if self.orcamento.esgotado():
+            self.orcamento.ignorar("edital(is)", total)
+            tarefas = []
+        else:
+            if progresso: progresso(0.3, f"📂 {total} editais únicos para {len(hashes)} itens (de {sum(editais_por_item.values())} resultados de busca). Extraindo itens...")
+            tarefas = [asyncio.ensure_future(_processar(ed)) for ed in editais_unicos.values()]
+        try:
+            for i, fut in enumerate(asyncio.as_completed(tarefas), start=1):
+                await fut
+                if progresso: progresso(0.3 + 0.7 * i / total, f"📄 Editais processados: {i}/{total}")
+                if self.orcamento.esgotado(): break
+        finally:
+            self._encerrar_tarefas(tarefas, "edital(is)")
+        return {h: (resultados[h], tipos.get(h, "Interrompida")) for h in hashes}
+
+    def sincronizar_espelho(self, espelho, termos, paginas_max=20, progresso=None):
+        return self._rodar(self.sincronizar_espelho_async, espelho, termos, paginas_max, progresso)
+
+    async def sincronizar_espelho_async(self, espelho, termos, paginas_max=20, progresso=None):
+        # Sincronização incremental: percorre as buscas do mais recente para o mais antigo e para
+        # ao alcançar a última dataPublicacaoPncp já sincronizada para o termo
+        base_url = f"{PNCP_API}/search/"
+        totais = {}
+        for i, termo in enumerate(termos):
+            marca = espelho.marca_sincronizacao(termo)
+            novos, mais_recente = [], marca
+            for p in range(1, paginas_max + 1):
+                params = {"q": termo, "ordenacao": "-dataPublicacaoPncp", "pagina": str(p), "tam_pagina": "50", "tipos_documento": "edital"}
+                try: dados = await self._get_json(base_url, params=params, timeout=10)
+                except ErroPNCP: break
+                items = (dados or {}).get("items", [])
+                recentes = [ed for ed in items if not marca or str(ed.get("data_publicacao_pncp", "")) > marca]
+                novos.extend(ed for ed in recentes if self._chave_edital(ed))
+                if len(recentes) < len(items) or not items: break
+
+            async def _espelhar(ed):
+                cnpj, ano, seq = self._chave_edital(ed)
+                try: itens_edital = await self._get_json(f"{PNCP_API}/pncp/v1/orgaos/{cnpj}/compras/{ano}/{seq}/itens", timeout=10)
+                except ErroPNCP: return False
+                if itens_edital is None: return False
+                valores = await asyncio.gather(*(self._obter_valor_homologado_robusto(cnpj, ano, seq, it) for it in itens_edital))
+                espelho.gravar_edital(ed, list(zip(itens_edital, valores)))
+                return True
+
+            gravados = 0
+            for j, coro in enumerate(asyncio.as_completed([_espelhar(ed) for ed in novos]), start=1):
+                gravados += await coro
+                if progresso: progresso((i + j / max(len(novos), 1)) / len(termos), f"🗄️ '{termo}': {j}/{len(novos)} editais espelhados")
+            # A marca só avança se todos os editais novos foram gravados, senão a próxima execução retoma daqui
+            if novos and gravados == len(novos): mais_recente = max(str(ed.get("data_publicacao_pncp")) for ed in novos)
+            espelho.registrar_sincronizacao(termo, mais_recente)
+            totais[termo] = gravados
+            if progresso: progresso((i + 1) / len(termos), f"🗄️ '{termo}': {gravados} editais novos")
+        return totais
+
+def anexar_linhas_pncp(lotes):
+    # lotes: [(hash_item, linhas)]; tudo entra no armazém numa única reorganização.
+    # Cotações já armazenadas para o item são descartadas antes do diário e da estatística
+    lotes = st.session_state['armazem_pncp'].filtrar_novas([(h, linhas) for h, linhas in lotes if h in st.session_state['banco_precos'] and linhas])
+    if not lotes: return
+    registrar_no_diario("pncp", dados=lotes)
+    df_novos = pd.concat([pd.DataFrame(linhas).assign(Hash=h) for h, linhas in lotes], ignore_index=True)
+    df_novos.insert(0, "Válido?", True)
+    
+    # Incremental: Adiciona aos já existentes
+    st.session_state['armazem_pncp'].anexar(df_novos)
+    no_periodo = filtrar_periodo_pncp(df_novos, meses_corte)
+    for h, precos in no_periodo.groupby('Hash')['Preço']: registrar_alteracao_precos(st.session_state['banco_precos'][h], precos)
+
+def registrar_historico_busca(h, termo, novos_registros):
+    banco = st.session_state['banco_precos'][h]
+    novo_log = {
+        "Data/Hora": datetime.now(fuso_br).strftime("%d/%m/%Y %H:%M"),
+        "Termo Pesquisado": termo,
+        "Novos Registros": novos_registros
+    }
+    registrar_no_diario("historico", h, novo_log)
+    banco["historico_buscas"] = pd.concat([banco["historico_buscas"], pd.DataFrame([novo_log])], ignore_index=True)
+
+# --- 4.1 EXTRAÇÕES EM SEGUNDO PLANO (JOBS) ---
+# Os jobs rodam num pool de threads fora da execução do script, portanto sobrevivem aos reruns do Streamlit.
+# Cada sessão guarda apenas os IDs dos seus jobs; o resultado é mesclado no banco_precos ao concluir.
+class JobPNCP:
+    def __init__(self, descricao, destino, rotulos):
+        self.id = uuid.uuid4().hex[:8]
+        self.descricao = descricao
+        self.destino = destino      # {hash_item: termo}
+        self.rotulos = rotulos      # {hash_item: número do item}
+        self.estado = "Na fila"
+        self.mensagem = "Aguardando execução..."
+        self.progresso = 0.0
+        self.resultado = None
+        self.resumo = None
+        self.parciais = []          # [(hash_item, linhas)] na ordem em que os editais terminam
+        self.mesclados = 0
+        self.mesclado = False
+        self.engine = None
+        self.cancelar = threading.Event()
+        self.criado_em = time.time()
+
+    @property
+    def recebidas(self):
+        return sum(len(linhas) for _, linhas in self.parciais)
+
+    @property
+    def finalizado(self):
+        return self.estado in ("Concluído", "Falhou")
+
+    # Mesma interface do st.status, para ser usado como status_placeholder da engine
+    def update(self, label=None, state=None, **kwargs):
+        if label: self.mensagem = label
+
+class GerenciadorJobs:
+    def __init__(self, max_workers=4, retencao=24 * 3600):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pncp-job")
+        self.retencao = retencao
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def submeter(self, job, fn, *args):
+        with self._lock:
+            limite = time.time() - self.retencao
+            for job_id in [j for j, jb in self.jobs.items() if jb.finalizado and jb.criado_em < limite]: del self.jobs[job_id]
+            self.jobs[job.id] = job
+        self.executor.submit(self._executar, job, fn, *args)
+        return job.id
+
+    def _executar(self, job, fn, *args):
+        job.estado = "Executando"
+        try:
+            job.resultado = fn(job, *args)
+            job.progresso = 1.0
+            job.estado = "Concluído"
+        except Exception as e:
+            job.mensagem = f"Erro na extração: {e}"
+            job.estado = "Falhou"
+
+    def obter(self, job_id):
+        with self._lock: return self.jobs.get(job_id)
+
+    def remover(self, job_id):
+        with self._lock: self.jobs.pop(job_id, None)
+
+@st.cache_resource
+def obter_gerenciador_jobs():
+    return GerenciadorJobs()
+
+def executar_job_pncp(job, paginas, recursos, limites, conhecidas=None):
+    engine = PNCPEngine(orcamento=OrcamentoBusca(cancelar=job.cancelar, **limites), **recursos)
+    job.engine = engine
+
+    def _progresso(fracao, mensagem):
+        job.progresso = min(fracao, 1.0)
+        job.mensagem = mensagem
+
+    resultado = engine.buscar_lote(job.destino, paginas=paginas, progresso=_progresso, status_placeholder=job, ao_extrair=lambda h, linhas: job.parciais.append((h, linhas)), conhecidas=conhecidas)
+    job.resumo = pd.DataFrame([{"Item": job.rotulos.get(h), "Termo Pesquisado": job.destino[h], "Modo": tipo, "Novos Registros": len(linhas)} for h, (linhas, tipo) in resultado.items()])
+    total = int(job.resumo["Novos Registros"].sum())
+    if job.cancelar.is_set(): job.mensagem = f"Encerrada pelo usuário com {total} cotações. {engine.orcamento.relatorio()}"
+    elif total: job.mensagem = f"Sucesso! {total} cotações encontradas."
+    elif all(tipo == "Falha" for _, tipo in resultado.values()): job.mensagem = "Nenhum resultado no PNCP, mesmo após tentativas de busca flexível."
+    else: job.mensagem = "A API retornou editais, mas a descrição interna dos itens não bateu com seus termos."
+    if engine.metricas["falhas"] or engine.metricas["circuito_aberto"]:
+        job.mensagem += f" ⚠️ {engine.metricas['falhas'] + engine.metricas['circuito_aberto']} consultas ao PNCP falharam; os resultados podem estar incompletos."
+    if engine.orcamento.motivo and not job.cancelar.is_set(): job.mensagem += f" ⏱️ {engine.orcamento.relatorio()}"
+    if engine.metricas["editais_fora_filtro"]: job.mensagem += f" 🧹 {engine.metricas['editais_fora_filtro']} resultados de busca fora do período/filtros descartados sem consultar os itens."
+    return resultado
+
+def executar_job_sincronizacao(job, espelho, termos, paginas_max, recursos):
+    engine = PNCPEngine(**recursos)
+    job.engine = engine
+
+    def _progresso(fracao, mensagem):
+        job.progresso = min(fracao, 1.0)
+        job.mensagem = mensagem
+
+    totais = engine.sincronizar_espelho(espelho, termos, paginas_max, progresso=_progresso)
+    job.resumo = pd.DataFrame([{"Termo": t, "Editais Novos": n} for t, n in totais.items()])
+    job.mensagem = f"Espelho atualizado: {sum(totais.values())} editais novos."
+    return None
+
+def submeter_job(job, fn, *args):
+    obter_gerenciador_jobs().submeter(job, fn, *args)
+    st.session_state['jobs_pncp'].append(job.id)
+    return job.id
+
+def mesclar_resultados_jobs():
+    # Anexa ao banco_precos os lotes de linhas que chegaram desde a última mesclagem; ao final do job registra o histórico.
+    # Retorna True quando algum job acabou de ser concluído (para a tela inteira ser atualizada).
+    gerenciador = obter_gerenciador_jobs()
+    concluiu = False
+    for job_id in st.session_state['jobs_pncp']:
+        job = gerenciador.obter(job_id)
+        if not job or job.mesclado: continue
+        finalizado = job.finalizado
+        n_parciais = len(job.parciais)
+        anexar_linhas_pncp(job.parciais[job.mesclados:n_parciais])
+        job.mesclados = n_parciais
+        if finalizado:
+            totais = Counter()
+            for h, linhas in job.parciais: totais[h] += len(linhas)
+            # Toda busca fica no histórico, mesmo as que não trouxeram cotação nova para o item
+            for h, termo in job.destino.items():
+                if h in st.session_state['banco_precos']: registrar_historico_busca(h, termo, totais[h])
+            job.mesclado = True
+            concluiu = True
+    return concluiu
+
+def painel_jobs_pncp():
+    gerenciador = obter_gerenciador_jobs()
+    if mesclar_resultados_jobs(): st.rerun()
+    jobs = [j for j in (gerenciador.obter(job_id) for job_id in st.session_state['jobs_pncp']) if j]
+    for job in jobs:
+        st.progress(job.progresso, text=f"**[{job.id}] {job.descricao}** — {job.estado}: {job.mensagem}")
+        if job.engine: st.caption(job.engine.resumo_metricas())
+        if job.parciais:
+            st.caption(f"📥 {job.recebidas} cotações recebidas até agora (já disponíveis na validação).")
+            with st.expander(f"Prévia das últimas cotações ({job.id})"):
+                ultimas = [linha for _, linhas in job.parciais[-5:] for linha in linhas][-10:]
+                st.dataframe(pd.DataFrame(ultimas)[["Empresa/Órgão", "Item", "Preço"]], column_config={"Preço": st.column_config.NumberColumn("Valor Unitário", format="R$ %.2f")}, hide_index=True, use_container_width=True)
+        if not job.finalizado:
+            if job.destino and st.button("⏹️ Encerrar com as amostras atuais", key=f"encerrar_{job.id}", disabled=job.cancelar.is_set(), use_container_width=True):
+                job.cancelar.set()
+        else:
+            if job.resumo is not None and len(job.resumo) > 1:
+                with st.expander(f"Resumo do job {job.id}"):
+                    st.dataframe(job.resumo, hide_index=True, use_container_width=True)
+            if st.button("Dispensar", key=f"dispensar_{job.id}", use_container_width=True):
+                st.session_state['jobs_pncp'].remove(job.id)
+                gerenciador.remover(job.id)
+                st.rerun()
+
+# --- 5. ESTATÍSTICA ---
+cols_estatistica_lote = ["Limite Inferior", "Limite Superior", "Outlier"]
+
+def calcular_estatisticas_lote(precos, regra=None, parametro=None):
+    # Motor em lote: recebe a tabela longa (coluna 'Hash' + 'Preço') de quantos itens houver e calcula,
+    # numa única passada vetorizada, mediana, limites do estimador, média saneada, amostras e outliers de cada item.
+    regra = regra if regra in ESTIMADORES else next(iter(ESTIMADORES))
+    parametro = ESTIMADORES[regra]['padrao'] if parametro is None else parametro
+    precos = precos[pd.to_numeric(precos['Preço'], errors='coerce').notna()]
+    codigos, hashes = pd.factorize(precos['Hash'], sort=False)
+    valores = precos['Preço'].to_numpy(dtype=float)
+    n = len(hashes)
+
+    grupos = agrupar_ordenados(valores, codigos, n)
+    mediana = quantil_grupos(grupos, 0.5)
+    limite_inferior, limite_superior = ESTIMADORES[regra]['fn'](valores, codigos, grupos, parametro)
+
+    li, ls = limite_inferior[codigos], limite_superior[codigos]
+    aceito = (valores >= li) & (valores <= ls)
+    amostras = np.bincount(codigos, weights=aceito, minlength=n).astype(int)
+    soma = np.bincount(codigos, weights=np.where(aceito, valores, 0.0), minlength=n)
+    media = np.divide(soma, amostras, out=np.zeros(n), where=amostras > 0)
+
+    marcados = precos.assign(**{"Limite Inferior": li, "Limite Superior": ls, "Outlier": ~aceito})
+    resumo = pd.DataFrame({"mediana": mediana, "limite_inferior": limite_inferior, "limite_superior": limite_superior,
+                           "media_saneada": media, "amostras": amostras, "outliers": grupos[2] - amostras}, index=pd.Index(hashes, name="Hash"))
+    resumo.attrs.update(regra=regra, parametro=parametro)
+    return marcados, resumo
+
+def aplicar_estatisticas_lote(banco_precos, marcados, resumo, atualizar_valores=True):
+    # Grava o resultado do lote em banco_precos; com atualizar_valores=False preserva os números já salvos
+    # (ex.: restauração de backup) e apenas remonta as tabelas de válidos e outliers.
+    # Uma ordenação global por (item, outlier, preço) deixa válidos e outliers de cada item em fatias contíguas,
+    # já ordenadas por preço: nada de filtrar ou ordenar item a item.
+    codigos, hashes = pd.factorize(marcados['Hash'], sort=False)
+    outlier = marcados['Outlier'].to_numpy(dtype=bool)
+    precos = marcados['Preço'].to_numpy(dtype=float)
+    ordem = np.lexsort((precos, outlier, codigos))
+    base = marcados.drop(columns=['Hash', 'Chave'] + cols_estatistica_lote, errors='ignore').iloc[ordem]
+    precos = precos[ordem]
+    manual = base['Tipo'].to_numpy(dtype=object) == "Manual" if 'Tipo' in base.columns else np.zeros(len(base), dtype=bool)
+    limites = np.concatenate(([0], np.cumsum(np.bincount(codigos * 2 + outlier, minlength=2 * len(hashes)))))
+    valores = resumo.to_dict('index')
+    if atualizar_valores:
+        registrar_no_diario("stats", dados={h: [float(est['media_saneada']), float(est['mediana']), int(est['amostras']), resumo.attrs['regra'], resumo.attrs['parametro']] for h, est in valores.items() if h in banco_precos})
+    for i, h in enumerate(hashes):
+        banco = banco_precos.get(h)
+        if banco is None: continue
+        inicio, meio, fim = limites[2 * i], limites[2 * i + 1], limites[2 * i + 2]
+        banco["df_validos"] = base.iloc[inicio:meio]
+        outliers = base.iloc[meio:fim]
+        # Outliers: maior, menor e os demais em ordem crescente
+        banco["df_outliers"] = outliers.iloc[np.r_[fim - meio - 1, 0:fim - meio - 1]] if fim - meio > 1 else outliers
+        banco["precos_ordenados"] = sorted(precos[inicio:fim].tolist())
+        banco["manuais_na_amostra"] = Counter(precos[inicio:fim][manual[inicio:fim]].tolist())
+        banco["alteracoes"] = {"adicionados": [], "removidos": []}
+        banco["tabelas_pendentes"] = False
+        if atualizar_valores:
+            est = valores[h]
+            banco["media_saneada"] = float(est['media_saneada'])
+            banco["mediana"] = float(est['mediana'])
+            banco["amostras"] = int(est['amostras'])
+            banco["estatistica_pronta"] = True
+            banco["regra_calculo"], banco["parametro_calculo"] = resumo.attrs['regra'], resumo.attrs['parametro']
+
+def zerar_estatisticas(banco_precos, hashes, regra, parametro):
+    # Itens sem nenhuma cotação válida no recálculo: os números anteriores não valem mais para o período/parâmetro atual
+    hashes = [h for h in hashes if h in banco_precos]
+    if not hashes: return
+    registrar_no_diario("stats", dados={h: [0.0, 0.0, 0, regra, parametro] for h in hashes})
+    for h in hashes:
+        banco_precos[h].update(media_saneada=0.0, mediana=0.0, amostras=0, regra_calculo=regra, parametro_calculo=parametro,
+                               df_validos=pd.DataFrame(), df_outliers=pd.DataFrame(), precos_ordenados=[], manuais_na_amostra=Counter(),
+                               alteracoes={"adicionados": [], "removidos": []}, tabelas_pendentes=False)
+
+def cotacoes_manuais_validas(df_man, nome_item):
+    # Propostas manuais aproveitáveis no cálculo, já no formato das cotações PNCP
+    if df_man.empty: return pd.DataFrame(columns=cols_pncp)
+    filtro = (df_man['Preço'] > 0) & (df_man['Situação'].str.contains('Proposta recebida|Portal|Mídia|Contrataç', case=False, na=False, regex=True))
+    df_v = df_man[filtro].copy()
+    if df_v.empty: return pd.DataFrame(columns=cols_pncp)
+    # nome_item pode ser um texto ou uma Series alinhada ao índice (vários itens de uma vez)
+    link = df_v['Link da fonte'].fillna("").astype(str).str.strip()
+    df_v["Origem"] = df_v['Link da fonte'].where(link != "", df_v['Descrição da fonte'])
+    df_v = df_v.rename(columns={"Data do Contato": "Data", "Empresa": "Empresa/Órgão"})
+    df_v["Item"] = nome_item
+    df_v["Qtd"] = 1
+    df_v["Tipo"] = "Manual"
+    df_v["Válido?"] = True
+    return df_v[[c for c in cols_pncp if c in df_v.columns]]
+
+def filtrar_periodo_pncp(df_p, meses_corte):
+    if not meses_corte or df_p.empty: return df_p
+    # 'Data' pode ser categórica (armazém PNCP); com muitas linhas o to_datetime devolveria outra categórica, não comparável
+    datas = pd.to_datetime(df_p['Data'].to_numpy(dtype=object), format="%d/%m/%Y", errors='coerce')
+    return df_p[np.asarray(datas >= (datetime.now(fuso_br) - relativedelta(months=meses_corte)).replace(tzinfo=None))]
+
+def montar_precos_validados(banco_precos, nomes_itens, meses_corte=None):
+    # Tabela longa com as cotações validadas de todos os itens informados, pronta para o motor em lote
+    hashes = [h for h in nomes_itens if h in banco_precos]
+    frames = [filtrar_periodo_pncp(st.session_state['armazem_pncp'].selecionar(hashes), meses_corte).astype({"Hash": object})]
+    manuais = {h: banco_precos[h]['df_manual_rastreio'] for h in hashes if not banco_precos[h]['df_manual_rastreio'].empty}
+    if manuais:
+        df_man = pd.concat(manuais, names=['Hash']).reset_index(level=0).reset_index(drop=True)
+        df_m = cotacoes_manuais_validas(df_man, df_man['Hash'].map(nomes_itens))
+        frames.append(df_m.assign(Hash=df_man.loc[df_m.index, 'Hash']))
+    precos = pd.concat([f for f in frames if not f.empty], ignore_index=True) if any(not f.empty for f in frames) else pd.DataFrame(columns=cols_pncp + ['Hash'])
+    return precos[precos['Válido?'] == True]
+
+# --- 5.1 ATUALIZAÇÃO INCREMENTAL DA ESTATÍSTICA ---
+# Cada item guarda a amostra validada ordenada ('precos_ordenados') e a fila de alterações ainda não aplicadas.
+# Novas cotações e edições só registram a diferença; a estatística é atualizada por bisect, sem refazer concat/ordenação.
+def registrar_alteracao_precos(banco, adicionados=(), removidos=()):
+    alteracoes = banco.setdefault('alteracoes', {"adicionados": [], "removidos": []})
+    alteracoes['adicionados'].extend(float(p) for p in adicionados)
+    alteracoes['removidos'].extend(float(p) for p in removidos)
+
+def substituir_rastreio_manual(banco, df_novo, nome_item):
+    antes = Counter(cotacoes_manuais_validas(banco['df_manual_rastreio'], nome_item)['Preço'].astype(float))
+    depois = Counter(cotacoes_manuais_validas(df_novo, nome_item)['Preço'].astype(float))
+    # Só sai da amostra o preço manual que está nela, e não uma cotação PNCP de mesmo valor
+    manuais = manuais_na_amostra(banco)
+    adicionados, removidos = depois - antes, (antes - depois) & manuais
+    manuais.update(adicionados)
+    manuais.subtract(removidos)
+    registrar_alteracao_precos(banco, adicionados.elements(), removidos.elements())
+    banco['df_manual_rastreio'] = df_novo
+
+def amostra_ordenada(banco):
+    # Itens restaurados sem a amostra a remontam das tabelas de válidos/outliers (as Amostras do projeto)
+    try: return banco['precos_ordenados']
+    except KeyError: pass
+    if 'df_validos' not in banco: return None
+    tabelas = [df for df in (banco['df_validos'], banco.get('df_outliers')) if isinstance(df, pd.DataFrame) and 'Preço' in df.columns]
+    amostras = pd.concat(tabelas, ignore_index=True) if tabelas else pd.DataFrame(columns=['Preço', 'Tipo'])
+    precos = amostras['Preço'].astype(float)
+    banco['precos_ordenados'] = sorted(precos.tolist())
+    banco['manuais_na_amostra'] = Counter(precos[amostras['Tipo'] == "Manual"].tolist()) if 'Tipo' in amostras.columns else Counter()
+    return banco['precos_ordenados']
+
+def manuais_na_amostra(banco):
+    # Preços manuais contidos na amostra: a cotação manual desmarcada na validação fica fora dela
+    try: return banco['manuais_na_amostra']
+    except KeyError:
+        banco['manuais_na_amostra'] = Counter()
+        return banco['manuais_na_amostra']
+
+def sincronizar_estatistica(banco):
+    alteracoes = banco.get('alteracoes')
+    if not alteracoes or not (alteracoes['adicionados'] or alteracoes['removidos']): return False
+    if not banco['estatistica_pronta']:
+        banco['alteracoes'] = {"adicionados": [], "removidos": []}
+        return False
+    # A fila só é esvaziada depois de aplicada: sem amostra nem tabelas para remontá-la, as alterações esperam
+    amostra = amostra_ordenada(banco)
+    if amostra is None: return False
+    banco['alteracoes'] = {"adicionados": [], "removidos": []}
+
+    for preco in alteracoes['removidos']:
+        i = bisect_left(amostra, preco)
+        if i < len(amostra) and amostra[i] == preco: del amostra[i]
+    for preco in alteracoes['adicionados']: insort(amostra, preco)
+
+    valores = np.asarray(amostra, dtype=float)
+    if not len(valores):
+        banco.update(media_saneada=0.0, mediana=0.0, amostras=0, tabelas_pendentes=True)
+        return True
+    regra = banco.get('regra_calculo') if banco.get('regra_calculo') in ESTIMADORES else next(iter(ESTIMADORES))
+    parametro = banco.get('parametro_calculo', ESTIMADORES[regra]['padrao'])
+    grupos = (valores, np.zeros(1, dtype=int), np.array([len(valores)]))
+    li, ls = ESTIMADORES[regra]['fn'](valores, np.zeros(len(valores), dtype=int), grupos, parametro)
+    aceitos = valores[bisect_left(amostra, li[0]):bisect_right(amostra, ls[0])]
+    banco.update(media_saneada=float(aceitos.mean()) if len(aceitos) else 0.0, mediana=float(quantil_grupos(grupos, 0.5)[0]),
+                 amostras=len(aceitos), tabelas_pendentes=True)
+    return True
+
+def garantir_tabelas_estatistica(h, banco, nome_item):
+    # Tabelas de válidos/outliers são remontadas sob demanda, só quando alguma tela ou o PDF precisa delas
+    sincronizar_estatistica(banco)
+    if not banco.get('tabelas_pendentes'): return
+    precos = montar_precos_validados({h: banco}, {h: nome_item}, meses_corte)
+    # Cotações manuais não guardam 'Válido?': só entram as que constam da amostra (a desmarcada na validação fica de fora).
+    # Os números já salvos prevalecem; aqui só as tabelas são remontadas.
+    disponiveis, manter = Counter(manuais_na_amostra(banco)), []
+    for tipo, preco in zip(precos['Tipo'], precos['Preço'].astype(float)):
+        dentro = tipo != "Manual" or disponiveis[preco] > 0
+        if tipo == "Manual" and dentro: disponiveis[preco] -= 1
+        manter.append(dentro)
+    precos = precos[manter]
+    marcados, resumo = calcular_estatisticas_lote(precos, banco.get('regra_calculo'), banco.get('parametro_calculo'))
+    if resumo.empty:
+        banco.update(df_validos=pd.DataFrame(), df_outliers=pd.DataFrame(), precos_ordenados=[], manuais_na_amostra=Counter(), tabelas_pendentes=False)
+    else:
+        aplicar_estatisticas_lote({h: banco}, marcados, resumo, atualizar_valores=False)
+
+# --- 6. MECANISMO DE PROJETO (BACKUP/RESTORE) ---
+colunas_stats = ["Hash", "estatistica_pronta", "media_saneada", "mediana", "amostras", "regra_calculo", "parametro_calculo"]
+
+def tabelas_projeto():
+    # Gera (tabela, colunas, blocos) com um bloco por item, sem concatenar nem copiar o projeto inteiro
+    banco_precos = st.session_state.get('banco_precos', {})
+    armazem = st.session_state['armazem_pncp']
+    df_tr_export = st.session_state['df_tr']
+
+    def blocos_pncp():
+        for h in banco_precos:
+            fatia = armazem.fatia(h)
+            if len(fatia): yield fatia.astype({c: object for c in armazem.categoricas}).assign(Hash=h)
+
+    def blocos_item(chave):
+        for h, banco in banco_precos.items():
+            if not banco[chave].empty: yield banco[chave].assign(Hash=h)
+
+    estatisticas = [{"Hash": h, "estatistica_pronta": banco['estatistica_pronta'], "media_saneada": banco['media_saneada'], "mediana": banco['mediana'], "amostras": banco['amostras'], "regra_calculo": banco.get('regra_calculo', ""), "parametro_calculo": banco.get('parametro_calculo')} for h, banco in banco_precos.items()]
+
+    yield "Config", ["Key", "Value"], iter([pd.DataFrame([{"Key": "objeto_contratacao", "Value": st.session_state.get('objeto_contratacao', '')}])])
+    yield "TR", list(df_tr_export.columns), iter([df_tr_export])
+    yield "PNCP", cols_pncp + ["Hash", "Chave"], blocos_pncp()
+    yield "Manual", cols_rastreio + ["Hash"], blocos_item('df_manual_rastreio')
+    yield "Stats", colunas_stats, iter([pd.DataFrame(estatisticas, columns=colunas_stats)])
+    yield "Historico", cols_historico_busca + ["Hash"], blocos_item('historico_buscas')
+
+# Formato nativo: zip sem compressão com tabelas Arrow IPC e um manifesto. Os tipos fazem o caminho de ida e volta
+# exatos (categóricos, booleanos, floats) e o arquivo é lido por memory-map; Manual, Histórico e Amostras são
+# gravados com uma record batch por item, lida só quando o item é acessado.
+FORMATO_PROJETO_NATIVO = "analise-mercado-arrow"
+VERSAO_ESQUEMA_PROJETO = 1
+TABELAS_POR_ITEM = ["Manual", "Historico", "Amostras"]
+
+def preparar_para_arrow(df):
+    # Backups JSON antigos (gravados com fillna("")) trazem colunas object com tipos misturados, como Lote "" ao lado de
+    # inteiros, que o Arrow rejeita. Inteiros com brancos viram Int64 (branco -> nulo); o resto vira texto.
+    # As duas conversões preservam o str() dos valores preenchidos, de que hashes_itens depende.
+    ajustes = {}
+    for c in df.columns[(df.dtypes == object).to_numpy()]:
+        if pd.api.types.infer_dtype(df[c], skipna=True) not in ("mixed", "mixed-integer"): continue
+        preenchido = df[c].notna() & (df[c].astype(str).str.strip() != "")
+        if all(isinstance(v, (int, np.integer)) and not isinstance(v, bool) for v in df[c][preenchido]):
+            ajustes[c] = pd.array(df[c].where(preenchido, None).tolist(), dtype="Int64")
+        else:
+            ajustes[c] = df[c].where(df[c].isna(), df[c].astype(str))
+    return df.assign(**ajustes) if ajustes else df
+
+def escrever_arrow_por_item(destino, df):
+    # Grava o IPC em destino e devolve {hash: [primeira batch, quantidade]}
+    df = df.sort_values('Hash', kind='stable').reset_index(drop=True)
+    tabela = pa.Table.from_pandas(preparar_para_arrow(df), preserve_index=False)
+    hashes = df['Hash'].to_numpy()
+    inicios = np.flatnonzero(np.r_[True, hashes[1:] != hashes[:-1]]) if len(df) else np.array([], dtype=int)
+    limites = np.r_[inicios, len(df)]
+    particoes, n_batches = {}, 0
+    with pa.ipc.new_file(pa.PythonFile(destino, mode='w'), tabela.schema) as escritor:
+        for inicio, fim in zip(limites[:-1], limites[1:]):
+            batches = tabela.slice(inicio, fim - inicio).combine_chunks().to_batches()
+            for batch in batches: escritor.write_batch(batch)
+            particoes[str(hashes[inicio])] = [n_batches, len(batches)]
+            n_batches += len(batches)
+    return particoes
+
+def escrever_arrow(destino, df):
+    tabela = pa.Table.from_pandas(preparar_para_arrow(df.reset_index(drop=True)), preserve_index=False)
+    with pa.ipc.new_file(pa.PythonFile(destino, mode='w'), tabela.schema) as escritor: escritor.write_table(tabela)
+
+def gerar_projeto_nativo(destino):
+    banco_precos = st.session_state.get('banco_precos', {})
+    armazem = st.session_state['armazem_pncp']
+    # Amostras saem das tabelas de válidos/outliers: itens com cotações novas têm as tabelas remontadas antes
+    df_tr, indice_tr = st.session_state['df_tr'], st.session_state['indice_tr']
+    for h, banco in banco_precos.items():
+        if banco['estatistica_pronta']: garantir_tabelas_estatistica(h, banco, df_tr.at[indice_tr[h], 'Descrição'] if h in indice_tr else "")
+    # PNCP vai como está no armazém (já tipado); as demais tabelas vêm do mesmo gerador das outras exportações
+    dfs = {nome: armazem.tabela[armazem.tabela['Hash'].isin(list(banco_precos))] if nome == "PNCP" else
+           pd.concat([pd.DataFrame(columns=colunas)] + [b.reindex(columns=colunas) for b in blocos], ignore_index=True)
+           for nome, colunas, blocos in tabelas_projeto()}
+    amostras = []
+    for h, banco in banco_precos.items():
+        if not banco['estatistica_pronta']: continue
+        for df, outlier in ((banco['df_validos'], False), (banco['df_outliers'], True)):
+            if not df.empty: amostras.append(df.reindex(columns=cols_pncp).assign(Hash=h, Outlier=outlier))
+    dfs['Amostras'] = pd.concat(amostras, ignore_index=True) if amostras else pd.DataFrame(columns=cols_pncp + ['Hash', 'Outlier'])
+
+    manifesto = {"formato": FORMATO_PROJETO_NATIVO, "versao_esquema": VERSAO_ESQUEMA_PROJETO,
+                 "criado_em": datetime.now(fuso_br).isoformat(), "tabelas": {}, "particoes": {}}
+    with zipfile.ZipFile(destino, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for nome, df in dfs.items():
+            with zf.open(f"{nome}.arrow", 'w', force_zip64=True) as membro:
+                if nome in TABELAS_POR_ITEM: manifesto["particoes"][nome] = escrever_arrow_por_item(membro, df)
+                else: escrever_arrow(membro, df)
+            manifesto["tabelas"][nome] = len(df)
+        zf.writestr("manifesto.json", json.dumps(manifesto))
+
+class ArquivoProjeto:
+    # Projeto nativo aberto por memory-map: cada tabela é lida direto do zip, sem descompactar nem copiar
+    def __init__(self, caminho):
+        with open(caminho, 'rb') as f: self._mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buffer = pa.py_buffer(self._mapa)
+        with zipfile.ZipFile(caminho) as zf:
+            self.manifesto = json.loads(zf.read("manifesto.json"))
+            self._membros = {info.filename: self._posicao_dados(info) for info in zf.infolist() if info.compress_type == zipfile.ZIP_STORED}
+        self._leitores = {}
+
+    def _posicao_dados(self, info):
+        # Cabeçalho local do zip: 30 bytes fixos + nome + campo extra
+        n_nome, n_extra = struct.unpack('<HH', self._mapa[info.header_offset + 26:info.header_offset + 30])
+        return info.header_offset + 30 + n_nome + n_extra, info.file_size
+
+    def _leitor(self, nome):
+        if nome not in self._leitores:
+            inicio, tamanho = self._membros[f"{nome}.arrow"]
+            self._leitores[nome] = pa.ipc.open_file(self._buffer.slice(inicio, tamanho))
+        return self._leitores[nome]
+
+    def tabela(self, nome):
+        return self._leitor(nome).read_pandas()
+
+    def particao(self, nome, h):
+        leitor = self._leitor(nome)
+        primeira, quantidade = self.manifesto["particoes"][nome].get(h, [0, 0])
+        tabela = pa.Table.from_batches([leitor.get_batch(i) for i in range(primeira, primeira + quantidade)], schema=leitor.schema)
+        return tabela.to_pandas().drop(columns=['Hash'])
+
+    def fechar(self):
+        # Solta leitores e buffer antes do mapeamento; se algum DataFrame ainda aponta para ele, o GC fecha depois
+        self._leitores.clear()
+        self._buffer = None
+        try: self._mapa.close()
+        except BufferError: pass
+
+def substituir_arquivo_projeto(arquivo):
+    # Fecha o projeto nativo anterior quando banco_precos deixa de apontar para ele
+    anterior = st.session_state.get('arquivo_projeto')
+    if anterior is not None and anterior is not arquivo: anterior.fechar()
+    st.session_state['arquivo_projeto'] = arquivo
+
+class ItemPreguicoso(dict):
+    # Entrada de banco_precos vinda de um projeto nativo: as tabelas do item só são lidas no primeiro acesso
+    def __init__(self, arquivo, h, **valores):
+        super().__init__(**valores)
+        self._arquivo, self._hash = arquivo, h
+
+    def __missing__(self, chave):
+        if chave == "df_manual_rastreio": self[chave] = self._arquivo.particao("Manual", self._hash)
+        elif chave == "historico_buscas": self[chave] = self._arquivo.particao("Historico", self._hash)
+        elif chave in ("df_validos", "df_outliers", "precos_ordenados", "manuais_na_amostra"):
+            amostras = self._arquivo.particao("Amostras", self._hash)
+            outlier = amostras.pop('Outlier').to_numpy(dtype=bool)
+            precos = amostras['Preço'].astype(float)
+            self.update(df_validos=amostras[~outlier], df_outliers=amostras[outlier], precos_ordenados=sorted(precos),
+                        manuais_na_amostra=Counter(precos[(amostras['Tipo'] == "Manual").to_numpy()].tolist()))
+        else: raise KeyError(chave)
+        return self[chave]
+
+def carregar_projeto_nativo(file):
+    # O upload é copiado uma vez para disco e mapeado em memória; o arquivo temporário é removido em seguida
+    # (o mapeamento continua válido enquanto o projeto estiver aberto).
+    fd, caminho = tempfile.mkstemp(suffix=".zip", prefix="projeto_")
+    with os.fdopen(fd, 'wb') as f: shutil.copyfileobj(file, f)
+    arquivo = ArquivoProjeto(caminho)
+    try: os.remove(caminho)
+    except OSError: pass
+    versao = arquivo.manifesto.get("versao_esquema", 0)
+    if arquivo.manifesto.get("formato") != FORMATO_PROJETO_NATIVO or versao > VERSAO_ESQUEMA_PROJETO:
+        arquivo.fechar()
+        raise ValueError(f"Projeto nativo incompatível (formato {arquivo.manifesto.get('formato')}, esquema {versao}).")
+
+    config = arquivo.tabela("Config")
+    if not config.empty:
+        st.session_state['objeto_contratacao'] = str(config.loc[0, 'Value'])
+        st.session_state['tr_objeto_salvo'] = True
+        st.session_state['keywords_extraidas'] = extrair_palavras_chave(str(config.loc[0, 'Value']), 10)
+    tr_df = arquivo.tabela("TR")
+    if tr_df.empty:
+        arquivo.fechar()
+        return True
+    definir_tr(tr_df.drop(columns=['Hash']))
+    st.session_state['tr_itens_salvos'] = True
+    st.session_state['armazem_pncp'] = ArmazemPrecos.da_tabela(arquivo.tabela("PNCP"))
+
+    estatisticas = arquivo.tabela("Stats").set_index('Hash').to_dict('index')
+    new_banco = {}
+    for h in tr_df['Hash']:
+        est = estatisticas.get(h, {})
+        regra_item = est.get('regra_calculo') if est.get('regra_calculo') in ESTIMADORES else regra_calculo
+        parametro_item = est.get('parametro_calculo')
+        new_banco[h] = ItemPreguicoso(arquivo, h, estatistica_pronta=bool(est.get('estatistica_pronta', False)),
+                                      media_saneada=float(est.get('media_saneada', 0.0)), mediana=float(est.get('mediana', 0.0)), amostras=int(est.get('amostras', 0)),
+                                      regra_calculo=regra_item, parametro_calculo=float(parametro_item) if pd.notna(parametro_item) else ESTIMADORES[regra_item]['padrao'])
+    st.session_state['banco_precos'] = new_banco
+    st.session_state['acao_ativa'] = {}
+    st.session_state['rascunhos_validacao'] = {}
+    substituir_arquivo_projeto(arquivo)
+    return True
+
+# Exportações são escritas tabela a tabela e item a item num arquivo temporário, que só vai para o disco acima do limite
+LIMITE_MEMORIA_EXPORTACAO = 32 * 1024 * 1024
+
+def escrever_ndjson(destino):
+    # Uma linha JSON por registro, com a tabela de origem em "_tabela"
+    for nome, colunas, blocos in tabelas_projeto():
+        for bloco in blocos:
+            linhas = bloco.reindex(columns=colunas).assign(_tabela=nome).to_json(orient='records', lines=True, force_ascii=False, double_precision=15)
+            destino.write(linhas.encode('utf-8'))
+            if not linhas.endswith("\n"): destino.write(b"\n")
+
+def escrever_xlsx(destino):
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    for nome, colunas, blocos in tabelas_projeto():
+        ws = wb.create_sheet(nome)
+        ws.append(colunas)
+        for bloco in blocos:
+            bloco = bloco.reindex(columns=colunas).astype(object)
+            for linha in bloco.where(bloco.notna(), None).itertuples(index=False, name=None): ws.append(linha)
+    wb.save(destino)
+
+def escrever_ods(destino):
+    # O writer ODS não tem modo streaming: monta uma aba por vez
+    with pd.ExcelWriter(destino, engine='odf') as writer:
+        for nome, colunas, blocos in tabelas_projeto():
+            pd.concat([pd.DataFrame(columns=colunas)] + [b.reindex(columns=colunas) for b in blocos], ignore_index=True).to_excel(writer, sheet_name=nome, index=False)
+
+def escrever_csv_zip(destino):
+    with zipfile.ZipFile(destino, 'w') as zf:
+        for nome, colunas, blocos in tabelas_projeto():
+            with zf.open(f"{nome}.csv", 'w') as membro, io.TextIOWrapper(membro, encoding='utf-8-sig', newline='') as texto:
+                pd.DataFrame(columns=colunas).to_csv(texto, index=False, sep=';')
+                for bloco in blocos: bloco.reindex(columns=colunas).to_csv(texto, index=False, header=False, sep=';')
+
+formatos_exportacao = {
+    "Projeto Nativo (Recomendado)": (gerar_projeto_nativo, "projeto_tr.arrow.zip", "application/zip"),
+    "NDJSON (JSON por linha)": (escrever_ndjson, "projeto_tr.ndjson", "application/x-ndjson"),
+    "XLSX (Excel)": (escrever_xlsx, "projeto_tr.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "ODS (LibreOffice)": (escrever_ods, "projeto_tr.ods", "application/vnd.oasis.opendocument.spreadsheet"),
+    "CSV (ZIP)": (escrever_csv_zip, "projeto_csv.zip", "application/zip"),
+}
 
 def gerar_arquivo_exportacao(formato):
-    dfs = empacotar_projeto()
-    buffer = io.BytesIO()
-    if formato == "JSON (Recomendado)":
-        out_dict = {k: v.fillna("").to_dict(orient='records') for k, v in dfs.items()}
-        buffer.write(json.dumps(out_dict, indent=4).encode('utf-8'))
-        return buffer.getvalue(), "projeto_tr.json", "application/json"
-    elif formato == "XLSX (Excel)":
-        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-            for k, v in dfs.items(): v.to_excel(writer, sheet_name=k, index=False)
-        return buffer.getvalue(), "projeto_tr.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    elif formato == "ODS (LibreOffice)":
-        with pd.ExcelWriter(buffer, engine='odf') as writer:
-            for k, v in dfs.items(): v.to_excel(writer, sheet_name=k, index=False)
-        return buffer.getvalue(), "projeto_tr.ods", "application/vnd.oasis.opendocument.spreadsheet"
-    elif formato == "CSV (ZIP)":
-        with zipfile.ZipFile(buffer, 'w') as zf:
-            for k, v in dfs.items():
-                csv_str = v.to_csv(index=False, sep=';', encoding='utf-8-sig')
-                zf.writestr(f"{k}.csv", csv_str)
-        return buffer.getvalue(), "projeto_csv.zip", "application/zip"
+    escrever, nome_arquivo, mime = formatos_exportacao[formato]
+    arquivo = tempfile.SpooledTemporaryFile(max_size=LIMITE_MEMORIA_EXPORTACAO)
+    escrever(arquivo)
+    arquivo.seek(0)
+    return arquivo, nome_arquivo, mime
 
 def carregar_projeto(file):
     dfs = {}
     try:
-        if file.name.endswith(".json"):
+        if file.name.endswith(".zip"):
+            with zipfile.ZipFile(file) as zf: nativo = "manifesto.json" in zf.namelist()
+            file.seek(0)
+            if nativo: return carregar_projeto_nativo(file)
+        if file.name.endswith(".ndjson"):
+            registros = {}
+            for linha in file:
+                if not linha.strip(): continue
+                registro = json.loads(linha)
+                registros.setdefault(registro.pop("_tabela"), []).append(registro)
+            dfs = {k: pd.DataFrame(v) for k, v in registros.items()}
+        elif file.name.endswith(".json"):
             data = json.load(file)
             for k, v in data.items(): dfs[k] = pd.DataFrame(v)
         elif file.name.endswith(".xlsx"): dfs = pd.read_excel(file, sheet_name=None, engine='openpyxl')
@@ -356,7 +1763,7 @@ def carregar_projeto(file):
         elif file.name.endswith(".zip"):
             with zipfile.ZipFile(file, 'r') as zf:
                 for name in zf.namelist():
-                    if name.endswith('.csv'): dfs[name.replace('.csv', '')] = pd.read_csv(zf.open(name), sep=';')
+                    if name.endswith('.csv'): dfs[name.replace('.csv', '')] = pd.read_csv(zf.open(name), sep=';', encoding='utf-8-sig')
         
         if 'Config' in dfs and not dfs['Config'].empty:
             st.session_state['objeto_contratacao'] = str(dfs['Config'].loc[0, 'Value'])
@@ -365,10 +1772,10 @@ def carregar_projeto(file):
 
         if 'TR' in dfs and not dfs['TR'].empty:
             tr_df = dfs['TR']
-            for c in ["Lote", "Item", "Descrição", "Métrica", "Tipo", "Quantidade"]:
+            for c in cols_tr:
                 if c not in tr_df.columns: tr_df[c] = ""
             tr_df['Quantidade_Calc'] = pd.to_numeric(tr_df['Quantidade'], errors='coerce').fillna(1)
-            st.session_state['df_tr'] = tr_df.drop(columns=['Hash'], errors='ignore')
+            novos_hashes = definir_tr(tr_df.drop(columns=['Hash'], errors='ignore'))['Hash']
             st.session_state['tr_itens_salvos'] = True
 
             pncp_df = dfs.get('PNCP', pd.DataFrame())
@@ -381,67 +1788,791 @@ def carregar_projeto(file):
             if 'estatistica_pronta' in stats_df.columns:
                 stats_df['estatistica_pronta'] = stats_df['estatistica_pronta'].astype(str).str.lower().map({'true': True, '1': True}).fillna(False)
 
-            new_banco = {}
-            for _, row in tr_df.iterrows():
-                old_hash = row.get('Hash', gerar_hash_item(row))
-                new_hash = gerar_hash_item(row)
-
-                df_p = pncp_df[pncp_df['Hash'] == old_hash].drop(columns=['Hash']) if ('Hash' in pncp_df.columns and not pncp_df.empty) else pd.DataFrame(columns=cols_pncp)
-                df_m = man_df[man_df['Hash'] == old_hash].drop(columns=['Hash']) if ('Hash' in man_df.columns and not man_df.empty) else pd.DataFrame(columns=cols_rastreio)
-                df_h = hist_df[hist_df['Hash'] == old_hash].drop(columns=['Hash']) if ('Hash' in hist_df.columns and not hist_df.empty) else pd.DataFrame(columns=cols_historico_busca)
-                
-                df_p = df_p.reindex(columns=cols_pncp).dropna(how='all')
-                df_m = df_m.reindex(columns=cols_rastreio).dropna(how='all')
-                df_h = df_h.reindex(columns=cols_historico_busca).dropna(how='all')
-
-                stat_row = stats_df[stats_df['Hash'] == old_hash] if ('Hash' in stats_df.columns and not stats_df.empty) else pd.DataFrame()
-
-                est_pronta = bool(stat_row.iloc[0]['estatistica_pronta']) if not stat_row.empty else False
-                media_san = float(stat_row.iloc[0]['media_saneada']) if not stat_row.empty else 0.0
-                mediana = float(stat_row.iloc[0]['mediana']) if not stat_row.empty else 0.0
-                amostras = int(stat_row.iloc[0]['amostras']) if not stat_row.empty else 0
-
-                df_validos, df_outliers = pd.DataFrame(), pd.DataFrame()
-                if est_pronta:
-                    p_val = df_p.copy()
-                    m_val = pd.DataFrame()
-                    if not df_m.empty:
-                        filtro = (df_m['Preço'] > 0) & (df_m['Situação'].str.contains('Proposta recebida|Portal|Mídia|Contrataç', case=False, na=False, regex=True))
-                        df_man_v = df_m[filtro].copy()
-                        if not df_man_v.empty:
-                            df_man_v["Origem"] = df_man_v.apply(lambda r: r['Link da fonte'] if pd.notna(r.get('Link da fonte')) and str(r.get('Link da fonte')).strip() else r.get('Descrição da fonte',''), axis=1)
-                            df_man_v = df_man_v.rename(columns={"Data do Contato": "Data", "Empresa": "Empresa/Órgão"})
-                            df_man_v["Item"] = row['Descrição']
-                            df_man_v["Qtd"] = 1
-                            df_man_v["Tipo"] = "Manual"
-                            m_val = df_man_v[[c for c in cols_pncp if c in df_man_v.columns]]
-
-                    frames = []
-                    if not p_val.empty: frames.append(p_val)
-                    if not m_val.empty: frames.append(m_val)
-                    if frames:
-                        df_merge = pd.concat(frames, ignore_index=True)
-                        df_validados = df_merge[df_merge["Válido?"] == True].copy()
-                        if not df_validados.empty:
-                            df_v, df_o, _, _, _ = processar_precos_regra(df_validados, "Preços válidos - Mediana ±25% e Média")
-                            df_validos = ordenar_validos(df_v)
-                            df_outliers = ordenar_outliers(df_o)
+            # Cotações PNCP vão direto para o armazém colunar, já com o hash atual de cada item
+            antigos_hashes = tr_df['Hash'].fillna(novos_hashes) if 'Hash' in tr_df.columns else novos_hashes
+            if 'Hash' in pncp_df.columns and not pncp_df.empty:
+                pncp_df = pncp_df.assign(Hash=pncp_df['Hash'].map(dict(zip(antigos_hashes, novos_hashes)))).dropna(subset=['Hash'])
+                pncp_df = pncp_df[pncp_df[cols_pncp].reindex(columns=cols_pncp).notna().any(axis=1)]
+                st.session_state['armazem_pncp'] = ArmazemPrecos(pncp_df)
+            else:
+                st.session_state['armazem_pncp'] = ArmazemPrecos()
+
+            # Cada planilha é agrupada por hash uma única vez; os itens são montados numa só passada
+            man_df = man_df.reindex(columns=cols_rastreio + ['Hash']).dropna(how='all', subset=cols_rastreio)
+            # Backups JSON gravam preço em branco como ""
+            man_df['Preço'] = pd.to_numeric(man_df['Preço'], errors='coerce')
+            hist_df = hist_df.reindex(columns=cols_historico_busca + ['Hash']).dropna(how='all', subset=cols_historico_busca)
+            grupos_man = {h: g.reset_index(drop=True) for h, g in man_df.set_index('Hash').groupby(level=0, sort=False)}
+            grupos_hist = {h: g.reset_index(drop=True) for h, g in hist_df.set_index('Hash').groupby(level=0, sort=False)}
+            estatisticas = stats_df.drop_duplicates('Hash').set_index('Hash').to_dict('index') if 'Hash' in stats_df.columns else {}
+
+            new_banco, itens_prontos = {}, {}
+            for old_hash, new_hash, descricao in zip(antigos_hashes, novos_hashes, tr_df['Descrição']):
+                df_m = grupos_man[old_hash] if old_hash in grupos_man else pd.DataFrame(columns=cols_rastreio)
+                df_h = grupos_hist[old_hash] if old_hash in grupos_hist else pd.DataFrame(columns=cols_historico_busca)
+                est = estatisticas.get(old_hash, {})
+
+                est_pronta = bool(est.get('estatistica_pronta', False))
+                # Backups anteriores ao registro de estimadores usam o parâmetro atual da barra lateral
+                regra_item = est.get('regra_calculo') if est.get('regra_calculo') in ESTIMADORES else regra_calculo
+                parametro_item = pd.to_numeric(est.get('parametro_calculo'), errors='coerce')
+                parametro_item = float(parametro_item) if pd.notna(parametro_item) else (parametro_calculo if regra_item == regra_calculo else ESTIMADORES[regra_item]['padrao'])
 
                 new_banco[new_hash] = {
-                    "df_pncp": df_p, "df_manual_rastreio": df_m, "df_validacao": pd.DataFrame(columns=cols_pncp),
-                    "historico_buscas": df_h,
-                    "estatistica_pronta": est_pronta, "media_saneada": media_san, "mediana": mediana,
-                    "amostras": amostras, "df_validos": df_validos, "df_outliers": df_outliers
+                    "df_manual_rastreio": df_m, "historico_buscas": df_h,
+                    "estatistica_pronta": est_pronta, "media_saneada": float(est.get('media_saneada', 0.0)), "mediana": float(est.get('mediana', 0.0)),
+                    "amostras": int(est.get('amostras', 0)), "df_validos": pd.DataFrame(), "df_outliers": pd.DataFrame(),
+                    "regra_calculo": regra_item, "parametro_calculo": parametro_item
                 }
+                if est_pronta: itens_prontos.setdefault((regra_item, parametro_item), {})[new_hash] = descricao
+
+            # Válidos/outliers dos itens com estatística salva: um cálculo em lote por estimador utilizado
+            for (regra_item, parametro_item), itens in itens_prontos.items():
+                marcados, resumo = calcular_estatisticas_lote(montar_precos_validados(new_banco, itens), regra_item, parametro_item)
+                aplicar_estatisticas_lote(new_banco, marcados, resumo, atualizar_valores=False)
             st.session_state['banco_precos'] = new_banco
-            st.session_state['acao_ativa'] = (None, None)
+            st.session_state['acao_ativa'] = {}
+            st.session_state['rascunhos_validacao'] = {}
+            substituir_arquivo_projeto(None)
             return True
     except Exception as e:
         st.error(f"Erro ao processar arquivo: {e}")
         return False
 
 
+# --- 6.1 PROJETO COMPARTILHADO (DIÁRIO + TRAVAS POR ITEM) ---
+# Cada mutação do projeto (lote PNCP, linha manual, edição, validação, resultado estatístico) vira um evento
+# append-only num SQLite WAL, gravado antes de a mutação ser aplicada. O projeto é identificado pelo parâmetro
+# ?projeto= da URL: várias sessões (analistas) podem abrir o mesmo endereço ao mesmo tempo. A cada execução a sessão
+# aplica só os eventos gravados pelas outras desde a última leitura, recarregando apenas os itens alterados.
+# Edições que sobrescrevem dados usam trava otimista por item (coluna 'Hash' do TR): a gravação só entra se a
+# versão do item ainda for a que a sessão leu. Com LIMITE_EVENTOS_DIARIO eventos acumulados (e ao importar um
+# backup) o projeto inteiro é gravado como instantâneo nativo e os eventos anteriores são descartados.
+# O armazenamento fica isolado em DiarioProjeto: um banco servidor só precisa oferecer os mesmos métodos.
+DIARIO_PROJETO_ARQUIVO = os.environ.get("DIARIO_PROJETO_PATH", "diario_projetos.sqlite")
+LIMITE_EVENTOS_DIARIO = 200
+CHAVE_PROJETO = "*"
+# Sobrescrevem dados: exigem a versão lida pela sessão. "pncp", "historico" e "manual_linha" só acrescentam linhas
+# (entram sempre, mas avançam a versão do item); "stats" é derivado e não mexe em versões.
+EVENTOS_COM_TRAVA = {"objeto", "tr", "manual", "validade"}
+
+class DiarioProjeto:
+    def __init__(self, caminho=DIARIO_PROJETO_ARQUIVO):
+        self.caminho = caminho
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(caminho, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS eventos (seq INTEGER PRIMARY KEY AUTOINCREMENT, projeto TEXT, tipo TEXT, hash TEXT, dados TEXT, gravado_em REAL);
+            CREATE INDEX IF NOT EXISTS idx_eventos_projeto ON eventos (projeto, seq);
+            CREATE TABLE IF NOT EXISTS instantaneos (projeto TEXT PRIMARY KEY, ate_seq INTEGER, dados BLOB, gravado_em REAL);
+            CREATE TABLE IF NOT EXISTS versoes (projeto TEXT, chave TEXT, versao INTEGER, PRIMARY KEY (projeto, chave));
+        """)
+        # Diários criados antes do projeto compartilhado não têm a sessão de origem dos eventos
+        if "sessao" not in [c[1] for c in self.conn.execute("PRAGMA table_info(eventos)")]:
+            self.conn.execute("ALTER TABLE eventos ADD COLUMN sessao TEXT")
+        self.conn.commit()
+
+    def registrar(self, projeto, sessao, tipo, h, dados, chaves=(), versoes_lidas=None):
+        # Grava o evento e avança a versão das chaves afetadas; devolve {chave: nova versão}.
+        # Com versoes_lidas, não grava nada e devolve None se outra sessão alterou alguma chave nesse meio tempo
+        # (sem exceção própria: a instância fica em cache entre execuções do script, que redefinem as classes).
+        with self._lock:
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                for chave, versao in (versoes_lidas or {}).items():
+                    linha = self.conn.execute("SELECT versao FROM versoes WHERE projeto = ? AND chave = ?", (projeto, chave)).fetchone()
+                    if (linha[0] if linha else 0) != versao:
+                        self.conn.rollback()
+                        return None
+                self.conn.execute("INSERT INTO eventos (projeto, tipo, hash, dados, gravado_em, sessao) VALUES (?, ?, ?, ?, ?, ?)",
+                                  (projeto, tipo, h, json.dumps(dados, ensure_ascii=False, default=str), time.time(), sessao))
+                self.conn.executemany("INSERT INTO versoes VALUES (?, ?, 1) ON CONFLICT (projeto, chave) DO UPDATE SET versao = versao + 1", [(projeto, c) for c in chaves])
+                novas = dict(self.conn.execute(f"SELECT chave, versao FROM versoes WHERE projeto = ? AND chave IN ({','.join('?' * len(chaves))})", (projeto, *chaves)).fetchall()) if chaves else {}
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+        return novas
+
+    def pendentes(self, projeto):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM eventos WHERE projeto = ?", (projeto,)).fetchone()[0]
+
+    def novidades(self, projeto, desde, sessao):
+        # Quantos eventos de outras sessões ainda não foram lidos (para o aviso periódico)
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM eventos WHERE projeto = ? AND seq > ? AND sessao IS NOT ?", (projeto, desde, sessao)).fetchone()[0]
+
+    def compactar(self, projeto, instantaneo, ate_seq):
+        # Só grava se cobrir mais eventos que o instantâneo atual; devolve False quando outra sessão já compactou além
+        # de ate_seq (a sessão está atrasada e precisa recarregar antes, senão apagaria os eventos que não leu)
+        with self._lock:
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                linha = self.conn.execute("SELECT ate_seq FROM instantaneos WHERE projeto = ?", (projeto,)).fetchone()
+                if linha and linha[0] >= ate_seq:
+                    self.conn.rollback()
+                    return False
+                self.conn.execute("INSERT OR REPLACE INTO instantaneos VALUES (?, ?, ?, ?)", (projeto, ate_seq, sqlite3.Binary(instantaneo), time.time()))
+                self.conn.execute("DELETE FROM eventos WHERE projeto = ? AND seq <= ?", (projeto, ate_seq))
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+        return True
+
+    def ultimo_seq(self, projeto):
+        with self._lock:
+            return self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM eventos WHERE projeto = ?", (projeto,)).fetchone()[0]
+
+    def ler(self, projeto, desde=0):
+        # Numa única transação de leitura: o instantâneo (só se for mais novo que 'desde'), os eventos posteriores
+        # e as versões atuais, para que versões e dados aplicados pela sessão correspondam ao mesmo momento
+        with self._lock:
+            self.conn.execute("BEGIN")
+            linha = self.conn.execute("SELECT ate_seq FROM instantaneos WHERE projeto = ?", (projeto,)).fetchone()
+            ate_seq = linha[0] if linha else 0
+            instantaneo = self.conn.execute("SELECT dados FROM instantaneos WHERE projeto = ?", (projeto,)).fetchone()[0] if ate_seq > desde else None
+            eventos = self.conn.execute("SELECT seq, sessao, tipo, hash, dados FROM eventos WHERE projeto = ? AND seq > ? ORDER BY seq", (projeto, max(desde, ate_seq))).fetchall()
+            versoes = dict(self.conn.execute("SELECT chave, versao FROM versoes WHERE projeto = ?", (projeto,)).fetchall())
+            self.conn.commit()
+        return instantaneo, ate_seq, eventos, versoes
+
+@st.cache_resource
+def obter_diario_projeto():
+    return DiarioProjeto()
+
+def id_projeto_sessao():
+    if 'projeto_id' not in st.session_state:
+        st.session_state['projeto_id'] = st.query_params.get("projeto") or uuid.uuid4().hex[:12]
+    if st.query_params.get("projeto") != st.session_state['projeto_id']: st.query_params["projeto"] = st.session_state['projeto_id']
+    return st.session_state['projeto_id']
+
+def id_sessao():
+    if 'sessao_id' not in st.session_state: st.session_state['sessao_id'] = uuid.uuid4().hex
+    return st.session_state['sessao_id']
+
+def df_para_diario(df):
+    df = df.astype(object)
+    return {"colunas": [str(c) for c in df.columns], "linhas": df.where(df.notna(), None).values.tolist()}
+
+def df_do_diario(dados):
+    return pd.DataFrame(dados["linhas"], columns=dados["colunas"])
+
+def registrar_no_diario(tipo, h=None, dados=None):
+    # Devolve False quando outra sessão alterou o item desde a última leitura: a alteração não deve ser aplicada
+    if st.session_state.get('diario_reaplicando'): return True
+    if tipo in ("objeto", "tr"): chaves = [CHAVE_PROJETO]
+    elif tipo == "pncp": chaves = list(dict.fromkeys(hh for hh, _ in dados))
+    elif tipo == "stats": chaves = []
+    else: chaves = [h]
+    versoes, exibidas = st.session_state.setdefault('versoes_itens', {}), st.session_state.setdefault('versoes_exibidas', {})
+    lidas = {c: exibidas.get(c, 0) for c in chaves} if tipo in EVENTOS_COM_TRAVA else None
+    novas = obter_diario_projeto().registrar(id_projeto_sessao(), id_sessao(), tipo, h, dados, chaves, lidas)
+    if novas is None:
+        st.session_state['aviso_conflito'] = "⚠️ Este item foi alterado por outro analista enquanto você editava. Os dados foram recarregados: confira e refaça a alteração."
+        return False
+    # Só avança a versão conhecida se nenhuma outra sessão gravou no meio (senão a sessão ainda não viu esses dados)
+    for c, v in novas.items():
+        if v == versoes.get(c, 0) + 1: versoes[c] = exibidas[c] = v
+    return True
+
+def compactar_diario(substituir=False):
+    # substituir=True (importação de backup): a importação ganha um evento próprio e o instantâneo cobre todos os
+    # eventos gravados até ele. Devolve False se outra sessão já compactou além do ponto lido por esta.
+    diario, projeto = obter_diario_projeto(), id_projeto_sessao()
+    if substituir:
+        diario.registrar(projeto, id_sessao(), "importacao", None, None)
+        ate_seq = diario.ultimo_seq(projeto)
+    else: ate_seq = st.session_state.get('diario_seq', 0)
+    instantaneo = io.BytesIO()
+    gerar_projeto_nativo(instantaneo)
+    if not diario.compactar(projeto, instantaneo.getvalue(), ate_seq): return False
+    st.session_state['diario_seq'] = max(ate_seq, st.session_state.get('diario_seq', 0))
+    return True
+
+def salvar_estrutura_itens(df_validos):
+    df_validos = definir_tr(df_validos)
+    st.session_state['tr_itens_salvos'] = True
+    for h in df_validos['Hash']:
+        if h not in st.session_state['banco_precos']:
+            st.session_state['banco_precos'][h] = {
+                "df_manual_rastreio": pd.DataFrame(columns=cols_rastreio),
+                "historico_buscas": pd.DataFrame(columns=cols_historico_busca),
+                "estatistica_pronta": False,
+                "media_saneada": 0.0,
+                "mediana": 0.0,
+                "amostras": 0,
+                "df_validos": pd.DataFrame(),
+                "df_outliers": pd.DataFrame()
+            }
+
+def reiniciar_estado_projeto():
+    st.session_state.update(objeto_contratacao="", tr_objeto_salvo=False, tr_itens_salvos=False, banco_precos={}, armazem_pncp=ArmazemPrecos())
+    definir_tr(pd.DataFrame(columns=cols_tr))
+    substituir_arquivo_projeto(None)
+
+def aplicar_evento_diario(tipo, h, dados):
+    # Reaplica um evento e devolve os itens tocados
+    banco_precos = st.session_state['banco_precos']
+    if tipo == "objeto":
+        st.session_state['objeto_contratacao'] = dados
+        st.session_state['tr_objeto_salvo'] = True
+        st.session_state['keywords_extraidas'] = extrair_palavras_chave(dados, 10)
+        return []
+    if tipo == "tr":
+        salvar_estrutura_itens(df_do_diario(dados))
+        return []
+    if tipo == "pncp":
+        anexar_linhas_pncp(dados)
+        return [h for h, _ in dados]
+    if tipo == "stats":
+        for h, (media, mediana, amostras, regra, parametro) in dados.items():
+            if h not in banco_precos: continue
+            banco_precos[h].update(media_saneada=media, mediana=mediana, amostras=amostras, estatistica_pronta=True, regra_calculo=regra, parametro_calculo=parametro,
+                                   alteracoes={"adicionados": [], "removidos": []})
+        return list(dados)
+    banco = banco_precos.get(h)
+    if banco is None: return []
+    if tipo == "historico": banco["historico_buscas"] = pd.concat([banco["historico_buscas"], pd.DataFrame([dados])], ignore_index=True)
+    elif tipo == "manual_linha": substituir_rastreio_manual(banco, pd.concat([banco["df_manual_rastreio"], pd.DataFrame([dados])], ignore_index=True), "")
+    elif tipo == "manual": substituir_rastreio_manual(banco, df_do_diario(dados), "")
+    # Validade por chave da cotação: não depende da ordem nem da quantidade de linhas que cada sessão tem do item.
+    # Eventos antigos, com a lista posicional, são ignorados.
+    elif tipo == "validade" and isinstance(dados, dict): st.session_state['armazem_pncp'].definir_validade_por_chave(h, dados)
+    return [h]
+
+def sincronizar_projeto():
+    # Primeira execução da sessão: instantâneo + eventos. Depois: só os eventos das outras sessões desde a última leitura
+    # (ou tudo de novo, se alguém compactou o diário além do ponto em que esta sessão estava).
+    # As travas comparam com as versões que o usuário via ao interagir, isto é, as da execução anterior
+    desde = st.session_state.get('diario_seq', 0)
+    instantaneo, ate_seq, eventos, versoes = obter_diario_projeto().ler(id_projeto_sessao(), desde)
+    completo = 'diario_seq' not in st.session_state or instantaneo is not None
+    st.session_state['versoes_exibidas'] = dict(versoes) if completo else st.session_state.get('versoes_itens', {})
+    ultimo = max([desde, ate_seq] + [e[0] for e in eventos])
+    if not completo: eventos = [e for e in eventos if e[1] != id_sessao()]
+    if not eventos and instantaneo is None:
+        st.session_state.update(diario_seq=ultimo, versoes_itens=versoes)
+        return
+    st.session_state['diario_reaplicando'] = True
+    try:
+        if instantaneo is not None:
+            reiniciar_estado_projeto()
+            carregar_projeto_nativo(io.BytesIO(instantaneo))
+        tocados = set()
+        for _, _, tipo, h, dados in eventos: tocados.update(aplicar_evento_diario(tipo, h, json.loads(dados)))
+
+        # Itens alterados: remonta as tabelas; quem ainda tinha alterações depois do último resultado é recalculado
+        banco_precos = st.session_state['banco_precos']
+        df_tr, indice_tr = st.session_state['df_tr'], st.session_state['indice_tr']
+        grupos = {}
+        for h in tocados:
+            banco = banco_precos.get(h)
+            if not banco or not banco['estatistica_pronta']: continue
+            alteracoes = banco.get('alteracoes') or {}
+            pendente = bool(alteracoes.get('adicionados') or alteracoes.get('removidos'))
+            grupos.setdefault((banco['regra_calculo'], banco['parametro_calculo'], pendente), {})[h] = df_tr.at[indice_tr[h], 'Descrição'] if h in indice_tr else ""
+        for (regra_item, parametro_item, pendente), itens in grupos.items():
+            marcados, resumo = calcular_estatisticas_lote(montar_precos_validados(banco_precos, itens, meses_corte), regra_item, parametro_item)
+            aplicar_estatisticas_lote(banco_precos, marcados, resumo, atualizar_valores=pendente)
+        st.session_state.update(diario_seq=ultimo, versoes_itens=versoes)
+        if not completo: st.toast(f"🔔 {len(tocados)} item(ns) atualizado(s) por outro analista.")
+        else: st.toast(f"💾 Projeto carregado do armazenamento compartilhado ({len(eventos)} alterações reaplicadas).")
+    except Exception as e:
+        # Diário ilegível: a sessão segue num projeto novo e o diário antigo fica intacto para inspeção
+        st.error(f"Não foi possível carregar o projeto salvo: {e}")
+        reiniciar_estado_projeto()
+        st.session_state.update(projeto_id=uuid.uuid4().hex[:12], diario_seq=0, versoes_itens={})
+    finally:
+        st.session_state['diario_reaplicando'] = False
+
+def painel_colaboracao():
+    novos = obter_diario_projeto().novidades(id_projeto_sessao(), st.session_state.get('diario_seq', 0), id_sessao())
+    if novos:
+        st.info(f"🔔 {novos} alteração(ões) de outros analistas neste projeto.")
+        if st.button("🔄 Atualizar agora", use_container_width=True): st.rerun()
+    else:
+        st.caption(f"👥 Projeto compartilhado `{id_projeto_sessao()}`: envie este endereço para editar em conjunto.")
+
+# --- 6.2 RELATÓRIO PDF (MODELOS JINJA2 + CACHE DE FRAGMENTOS) ---
+# Os modelos são compilados uma vez por processo. Os anexos de cada item são renderizados como fragmentos e
+# guardados por hash do conteúdo: só itens cujo rastreio ou estatística mudou são renderizados de novo.
+# A montagem final e o xhtml2pdf rodam num executor próprio, fora da thread do script.
+MODELOS_RELATORIO = {
+    "documento": """<html>
+<head>
+    <style>
+        @page {
+            size: A4 portrait;
+            margin-top: 3.5cm;
+            margin-bottom: 2cm;
+            margin-left: 1.5cm;
+            margin-right: 1.5cm;
+            @frame header_frame { -pdf-frame-content: header_content; left: 1.5cm; right: 1.5cm; top: 1cm; height: 2.5cm; }
+            @frame footer_frame { -pdf-frame-content: footer_content; left: 1.5cm; right: 1.5cm; bottom: 0.5cm; height: 1cm; }
+        }
+        body { font-family: "Times New Roman", Times, serif; font-size: 12px; color: black; line-height: 1; }
+        p { margin: 0; padding: 0; text-align: justify; }
+        h1, h2, h3, h4 { font-family: "Times New Roman", Times, serif; font-size: 12px; font-weight: bold; color: black; margin: 24px 0 6px 0; padding: 0; }
+        table { width: 100%; border-collapse: collapse; border: 0.25pt solid #666; table-layout: fixed; margin: 0; }
+        th, td { border: 0.25pt solid #666; padding: 4px; font-size: 10px; vertical-align: middle; word-wrap: break-word; }
+        th { font-weight: bold; text-align: center; background-color: #f2f2f2; }
+        .right-txt { text-align: right; font-weight: bold; }
+        .center-txt { text-align: center; }
+    </style>
+</head>
+<body>
+    <div id="header_content">
+        <table>
+            <tr>
+                <td rowspan="3" style="width: 35%; text-align: center; vertical-align: middle;">
+                    <span style="font-family: Arial, Helvetica, sans-serif; font-size: 14px; font-weight: bold;">PODER JUDICIÁRIO</span><br>
+                    <span style="font-family: Arial, Helvetica, sans-serif; font-size: 11px;">Tribunal de Justiça do Estado de Goiás</span><br>
+                    <span style="font-family: Arial, Helvetica, sans-serif; font-size: 9px; color: #555555;">Coordenadoria de Contratos e Aquisições de TIC</span>
+                </td>
+                <td colspan="3" style="width: 65%; text-align: center; font-size: 14px; font-weight: bold; vertical-align: middle;">
+                    ANÁLISE DE MERCADO
+                </td>
+            </tr>
+            <tr>
+                <td colspan="3" style="text-align: center; font-size: 12px; font-weight: bold; vertical-align: middle;">
+                    Processo de Planejamento de Aquisições e de Contratações de Soluções de TIC
+                </td>
+            </tr>
+            <tr>
+                <td style="width: 25%; text-align: center; font-size: 11px; vertical-align: middle;"><b>Revisão:</b> 008</td>
+                <td style="width: 25%; text-align: center; font-size: 11px; vertical-align: middle;"><b>Código/Versão:</b> CCA-006</td>
+                <td style="width: 15%; text-align: center; font-size: 11px; vertical-align: middle;"><b>Página:</b> <pdf:pagenumber> / <pdf:pagecount></td>
+            </tr>
+        </table>
+    </div>
+
+    <div id="footer_content">
+        <p style="text-align: right; font-size: 10px;">Documento gerado eletronicamente em {{ data_emissao }}</p>
+    </div>
+
+    <h1 style="margin-top:0;">OBJETO</h1>
+    <p>{{ objeto }}</p>
+
+    <h1>METODOLOGIA</h1>
+    <p><b>Estatística Aplicada:</b> {% for m in metodologias %}{{ m }}{% if not loop.last %}<br>{% endif %}{% endfor %}</p>
+    <p class="right-txt" style="font-size:14px; margin-top: 10px;">VALOR TOTAL ESTIMADO: {{ valor_total|moeda }}</p>
+{% for lote in lotes %}
+    <br><h2>{{ lote.titulo }}</h2>
+    <table repeat-header='yes'><thead><tr><th width='5%'>Item</th><th width='40%'>Descrição</th><th width='5%'>Qtd</th><th width='10%'>Unid.</th><th width='20%'>Valor Ref. Unit.</th><th width='20%'>Subtotal</th></tr></thead><tbody>
+{% for it in lote.itens %}
+    <tr><td class='center-txt'>{{ it.item }}</td><td>{{ it.descricao }}</td><td class='center-txt'>{{ it.qtd }}</td><td class='center-txt'>{{ it.unidade }}</td><td class='center-txt'>{{ it.preco|moeda }}</td><td class='center-txt'>{{ it.subtotal|moeda }}</td></tr>
+{% endfor %}
+    <tr><td colspan='5' class='right-txt'>Subtotal {{ lote.titulo }}:</td><td class='center-txt'><b>{{ lote.subtotal|moeda }}</b></td></tr></tbody></table>
+{% endfor %}
+    <br><h1>ANEXO I - RELATÓRIO DE RASTREABILIDADE (ART. 6º)</h1>
+    {{ anexo_i|safe }}
+    <br><h1>ANEXO II - COMPOSIÇÃO ESTATÍSTICA FINAL</h1>
+    {{ anexo_ii|safe }}
+</body>
+</html>""",
+    "rastreio_item": """<h2>ITEM {{ item }}: {{ descricao }}</h2>
+<table repeat-header='yes'><thead><tr><th width='20%'>Empresa (CNPJ)</th><th width='25%'>Fonte da Pesquisa</th><th width='20%'>Contato (E-mail/Tel)</th><th width='10%'>Data/Hora</th><th width='15%'>Situação</th><th width='10%'>Preço</th></tr></thead><tbody>
+{% for r in linhas %}
+<tr><td>{{ r['Empresa']|texto }}<br>{{ r['CNPJ/CPF']|texto }}</td><td><b>{{ (r['Tipo de fonte']|texto|string)[:15] }}</b><br>{{ r['Descrição da fonte']|texto }}</td><td>{{ r['Nome do Contato']|texto }}<br>{{ r['E-mail']|texto }}<br>{{ r['Telefone']|texto }}</td><td class='center-txt'>{{ r['Data do Contato']|texto }}<br>{{ r['Horário']|texto }}</td><td>{{ r['Situação']|texto }}</td><td class='center-txt'>{{ r['Preço']|moeda if (r['Preço']|float(0)) > 0 else '-' }}</td></tr>
+{% endfor %}
+</tbody></table>
+""",
+    "composicao_item": """<h2>ITEM {{ item }}: {{ descricao }}</h2>
+<p><b>Média Saneada Aplicada:</b> {{ media|moeda }} | <b>Amostras Válidas:</b> {{ amostras }}</p>
+{% for titulo, linhas in tabelas if linhas %}
+<h2>{{ titulo }}</h2>
+<table repeat-header='yes'><thead><tr><th width='12%'>Data</th><th width='30%'>Empresa/Órgão</th><th width='18%'>Valor Unit.</th><th width='40%'>Origem (Fundamento)</th></tr></thead><tbody>
+{% for r in linhas %}
+{% set origem = r['Origem']|texto|string %}
+<tr><td class='center-txt'>{{ r['Data'] }}</td><td>{{ r['Empresa/Órgão'] }}</td><td class='center-txt'>{{ r['Preço']|moeda }}</td><td>{{ origem[:150] ~ '...' if origem|length > 150 else origem }}</td></tr>
+{% endfor %}
+</tbody></table>
+{% endfor %}
+""",
+}
+
+def texto_relatorio(valor):
+    return "" if valor is None or (isinstance(valor, float) and math.isnan(valor)) else valor
+
+@st.cache_resource
+def obter_modelos_relatorio():
+    ambiente = jinja2.Environment(loader=jinja2.DictLoader(MODELOS_RELATORIO), autoescape=True, trim_blocks=True, lstrip_blocks=True)
+    ambiente.filters.update(moeda=formatar_moeda_simples, texto=texto_relatorio)
+    return {nome: ambiente.get_template(nome) for nome in MODELOS_RELATORIO}
+
+# Fragmentos renderizados, por chave de conteúdo (LRU compartilhado entre sessões: a chave já identifica o conteúdo)
+class CacheFragmentos:
+    def __init__(self, limite=5000):
+        self.limite = limite
+        self.fragmentos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obter(self, chave, renderizar):
+        with self._lock:
+            if chave in self.fragmentos:
+                self.fragmentos.move_to_end(chave)
+                return self.fragmentos[chave]
+        fragmento = renderizar()
+        with self._lock:
+            self.fragmentos[chave] = fragmento
+            while len(self.fragmentos) > self.limite: self.fragmentos.popitem(last=False)
+        return fragmento
+
+@st.cache_resource
+def obter_cache_fragmentos():
+    return CacheFragmentos()
+
+@st.cache_resource
+def obter_executor_relatorios():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="relatorio-pdf")
+
+def hash_conteudo(df):
+    if df.empty: return ""
+    return hashlib.sha1(pd.util.hash_pandas_object(df.astype(str), index=False).to_numpy().tobytes()).hexdigest()
+
+def gerar_pdf_relatorio(modelos, cache, contexto, itens, anterior=None):
+    # Roda no executor: recebe só dados já coletados da sessão (nada de st.session_state aqui).
+    # anterior: (assinatura, pdf) da última geração; conteúdo idêntico reaproveita o PDF pronto.
+    anexo_i, anexo_ii, chaves = [], [], []
+    for it in itens:
+        if not it['rastreio'].empty:
+            chave = ("rastreio_item", it['item'], it['descricao'], hash_conteudo(it['rastreio']))
+            anexo_i.append(cache.obter(chave, lambda it=it: modelos["rastreio_item"].render(item=it['item'], descricao=it['descricao'], linhas=it['rastreio'].to_dict('records'))))
+            chaves.append(chave)
+        chave = ("composicao_item", it['item'], it['descricao'], it['media'], it['amostras'], hash_conteudo(it['validos']), hash_conteudo(it['outliers']))
+        anexo_ii.append(cache.obter(chave, lambda it=it: modelos["composicao_item"].render(
+            item=it['item'], descricao=it['descricao'], media=it['media'], amostras=it['amostras'],
+            tabelas=[("Preços Válidos Adotados no Cálculo", it['validos'].to_dict('records')), ("Preços Descartados (Outliers ou Desmarcados Manualmente)", it['outliers'].to_dict('records'))])))
+        chaves.append(chave)
+
+    assinatura = hashlib.sha1(json.dumps([contexto, chaves], default=str).encode()).hexdigest()
+    if anterior and anterior[0] == assinatura: return anterior
+    html_pdf = modelos["documento"].render(**contexto, data_emissao=datetime.now(fuso_br).strftime('%d/%m/%Y %H:%M'), anexo_i="".join(anexo_i), anexo_ii="".join(anexo_ii))
+    result_pdf = io.BytesIO()
+    pdf = pisa.CreatePDF(src=html_pdf, dest=result_pdf, encoding='utf-8')
+    if pdf.err: raise RuntimeError("Erro interno ao gerar o PDF.")
+    return assinatura, result_pdf.getvalue()
+
+def painel_relatorio_pdf():
+    futuro = st.session_state.get('relatorio_pdf')
+    if futuro is None: return
+    if not futuro.done():
+        st.info("⏳ Gerando o PDF em segundo plano... você pode continuar trabalhando nas outras abas.")
+        return
+    try: st.session_state['relatorio_pdf_ultimo'] = futuro.result()
+    except Exception as e:
+        st.error(str(e))
+        st.session_state.pop('relatorio_pdf', None)
+        return
+    # Ao concluir, uma execução completa desliga a atualização periódica do painel
+    if st.session_state.get('relatorio_pdf_exibido') is not futuro:
+        st.session_state['relatorio_pdf_exibido'] = futuro
+        st.rerun()
+    st.download_button(
+        label="📥 Baixar Arquivo PDF Oficial",
+        data=st.session_state['relatorio_pdf_ultimo'][1],
+        file_name="Analise_de_Mercado_Oficial.pdf",
+        mime="application/pdf",
+        type="primary",
+        use_container_width=True
+    )
+
+# --- 6.3 COMPOSIÇÃO DE PREÇOS (SEÇÕES POR ITEM) ---
+# Cada item do painel é um fragmento: botões, formulários e editores reexecutam só a seção do próprio item.
+# Alterações de cotação marcam o item em 'itens_alterados'; ao fechar a área de trabalho ou salvar a estatística
+# a tela inteira é atualizada uma vez, para o Relatório e o Projeto refletirem o novo preço.
+# Grade de validação: filtro, ordenação e paginação no servidor, só a página atual vai para o navegador.
+# As marcações ficam num rascunho por item ('rascunhos_validacao') e as operações em massa são máscaras
+# sobre o conjunto filtrado, sem clicar caixa a caixa.
+TAMANHO_PAGINA_GRADE = 50
+ORDENS_GRADE = {"Ordem de chegada": None, "Menor preço": ("Preço", True), "Maior preço": ("Preço", False), "Empresa/Órgão (A-Z)": ("Empresa/Órgão", True)}
+
+def paginar(df, chave):
+    paginas = max(1, -(-len(df) // TAMANHO_PAGINA_GRADE))
+    if st.session_state.get(chave, 1) > paginas: st.session_state[chave] = paginas
+    pagina = st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, step=1, key=chave) if paginas > 1 else 1
+    inicio = (pagina - 1) * TAMANHO_PAGINA_GRADE
+    return df.iloc[inicio:inicio + TAMANHO_PAGINA_GRADE], pagina
+
+def grade_validacao(df, chave):
+    # df com índice estável entre execuções; devolve df com 'Válido?' conforme o rascunho
+    rascunhos = st.session_state['rascunhos_validacao']
+    rascunho = df['Válido?'].astype(bool)
+    anterior = rascunhos.get(chave)
+    if anterior is not None:
+        comuns = rascunho.index.intersection(anterior.index)
+        rascunho.loc[comuns] = anterior.loc[comuns]
+    rascunhos[chave] = rascunho
+
+    c_f1, c_f2, c_f3, c_f4 = st.columns([2, 1, 1, 1.5])
+    texto = c_f1.text_input("Filtrar por empresa ou descrição", key=f"{chave}_texto").strip()
+    preco_min = c_f2.number_input("Preço mín. (R$)", min_value=0.0, value=None, step=0.01, key=f"{chave}_min")
+    preco_max = c_f3.number_input("Preço máx. (R$)", min_value=0.0, value=None, step=0.01, key=f"{chave}_max")
+    ordem = c_f4.selectbox("Ordenar por", list(ORDENS_GRADE), key=f"{chave}_ordem")
+
+    filtro = np.ones(len(df), dtype=bool)
+    if texto:
+        filtro &= np.asarray(df['Empresa/Órgão'].str.contains(texto, case=False, regex=False, na=False) | df['Item'].str.contains(texto, case=False, regex=False, na=False), dtype=bool)
+    precos = df['Preço'].to_numpy(dtype=float)
+    if preco_min is not None: filtro &= precos >= preco_min
+    if preco_max is not None: filtro &= precos <= preco_max
+
+    c_b1, c_b2, c_b3, c_resumo = st.columns([1, 1, 1, 2])
+    massa = None
+    if c_b1.button("✔ Marcar filtrados", key=f"{chave}_marcar", use_container_width=True): massa = rascunho.index[filtro], True
+    if c_b2.button("✖ Desmarcar filtrados", key=f"{chave}_desmarcar", use_container_width=True): massa = rascunho.index[filtro], False
+    if c_b3.button("◎ Só os filtrados", key=f"{chave}_somente", use_container_width=True): massa = rascunho.index, filtro
+    if massa is not None:
+        rascunho.loc[massa[0]] = massa[1]
+        # Nova chave do editor: marcações antigas guardadas no widget não sobrepõem a operação em massa
+        st.session_state[f"{chave}_versao"] = st.session_state.get(f"{chave}_versao", 0) + 1
+
+    visiveis = df[filtro].assign(**{"Válido?": rascunho[filtro]})
+    if ORDENS_GRADE[ordem]:
+        campo, crescente = ORDENS_GRADE[ordem]
+        visiveis = visiveis.sort_values(campo, ascending=crescente, kind="stable", key=None if campo == "Preço" else lambda s: s.astype(str).str.lower())
+    pagina, n_pagina = paginar(visiveis, f"{chave}_pagina")
+
+    if pagina.empty:
+        st.info("Nenhuma cotação atende ao filtro.")
+    else:
+        visao = f"{st.session_state.get(f'{chave}_versao', 0)}|{texto}|{preco_min}|{preco_max}|{ordem}|{n_pagina}"
+        editado = st.data_editor(
+            pagina.drop(columns=['Tipo', 'Chave'], errors='ignore'),
+            column_config={"Válido?": st.column_config.CheckboxColumn("Válido?"), "Preço": st.column_config.NumberColumn("Valor Unitário", format="R$ %.2f")},
+            disabled=["Data", "Empresa/Órgão", "Item", "Qtd", "Preço", "Origem"],
+            hide_index=True, use_container_width=True, key=f"{chave}_grade_{hashlib.md5(visao.encode()).hexdigest()[:8]}"
+        )
+        rascunho.loc[editado.index] = editado["Válido?"].astype(bool)
+    c_resumo.caption(f"{int(rascunho.sum())} de {len(rascunho)} marcadas como válidas | {int(filtro.sum())} no filtro")
+    return df.assign(**{"Válido?": rascunho})
+
+def alternar_acao_item(h_id, acao):
+    acoes = st.session_state['acao_ativa']
+    if acoes.get(h_id) != acao:
+        acoes[h_id] = acao
+        return
+    del acoes[h_id]
+    if h_id in st.session_state['itens_alterados']: st.rerun()
+
+def secao_item(h_id):
+    # A linha vem do índice do TR: cada reexecução do fragmento lê a estrutura atual sem percorrer a tabela
+    indice_tr = st.session_state['indice_tr']
+    banco = st.session_state['banco_precos'].get(h_id)
+    if not banco or h_id not in indice_tr: return
+    row = st.session_state['df_tr'].loc[indice_tr[h_id]]
+
+    lote_lbl = row['Lote'] if pd.notna(row['Lote']) and str(row['Lote']).strip() != "" else "Único"
+
+    st.markdown("<div class='item-row'>", unsafe_allow_html=True)
+    c1, c2, c3, c4 = st.columns([1, 4, 1.5, 3.5])
+    c1.write(f"**{row['Item']}** ({lote_lbl})")
+    c2.write(row['Descrição'])
+
+    # Preenchido ao final da seção, depois que a área de trabalho registrou as alterações desta execução
+    status = c3.empty()
+
+    with c4:
+        btn_p, btn_c, btn_v = st.columns(3)
+        if btn_p.button("🔍 PNCP", key=f"p_{h_id}", help="Buscar no PNCP", use_container_width=True):
+            alternar_acao_item(h_id, "pncp")
+        if btn_c.button("✍️ Cadastrar", key=f"c_{h_id}", help="Cotações Manuais", use_container_width=True):
+            alternar_acao_item(h_id, "manual")
+        if btn_v.button("⚖️ Validar", key=f"v_{h_id}", help="Validar tabelas isoladas", use_container_width=True):
+            alternar_acao_item(h_id, "validar")
+    st.markdown("</div>", unsafe_allow_html=True)
+
+    acao = st.session_state['acao_ativa'].get(h_id)
+    if acao: area_trabalho_item(acao, h_id, row, banco)
+
+    sincronizar_estatistica(banco)
+    if banco['estatistica_pronta']:
+        status.markdown(f"<span style='color:green; font-weight:bold;'>✔ {formatar_moeda_simples(banco['media_saneada'])}</span>", unsafe_allow_html=True)
+    else:
+        status.markdown("<span style='color:#64748B;'>Pendente</span>", unsafe_allow_html=True)
+
+def area_trabalho_item(acao, h_id, row, banco):
+    nome_item = row['Descrição']
+    st.markdown(f"#### Área de Trabalho: {nome_item}")
+
+    if acao == "pncp":
+        with st.form(f"form_pncp_busca_{h_id}"):
+            termo_sugerido = " ".join(nome_item.split()[:3])
+            termo_pncp = st.text_input("Termos de Busca:", value=termo_sugerido)
+
+            if st.form_submit_button("Iniciar Extração Inteligente"):
+                if termo_pncp.strip():
+                    submeter_job(JobPNCP(f"Item {row['Item']}: {termo_pncp}", {h_id: termo_pncp}, {h_id: row['Item']}), executar_job_pncp, paginas_pncp, recursos_pncp(fonte_pncp, filtros=filtros_busca_pncp(meses_corte, ufs_pncp, modalidades_pncp, orgao_pncp), minimo_correspondencia=corresp_minima / 100, especulativa=busca_especulativa), {"tempo_max": tempo_max_busca, "meta_amostras": meta_amostras}, st.session_state['armazem_pncp'].chaves_por_item([h_id]))
+                    # Execução completa: o painel de jobs da barra lateral passa a se atualizar sozinho
+                    st.rerun()
+                else:
+                    st.warning("Insira um termo para buscar.")
+
+        if not banco["historico_buscas"].empty:
+            st.markdown("##### 📜 Histórico de Buscas Realizadas")
+            st.dataframe(paginar(banco["historico_buscas"], f"historico_{h_id}_pagina")[0], hide_index=True, use_container_width=True)
+
+    elif acao == "manual":
+        with st.form(f"form_add_contato_{h_id}"):
+            st.markdown("**Novo Registro**")
+            c1, c2, c3 = st.columns([1.5, 1, 1.5])
+            m_emp = c1.text_input("Empresa / Órgão Público")
+            m_cnpj = c2.text_input("CNPJ / CPF")
+            m_tipo_fonte = c3.selectbox("Tipo de Fonte (Art. 6º):", opcoes_origem_decreto)
+
+            c4, c5 = st.columns([2, 2])
+            m_desc_fonte = c4.text_input("Descrição da Fonte")
+            m_link_fonte = c5.text_input("Link da Fonte (URL)")
+
+            c6, c7, c8 = st.columns([1.5, 1.5, 1])
+            m_contato = c6.text_input("Nome do Contato")
+            m_email = c7.text_input("E-mail")
+            m_telefone = c8.text_input("Telefone")
+
+            c9, c10, c11, c12 = st.columns([1, 1, 1.5, 1.5])
+            m_data = c9.date_input("Data do Contato", value=datetime.now(fuso_br))
+            m_hora = c10.time_input("Horário", value=datetime.now(fuso_br).time())
+            m_sit = c11.selectbox("Situação:", opcoes_situacao)
+            m_preco = c12.number_input("Preço Unitário (R$)", min_value=0.00, value=0.00, step=0.01)
+
+            if st.form_submit_button("Registrar Histórico"):
+                erros = []
+                if not m_emp.strip(): erros.append("Empresa é obrigatório.")
+                cnpj_fmt = validar_formatar_cpf_cnpj(m_cnpj)
+                tel_fmt = validar_formatar_telefone(m_telefone)
+
+                if erros:
+                    for e in erros: st.error(e)
+                else:
+                    novo_log = {
+                        "Data do Contato": m_data.strftime("%d/%m/%Y"),
+                        "Horário": m_hora.strftime("%H:%M"),
+                        "Empresa": m_emp,
+                        "CNPJ/CPF": cnpj_fmt if cnpj_fmt else "",
+                        "Tipo de fonte": m_tipo_fonte,
+                        "Descrição da fonte": m_desc_fonte,
+                        "Link da fonte": m_link_fonte,
+                        "Nome do Contato": m_contato,
+                        "E-mail": m_email,
+                        "Telefone": tel_fmt if tel_fmt else "",
+                        "Situação": m_sit,
+                        "Preço": float(m_preco)
+                    }
+                    registrar_no_diario("manual_linha", h_id, novo_log)
+                    substituir_rastreio_manual(banco, pd.concat([banco["df_manual_rastreio"], pd.DataFrame([novo_log])], ignore_index=True), nome_item)
+                    st.session_state['itens_alterados'].add(h_id)
+                    st.success("Adicionado!")
+
+        # O editor vem depois do formulário: o registro recém-adicionado já aparece nesta mesma execução
+        if not banco["df_manual_rastreio"].empty:
+            df_rastreio_view = banco["df_manual_rastreio"]
+            df_rastreio_editado = st.data_editor(
+                df_rastreio_view,
+                num_rows="dynamic",
+                column_config={"Preço": st.column_config.NumberColumn("Preço (R$)", format="R$ %.2f")},
+                use_container_width=True, hide_index=False, key=f"editor_rastreio_{h_id}"
+            )
+            if not df_rastreio_editado.equals(df_rastreio_view):
+                if registrar_no_diario("manual", h_id, df_para_diario(df_rastreio_editado)):
+                    substituir_rastreio_manual(banco, df_rastreio_editado, nome_item)
+                    st.session_state['itens_alterados'].add(h_id)
+                else:
+                    # Conflito: a execução completa recarrega a versão do outro analista e exibe o aviso
+                    st.session_state.pop(f"editor_rastreio_{h_id}", None)
+                    st.rerun()
+
+    elif acao == "validar":
+        # Índice da grade PNCP = posição na fatia do item: estável mesmo quando o armazém é reorganizado por novas cotações
+        fatia_pncp = st.session_state['armazem_pncp'].fatia(h_id)
+        df_pncp_atual = filtrar_periodo_pncp(fatia_pncp, meses_corte)
+        if not df_pncp_atual.empty: df_pncp_atual = df_pncp_atual.set_axis(df_pncp_atual.index - fatia_pncp.index[0])
+
+        df_man_valido = cotacoes_manuais_validas(banco["df_manual_rastreio"], nome_item)
+
+        st.markdown("#### 1. Preços Editais Homologados (PNCP)")
+        if df_pncp_atual.empty:
+            st.info("Nenhum preço do PNCP capturado.")
+            pncp_resultado = pd.DataFrame()
+        else:
+            pncp_resultado = grade_validacao(df_pncp_atual, f"pncp_{h_id}")
+
+        st.markdown("#### 2. Cotações do Histórico Manual")
+        if df_man_valido.empty:
+            st.info("Nenhuma proposta manual classificada com preço válido.")
+            man_resultado = pd.DataFrame()
+        else:
+            man_resultado = grade_validacao(df_man_valido, f"man_{h_id}")
+
+        if st.button("Calcular Mediana/Média com Preços Válidos", type="primary", key=f"calcular_{h_id}"):
+            frames_to_concat = []
+            if not pncp_resultado.empty: frames_to_concat.append(pncp_resultado)
+            if not man_resultado.empty: frames_to_concat.append(man_resultado)
+
+            if not frames_to_concat:
+                st.error("Não há dados para calcular.")
+            else:
+                df_merge = pd.concat(frames_to_concat, ignore_index=True)
+                df_validados = df_merge[df_merge["Válido?"] == True].copy()
+
+                if df_validados.empty:
+                    st.error("Você desmarcou todos os preços.")
+                else:
+                    rascunhos = st.session_state['rascunhos_validacao']
+                    # A seleção feita na grade passa a valer para a base PNCP do item
+                    if not pncp_resultado.empty:
+                        validade = fatia_pncp["Válido?"].copy()
+                        validade.iloc[pncp_resultado.index] = pncp_resultado["Válido?"].to_numpy(dtype=bool)
+                        marcas = {chave: bool(v) for chave, v in zip(fatia_pncp["Chave"], validade) if isinstance(chave, str)}
+                        if not registrar_no_diario("validade", h_id, marcas):
+                            for chave in (f"pncp_{h_id}", f"man_{h_id}"): rascunhos.pop(chave, None)
+                            st.rerun()
+                        st.session_state['armazem_pncp'].definir_validade(validade.index, validade)
+                    marcados, resumo = calcular_estatisticas_lote(df_validados.assign(Hash=h_id), regra_calculo, parametro_calculo)
+                    aplicar_estatisticas_lote({h_id: banco}, marcados, resumo)
+
+                    for chave in (f"pncp_{h_id}", f"man_{h_id}"): rascunhos.pop(chave, None)
+                    st.toast("Estatística salva com sucesso!", icon="✅")
+                    del st.session_state['acao_ativa'][h_id]
+                    st.rerun()
+
+    if banco["estatistica_pronta"]:
+        garantir_tabelas_estatistica(h_id, banco, nome_item)
+        st.markdown("<br>", unsafe_allow_html=True)
+        l1_c1, l1_c2, l1_c3 = st.columns(3)
+        l1_c1.markdown(f"<div class='metric-card'><div class='metric-lbl'>Preço Final Adotado</div><div class='metric-val'>{formatar_moeda_simples(banco['media_saneada'])}</div></div>", unsafe_allow_html=True)
+        l1_c2.markdown(f"<div class='metric-card'><div class='metric-lbl'>Amostras Utilizadas</div><div class='metric-val'>{banco['amostras']}</div></div>", unsafe_allow_html=True)
+        maior_v = banco["df_validos"]['Preço'].max() if not banco["df_validos"].empty else 0
+        l1_c3.markdown(f"<div class='metric-card'><div class='metric-lbl'>Maior Valor Aceito</div><div class='metric-val'>{formatar_moeda_simples(maior_v)}</div></div>", unsafe_allow_html=True)
+    st.markdown("---")
+
 # --- 7. INTERFACE DE ABAS ---
+sincronizar_projeto()
+# Se a compactação falhar, o diário segue valendo; a próxima tentativa só depois de outros LIMITE_EVENTOS_DIARIO eventos
+pendentes_diario = obter_diario_projeto().pendentes(id_projeto_sessao())
+if pendentes_diario >= LIMITE_EVENTOS_DIARIO + st.session_state.get('compactacao_adiada', 0):
+    try:
+        # Recusada (outra sessão compactou além deste ponto): a próxima execução recarrega o instantâneo mais novo
+        if compactar_diario(): st.session_state.pop('compactacao_adiada', None)
+    except Exception as e:
+        st.session_state['compactacao_adiada'] = pendentes_diario
+        st.error(f"Não foi possível compactar o autosalvamento: {e}. As alterações continuam gravadas no diário.")
+if 'aviso_conflito' in st.session_state: st.warning(st.session_state.pop('aviso_conflito'))
+mesclar_resultados_jobs()
+st.session_state['itens_alterados'] = set()
+with st.sidebar:
+    st.markdown("---")
+    st.fragment(run_every=5)(painel_colaboracao)()
+if st.session_state['jobs_pncp']:
+    jobs_ativos = any(not (j and j.finalizado) for j in map(obter_gerenciador_jobs().obter, st.session_state['jobs_pncp']))
+    with st.sidebar:
+        st.markdown("---")
+        st.markdown("### ⏳ Tarefas em Segundo Plano")
+        st.fragment(run_every=2 if jobs_ativos else None)(painel_jobs_pncp)()
+
 st.markdown("""
 <div class="tj-header">
     <div style="display:flex; align-items:center;">
@@ -478,8 +2609,9 @@ with tab_tr:
         c_obj_btn, _ = st.columns([1, 4])
         if c_obj_btn.button("💾 Salvar Objeto"):
             if st.session_state['objeto_contratacao'].strip():
-                st.session_state['tr_objeto_salvo'] = True
-                st.session_state['keywords_extraidas'] = extrair_palavras_chave(st.session_state['objeto_contratacao'], qtd_kw)
+                if registrar_no_diario("objeto", dados=st.session_state['objeto_contratacao']):
+                    st.session_state['tr_objeto_salvo'] = True
+                    st.session_state['keywords_extraidas'] = extrair_palavras_chave(st.session_state['objeto_contratacao'], qtd_kw)
                 st.rerun()
             else:
                 st.error("Preencha a descrição do objeto antes de salvar.")
@@ -505,6 +2637,7 @@ with tab_tr:
                 "Métrica": st.column_config.TextColumn("Métrica (Texto Livre)"),
                 "Tipo": st.column_config.TextColumn("Tipo (Texto Livre)"),
                 "Quantidade": st.column_config.TextColumn("Quantidade (Texto/Numérico)"),
+                "Hash": None,
             },
             use_container_width=True,
             hide_index=False
@@ -512,35 +2645,17 @@ with tab_tr:
         
         c_it_btn, _ = st.columns([1, 4])
         if c_it_btn.button("💾 Salvar Estrutura de Itens"):
-            df_validos = df_tr_editado.dropna(subset=["Item", "Descrição"]).copy()
+            df_validos = df_tr_editado.drop(columns=['Hash'], errors='ignore').dropna(subset=["Item", "Descrição"]).copy()
             if df_validos.empty:
                 st.error("A tabela precisa ter ao menos um item válido com Número e Descrição.")
             else:
                 df_validos['Lote'] = df_validos['Lote'].ffill()
                 df_validos['Quantidade_Calc'] = pd.to_numeric(df_validos['Quantidade'], errors='coerce').fillna(1)
-                
-                st.session_state['df_tr'] = df_validos
-                st.session_state['tr_itens_salvos'] = True
-                
-                for _, row in df_validos.iterrows():
-                    h = gerar_hash_item(row)
-                    if h not in st.session_state['banco_precos']:
-                        st.session_state['banco_precos'][h] = {
-                            "df_pncp": pd.DataFrame(columns=cols_pncp),
-                            "df_manual_rastreio": pd.DataFrame(columns=cols_rastreio),
-                            "df_validacao": pd.DataFrame(columns=cols_pncp), 
-                            "historico_buscas": pd.DataFrame(columns=cols_historico_busca),
-                            "estatistica_pronta": False,
-                            "media_saneada": 0.0,
-                            "mediana": 0.0,
-                            "amostras": 0,
-                            "df_validos": pd.DataFrame(),
-                            "df_outliers": pd.DataFrame()
-                        }
+                if registrar_no_diario("tr", dados=df_para_diario(df_validos)): salvar_estrutura_itens(df_validos)
                 st.rerun()
     else:
         df_validos = st.session_state['df_tr'].dropna(subset=["Item", "Descrição"])
-        st.dataframe(df_validos.drop(columns=['Quantidade_Calc'], errors='ignore'), hide_index=True, use_container_width=True)
+        st.dataframe(df_validos.drop(columns=['Quantidade_Calc', 'Hash'], errors='ignore'), hide_index=True, use_container_width=True)
         c_it_btn, _ = st.columns([1, 4])
         if c_it_btn.button("✎ Editar Estrutura"):
             st.session_state['tr_itens_salvos'] = False
@@ -555,6 +2670,35 @@ with tab_cotacao:
     else:
         df_validos_tr = st.session_state['df_tr'].dropna(subset=["Item", "Descrição"])
         
+        # Busca em lote: todos os itens sem estatística pronta, com editais compartilhados baixados uma única vez
+        pendentes_lote, itens_calculados = {}, {}
+        for h_id, item, descricao in zip(df_validos_tr['Hash'], df_validos_tr['Item'], df_validos_tr['Descrição']):
+            banco = st.session_state['banco_precos'].get(h_id)
+            if not banco: continue
+            if banco['estatistica_pronta']: itens_calculados[h_id] = descricao
+            else: pendentes_lote[h_id] = (item, " ".join(str(descricao).split()[:3]))
+
+        with st.expander(f"🚀 Busca em Lote no PNCP ({len(pendentes_lote)} itens pendentes)"):
+            if not pendentes_lote:
+                st.info("Todos os itens já possuem estatística calculada.")
+            else:
+                st.caption("Os termos de busca seguem a mesma sugestão da busca individual (três primeiras palavras da descrição).")
+                if st.button("Buscar Todos os Itens Pendentes", type="primary"):
+                    termos_lote = {h: termo for h, (_, termo) in pendentes_lote.items()}
+                    rotulos_lote = {h: item for h, (item, _) in pendentes_lote.items()}
+                    job_id = submeter_job(JobPNCP(f"Busca em lote ({len(termos_lote)} itens)", termos_lote, rotulos_lote), executar_job_pncp, paginas_pncp, recursos_pncp(fonte_pncp, filtros=filtros_busca_pncp(meses_corte, ufs_pncp, modalidades_pncp, orgao_pncp), minimo_correspondencia=corresp_minima / 100, especulativa=busca_especulativa), {"tempo_max": tempo_max_busca, "meta_amostras": meta_amostras}, st.session_state['armazem_pncp'].chaves_por_item(termos_lote))
+                    st.toast(f"Busca em lote enviada para segundo plano (job {job_id}).")
+                    # Execução completa: o painel de jobs da barra lateral passa a se atualizar sozinho
+                    st.rerun()
+
+        if itens_calculados and st.button(f"♻️ Recalcular Estatística dos {len(itens_calculados)} Itens Calculados", help="Aplica o Parâmetro de Cálculo e o Período de PNCP atuais a todos os itens de uma vez, considerando todas as cotações capturadas."):
+            marcados, resumo = calcular_estatisticas_lote(montar_precos_validados(st.session_state['banco_precos'], itens_calculados, meses_corte), regra_calculo, parametro_calculo)
+            aplicar_estatisticas_lote(st.session_state['banco_precos'], marcados, resumo)
+            sem_cotacoes = [h for h in itens_calculados if h not in resumo.index]
+            zerar_estatisticas(st.session_state['banco_precos'], sem_cotacoes, regra_calculo, parametro_calculo)
+            st.success(f"Estatística recalculada para {len(resumo)} itens.")
+            if sem_cotacoes: st.warning(f"⚠️ {len(sem_cotacoes)} item(ns) sem cotação válida no período atual ficaram com estatística zerada: " + "; ".join(str(itens_calculados[h]) for h in sem_cotacoes))
+
         st.markdown("### Painel de Ações por Item")
         st.markdown("<div style='background-color:#0F2C4C; color:white; padding:10px; border-radius:4px; font-weight:bold; display:flex;'>", unsafe_allow_html=True)
         c_h1, c_h2, c_h3, c_h4 = st.columns([1, 4, 1.5, 3.5])
@@ -564,254 +2708,8 @@ with tab_cotacao:
         c_h4.write("Ações")
         st.markdown("</div>", unsafe_allow_html=True)
 
-        for _, row in df_validos_tr.iterrows():
-            h_id = gerar_hash_item(row)
-            banco = st.session_state['banco_precos'].get(h_id)
-            if not banco: continue
-
-            lote_lbl = row['Lote'] if pd.notna(row['Lote']) and str(row['Lote']).strip() != "" else "Único"
-            
-            st.markdown("<div class='item-row'>", unsafe_allow_html=True)
-            c1, c2, c3, c4 = st.columns([1, 4, 1.5, 3.5])
-            c1.write(f"**{row['Item']}** ({lote_lbl})")
-            c2.write(row['Descrição'])
-            
-            if banco['estatistica_pronta']:
-                c3.markdown(f"<span style='color:green; font-weight:bold;'>✔ {formatar_moeda_simples(banco['media_saneada'])}</span>", unsafe_allow_html=True)
-            else:
-                c3.markdown("<span style='color:#64748B;'>Pendente</span>", unsafe_allow_html=True)
-                
-            with c4:
-                btn_p, btn_c, btn_v = st.columns(3)
-                if btn_p.button("🔍 PNCP", key=f"p_{h_id}", help="Buscar no PNCP", use_container_width=True):
-                    st.session_state['acao_ativa'] = ("pncp", h_id)
-                if btn_c.button("✍️ Cadastrar", key=f"c_{h_id}", help="Cotações Manuais", use_container_width=True):
-                    st.session_state['acao_ativa'] = ("manual", h_id)
-                if btn_v.button("⚖️ Validar", key=f"v_{h_id}", help="Validar tabelas isoladas", use_container_width=True):
-                    st.session_state['acao_ativa'] = ("validar", h_id)
-            st.markdown("</div>", unsafe_allow_html=True)
-
-        st.markdown("---")
-        
-        acao, active_hash = st.session_state['acao_ativa']
-        if acao and active_hash:
-            df_matches = df_validos_tr[df_validos_tr.apply(gerar_hash_item, axis=1) == active_hash]
-            if df_matches.empty:
-                st.session_state['acao_ativa'] = (None, None)
-                st.rerun()
-            else:
-                row_ativa = df_matches.iloc[0]
-                nome_item_ativo = row_ativa['Descrição']
-                banco_ativo = st.session_state['banco_precos'][active_hash]
-                
-                st.markdown(f"#### Área de Trabalho: {nome_item_ativo}")
-                
-                if acao == "pncp":
-                    with st.form("form_pncp_busca"):
-                        termo_sugerido = " ".join(nome_item_ativo.split()[:3])
-                        termo_pncp = st.text_input("Termos de Busca:", value=termo_sugerido)
-                        
-                        if st.form_submit_button("Iniciar Extração Inteligente"):
-                            if termo_pncp.strip():
-                                engine = PNCPEngine()
-                                status_ui = st.status("Iniciando varredura no PNCP...", expanded=True)
-                                editais, tipo = engine.buscar_editais_inteligente(termo_pncp, paginas=paginas_pncp, status_placeholder=status_ui)
-                                
-                                if editais:
-                                    status_ui.update(label=f"Editais localizados (Modo: {tipo}). Extraindo itens...", state="running")
-                                    all_items = []
-                                    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-                                        futures = {executor.submit(engine.minerar_itens, ed, termo_pncp): ed for ed in editais}
-                                        for f in concurrent.futures.as_completed(futures):
-                                            res = f.result()
-                                            if res: all_items.extend(res)
-                                            
-                                    if all_items:
-                                        df_novos = pd.DataFrame(all_items)
-                                        df_novos.insert(0, "Válido?", True)
-                                        
-                                        # Incremental: Adiciona aos já existentes
-                                        banco_ativo["df_pncp"] = pd.concat([banco_ativo["df_pncp"], df_novos], ignore_index=True)
-                                        
-                                        # Log de Busca
-                                        novo_log = {
-                                            "Data/Hora": datetime.now(fuso_br).strftime("%d/%m/%Y %H:%M"),
-                                            "Termo Pesquisado": termo_pncp,
-                                            "Novos Registros": len(all_items)
-                                        }
-                                        banco_ativo["historico_buscas"] = pd.concat([banco_ativo["historico_buscas"], pd.DataFrame([novo_log])], ignore_index=True)
-                                        
-                                        status_ui.update(label=f"Sucesso! {len(all_items)} cotações encontradas.", state="complete")
-                                        st.success(f"Foram adicionados {len(all_items)} registros à sua validação (Busca: {tipo}).")
-                                    else:
-                                        status_ui.update(label="Nenhum item correspondente dentro dos editais.", state="error")
-                                        st.error("A API retornou editais, mas a descrição interna dos itens não bateu com seus termos.")
-                                else:
-                                    status_ui.update(label="Nenhum resultado no PNCP.", state="error")
-                                    st.warning("O PNCP não retornou nada, mesmo após tentativas de busca flexível.")
-                            else:
-                                st.warning("Insira um termo para buscar.")
-                    
-                    if not banco_ativo["historico_buscas"].empty:
-                        st.markdown("##### 📜 Histórico de Buscas Realizadas")
-                        st.dataframe(banco_ativo["historico_buscas"], hide_index=True, use_container_width=True)
-
-                elif acao == "manual":
-                    with st.form("form_add_contato"):
-                        st.markdown("**Novo Registro**")
-                        c1, c2, c3 = st.columns([1.5, 1, 1.5])
-                        m_emp = c1.text_input("Empresa / Órgão Público")
-                        m_cnpj = c2.text_input("CNPJ / CPF")
-                        m_tipo_fonte = c3.selectbox("Tipo de Fonte (Art. 6º):", opcoes_origem_decreto)
-                        
-                        c4, c5 = st.columns([2, 2])
-                        m_desc_fonte = c4.text_input("Descrição da Fonte")
-                        m_link_fonte = c5.text_input("Link da Fonte (URL)")
-                        
-                        c6, c7, c8 = st.columns([1.5, 1.5, 1])
-                        m_contato = c6.text_input("Nome do Contato")
-                        m_email = c7.text_input("E-mail")
-                        m_telefone = c8.text_input("Telefone")
-                        
-                        c9, c10, c11, c12 = st.columns([1, 1, 1.5, 1.5])
-                        m_data = c9.date_input("Data do Contato", value=datetime.now(fuso_br))
-                        m_hora = c10.time_input("Horário", value=datetime.now(fuso_br).time())
-                        m_sit = c11.selectbox("Situação:", opcoes_situacao)
-                        m_preco = c12.number_input("Preço Unitário (R$)", min_value=0.00, value=0.00, step=0.01)
-                        
-                        if st.form_submit_button("Registrar Histórico"):
-                            erros = []
-                            if not m_emp.strip(): erros.append("Empresa é obrigatório.")
-                            cnpj_fmt = validar_formatar_cpf_cnpj(m_cnpj)
-                            tel_fmt = validar_formatar_telefone(m_telefone)
-                            
-                            if erros:
-                                for e in erros: st.error(e)
-                            else:
-                                novo_log = {
-                                    "Data do Contato": m_data.strftime("%d/%m/%Y"),
-                                    "Horário": m_hora.strftime("%H:%M"),
-                                    "Empresa": m_emp,
-                                    "CNPJ/CPF": cnpj_fmt if cnpj_fmt else "",
-                                    "Tipo de fonte": m_tipo_fonte,
-                                    "Descrição da fonte": m_desc_fonte,
-                                    "Link da fonte": m_link_fonte,
-                                    "Nome do Contato": m_contato,
-                                    "E-mail": m_email,
-                                    "Telefone": tel_fmt if tel_fmt else "",
-                                    "Situação": m_sit,
-                                    "Preço": float(m_preco),
-                                    "Valor Unitário": formatar_moeda_ordenavel(m_preco)
-                                }
-                                banco_ativo["df_manual_rastreio"] = pd.concat([banco_ativo["df_manual_rastreio"], pd.DataFrame([novo_log])], ignore_index=True)
-                                st.success("Adicionado!")
-                                time.sleep(0.5)
-                                st.rerun()
-                    
-                    if not banco_ativo["df_manual_rastreio"].empty:
-                        df_rastreio_view = banco_ativo["df_manual_rastreio"].drop(columns=['Valor Unitário'], errors='ignore')
-                        df_rastreio_editado = st.data_editor(
-                            df_rastreio_view,
-                            num_rows="dynamic",
-                            column_config={"Preço": st.column_config.NumberColumn("Preço (R$)", format="R$ %.2f")},
-                            use_container_width=True, hide_index=False, key=f"editor_rastreio_{active_hash}"
-                        )
-                        if not df_rastreio_editado.equals(df_rastreio_view):
-                            df_rastreio_editado['Valor Unitário'] = df_rastreio_editado['Preço'].apply(formatar_moeda_ordenavel)
-                            banco_ativo["df_manual_rastreio"] = df_rastreio_editado
-
-                elif acao == "validar":
-                    df_pncp_atual = banco_ativo["df_pncp"].copy()
-                    if not df_pncp_atual.empty:
-                        try:
-                            df_pncp_atual['dt'] = pd.to_datetime(df_pncp_atual['Data'], format="%d/%m/%Y", errors='coerce')
-                            limite_data = datetime.now(fuso_br) - relativedelta(months=meses_corte)
-                            df_pncp_atual['dt'] = df_pncp_atual['dt'].dt.tz_localize(fuso_br)
-                            df_pncp_atual = df_pncp_atual[(df_pncp_atual['dt'] >= limite_data)].copy()
-                            df_pncp_atual = df_pncp_atual.drop(columns=['dt'])
-                        except: pass
-                    
-                    df_man_full = banco_ativo["df_manual_rastreio"].copy()
-                    df_man_valido = pd.DataFrame()
-                    if not df_man_full.empty:
-                        filtro = (df_man_full['Preço'] > 0) & (df_man_full['Situação'].str.contains('Proposta recebida|Portal|Mídia|Contrataç', case=False, na=False, regex=True))
-                        df_man_valido = df_man_full[filtro].copy()
-                        if not df_man_valido.empty:
-                            df_man_valido["Origem"] = df_man_valido.apply(lambda r: r['Link da fonte'] if pd.notna(r.get('Link da fonte')) and str(r.get('Link da fonte')).strip() else r.get('Descrição da fonte',''), axis=1)
-                            df_man_valido = df_man_valido.rename(columns={"Data do Contato": "Data", "Empresa": "Empresa/Órgão"})
-                            df_man_valido["Item"] = nome_item_ativo
-                            df_man_valido["Qtd"] = 1
-                            df_man_valido["Tipo"] = "Manual"
-                            df_man_valido["Válido?"] = True
-                            df_man_valido = df_man_valido[[c for c in cols_pncp if c in df_man_valido.columns]]
-
-                    with st.form("form_validacao_dupla"):
-                        st.markdown("#### 1. Preços Editais Homologados (PNCP)")
-                        if df_pncp_atual.empty:
-                            st.info("Nenhum preço do PNCP capturado.")
-                            pncp_resultado = pd.DataFrame()
-                        else:
-                            c_t1, _ = st.columns([1, 4])
-                            sel_pncp = c_t1.radio("Selecionar PNCP:", ["Todos", "Nenhum"], index=0, horizontal=True)
-                            df_pncp_atual["Válido?"] = True if sel_pncp == "Todos" else False
-                            pncp_resultado = st.data_editor(
-                                df_pncp_atual.drop(columns=['Preço', 'Tipo']),
-                                column_config={"Válido?": st.column_config.CheckboxColumn("Válido?")},
-                                disabled=["Data", "Empresa/Órgão", "Item", "Qtd", "Valor Unitário", "Origem"],
-                                hide_index=True, use_container_width=True, key="val_pncp"
-                            )
-                            pncp_resultado["Preço"] = df_pncp_atual["Preço"]
-
-                        st.markdown("#### 2. Cotações do Histórico Manual")
-                        if df_man_valido.empty:
-                            st.info("Nenhuma proposta manual classificada com preço válido.")
-                            man_resultado = pd.DataFrame()
-                        else:
-                            c_t3, _ = st.columns([1, 4])
-                            sel_man = c_t3.radio("Selecionar Manuais:", ["Todos", "Nenhum"], index=0, horizontal=True)
-                            df_man_valido["Válido?"] = True if sel_man == "Todos" else False
-                            man_resultado = st.data_editor(
-                                df_man_valido.drop(columns=['Preço', 'Tipo']),
-                                column_config={"Válido?": st.column_config.CheckboxColumn("Válido?")},
-                                disabled=["Data", "Empresa/Órgão", "Item", "Qtd", "Valor Unitário", "Origem"],
-                                hide_index=True, use_container_width=True, key="val_man"
-                            )
-                            man_resultado["Preço"] = df_man_valido["Preço"]
-
-                        if st.form_submit_button("Calcular Mediana/Média com Preços Válidos", type="primary"):
-                            frames_to_concat = []
-                            if not pncp_resultado.empty: frames_to_concat.append(pncp_resultado)
-                            if not man_resultado.empty: frames_to_concat.append(man_resultado)
-                            
-                            if not frames_to_concat:
-                                st.error("Não há dados para calcular.")
-                            else:
-                                df_merge = pd.concat(frames_to_concat, ignore_index=True)
-                                df_validados = df_merge[df_merge["Válido?"] == True].copy()
-                                
-                                if df_validados.empty:
-                                    st.error("Você desmarcou todos os preços.")
-                                else:
-                                    df_v, df_o, m_geral, _, _ = processar_precos_regra(df_validados, regra_calculo)
-                                    banco_ativo["df_validos"] = ordenar_validos(df_v)
-                                    banco_ativo["df_outliers"] = ordenar_outliers(df_o)
-                                    banco_ativo["media_saneada"] = df_v['Preço'].mean() if not df_v.empty else 0
-                                    banco_ativo["mediana"] = m_geral
-                                    banco_ativo["amostras"] = len(df_v)
-                                    banco_ativo["estatistica_pronta"] = True
-                                    
-                                    st.success("Estatística salva com sucesso!")
-                                    time.sleep(1)
-                                    st.session_state['acao_ativa'] = (None, None)
-                                    st.rerun()
-
-                if banco_ativo["estatistica_pronta"]:
-                    st.markdown("<br>", unsafe_allow_html=True)
-                    l1_c1, l1_c2, l1_c3 = st.columns(3)
-                    l1_c1.markdown(f"<div class='metric-card'><div class='metric-lbl'>Preço Final Adotado</div><div class='metric-val'>{formatar_moeda_simples(banco_ativo['media_saneada'])}</div></div>", unsafe_allow_html=True)
-                    l1_c2.markdown(f"<div class='metric-card'><div class='metric-lbl'>Amostras Utilizadas</div><div class='metric-val'>{banco_ativo['amostras']}</div></div>", unsafe_allow_html=True)
-                    maior_v = banco_ativo["df_validos"]['Preço'].max() if not banco_ativo["df_validos"].empty else 0
-                    l1_c3.markdown(f"<div class='metric-card'><div class='metric-lbl'>Maior Valor Aceito</div><div class='metric-val'>{formatar_moeda_simples(maior_v)}</div></div>", unsafe_allow_html=True)
+        secao_fragmento = st.fragment(secao_item)
+        for h_id in df_validos_tr['Hash']: secao_fragmento(h_id)
 
 # ==========================================
 # ABA 3: RELATÓRIO PDF NATIVO (XHTML2PDF)
@@ -824,16 +2722,23 @@ with tab_resumo:
         
         lotes_dict = {}
         valor_total_global = 0.0
+        metodologias_pdf = []
+        itens_relatorio = []
         
         for _, row in df_validos_tr.iterrows():
             lote_key = row["Lote"] if pd.notna(row["Lote"]) and str(row["Lote"]).strip() != "" else "Único"
             if lote_key not in lotes_dict: lotes_dict[lote_key] = []
             
-            h_id = gerar_hash_item(row)
+            h_id = row['Hash']
             banco = st.session_state['banco_precos'].get(h_id)
             if not banco: continue
+            sincronizar_estatistica(banco)
+            itens_relatorio.append((row, h_id, banco))
             
             media_item = banco['media_saneada']
+            if banco['estatistica_pronta'] and banco.get('regra_calculo') in ESTIMADORES:
+                metodologia = descrever_metodologia(banco['regra_calculo'], banco['parametro_calculo'])
+                if metodologia not in metodologias_pdf: metodologias_pdf.append(metodologia)
             qtd_num = row.get("Quantidade_Calc", 1)
             subtotal_item = media_item * qtd_num
             valor_total_global += subtotal_item
@@ -863,169 +2768,95 @@ with tab_resumo:
             
         st.markdown("---")
         if st.button("📄 Gerar Relatório Analítico de Mercado (Download PDF)", type="primary"):
-            data_emissao = datetime.now(fuso_br).strftime('%d/%m/%Y %H:%M')
-            obj_global = str(st.session_state['objeto_contratacao'])
-            
-            html_pdf = f"""
-            <html>
-            <head>
-                <style>
-                    @page {{
-                        size: A4 portrait;
-                        margin-top: 3.5cm;
-                        margin-bottom: 2cm;
-                        margin-left: 1.5cm;
-                        margin-right: 1.5cm;
-                        @frame header_frame {{ -pdf-frame-content: header_content; left: 1.5cm; right: 1.5cm; top: 1cm; height: 2.5cm; }}
-                        @frame footer_frame {{ -pdf-frame-content: footer_content; left: 1.5cm; right: 1.5cm; bottom: 0.5cm; height: 1cm; }}
-                    }}
-                    body {{ font-family: "Times New Roman", Times, serif; font-size: 12px; color: black; line-height: 1; }}
-                    p {{ margin: 0; padding: 0; text-align: justify; }}
-                    h1, h2, h3, h4 {{ font-family: "Times New Roman", Times, serif; font-size: 12px; font-weight: bold; color: black; margin: 24px 0 6px 0; padding: 0; }}
-                    table {{ width: 100%; border-collapse: collapse; border: 0.25pt solid #666; table-layout: fixed; margin: 0; }}
-                    th, td {{ border: 0.25pt solid #666; padding: 4px; font-size: 10px; vertical-align: middle; word-wrap: break-word; }}
-                    th {{ font-weight: bold; text-align: center; background-color: #f2f2f2; }}
-                    .right-txt {{ text-align: right; font-weight: bold; }}
-                    .center-txt {{ text-align: center; }}
-                </style>
-            </head>
-            <body>
-                <div id="header_content">
-                    <table>
-                        <tr>
-                            <td rowspan="3" style="width: 35%; text-align: center; vertical-align: middle;">
-                                <span style="font-family: Arial, Helvetica, sans-serif; font-size: 14px; font-weight: bold;">PODER JUDICIÁRIO</span><br>
-                                <span style="font-family: Arial, Helvetica, sans-serif; font-size: 11px;">Tribunal de Justiça do Estado de Goiás</span><br>
-                                <span style="font-family: Arial, Helvetica, sans-serif; font-size: 9px; color: #555555;">Coordenadoria de Contratos e Aquisições de TIC</span>
-                            </td>
-                            <td colspan="3" style="width: 65%; text-align: center; font-size: 14px; font-weight: bold; vertical-align: middle;">
-                                ANÁLISE DE MERCADO
-                            </td>
-                        </tr>
-                        <tr>
-                            <td colspan="3" style="text-align: center; font-size: 12px; font-weight: bold; vertical-align: middle;">
-                                Processo de Planejamento de Aquisições e de Contratações de Soluções de TIC
-                            </td>
-                        </tr>
-                        <tr>
-                            <td style="width: 25%; text-align: center; font-size: 11px; vertical-align: middle;"><b>Revisão:</b> 008</td>
-                            <td style="width: 25%; text-align: center; font-size: 11px; vertical-align: middle;"><b>Código/Versão:</b> CCA-006</td>
-                            <td style="width: 15%; text-align: center; font-size: 11px; vertical-align: middle;"><b>Página:</b> <pdf:pagenumber> / <pdf:pagecount></td>
-                        </tr>
-                    </table>
-                </div>
-                
-                <div id="footer_content">
-                    <p style="text-align: right; font-size: 10px;">Documento gerado eletronicamente em {data_emissao}</p>
-                </div>
-
-                <h1 style="margin-top:0;">OBJETO</h1>
-                <p>{obj_global}</p>
-                
-                <h1>METODOLOGIA</h1>
-                <p><b>Estatística Aplicada:</b> {regra_calculo}</p>
-                <p class="right-txt" style="font-size:14px; margin-top: 10px;">VALOR TOTAL ESTIMADO: {formatar_moeda_simples(valor_total_global)}</p>
-            """
+            if not metodologias_pdf: metodologias_pdf = [descrever_metodologia(regra_calculo, parametro_calculo)]
             
+            # Quadro de itens: subtotal pela quantidade informada no TR (texto não numérico conta como 1)
+            lotes_pdf = []
             for nome_lote, itens in lotes_dict.items():
-                titulo = f"LOTE {nome_lote}" if nome_lote != "Único" else "QUADRO DE ITENS"
-                html_pdf += f"<br><h2>{titulo}</h2>"
-                html_pdf += "<table repeat-header='yes'><thead><tr><th width='5%'>Item</th><th width='40%'>Descrição</th><th width='5%'>Qtd</th><th width='10%'>Unid.</th><th width='20%'>Valor Ref. Unit.</th><th width='20%'>Subtotal</th></tr></thead><tbody>"
-                subt_lote = 0.0
+                linhas_lote = []
                 for it in itens:
-                    try: q = float(it['Qtd']) 
+                    try: q = float(it['Qtd'])
                     except: q = 1
-                    subt_item_val = it['Preço Numérico'] * q
-                    subt_lote += subt_item_val
-                    html_pdf += f"<tr><td class='center-txt'>{it['Item']}</td><td>{it['Descrição']}</td><td class='center-txt'>{it['Qtd']}</td><td class='center-txt'>{it['Unid.']}</td><td class='center-txt'>{formatar_moeda_simples(it['Preço Numérico'])}</td><td class='center-txt'>{formatar_moeda_simples(subt_item_val)}</td></tr>"
-                html_pdf += f"<tr><td colspan='5' class='right-txt'>Subtotal {titulo}:</td><td class='center-txt'><b>{formatar_moeda_simples(subt_lote)}</b></td></tr></tbody></table>"
+                    linhas_lote.append({"item": it['Item'], "descricao": it['Descrição'], "qtd": it['Qtd'], "unidade": it['Unid.'], "preco": it['Preço Numérico'], "subtotal": it['Preço Numérico'] * q})
+                lotes_pdf.append({"titulo": f"LOTE {nome_lote}" if nome_lote != "Único" else "QUADRO DE ITENS", "itens": linhas_lote, "subtotal": sum(l['subtotal'] for l in linhas_lote)})
             
-            html_pdf += "<br><h1>ANEXO I - RELATÓRIO DE RASTREABILIDADE (ART. 6º)</h1>"
-            for _, row in df_validos_tr.iterrows():
-                h_id = gerar_hash_item(row)
-                banco = st.session_state['banco_precos'].get(h_id)
-                if not banco: continue
-                df_rastreio = banco['df_manual_rastreio']
-                
-                if not df_rastreio.empty:
-                    html_pdf += f"<h2>ITEM {row['Item']}: {row['Descrição']}</h2>"
-                    html_pdf += "<table repeat-header='yes'><thead><tr><th width='20%'>Empresa (CNPJ)</th><th width='25%'>Fonte da Pesquisa</th><th width='20%'>Contato (E-mail/Tel)</th><th width='10%'>Data/Hora</th><th width='15%'>Situação</th><th width='10%'>Preço</th></tr></thead><tbody>"
-                    for _, r_log in df_rastreio.iterrows():
-                        nome_doc = f"{r_log.get('Empresa','')}<br>{r_log.get('CNPJ/CPF','')}"
-                        fonte_base = f"<b>{str(r_log.get('Tipo de fonte',''))[:15]}</b><br>{r_log.get('Descrição da fonte', '')}"
-                        cont_doc = f"{r_log.get('Nome do Contato','')}<br>{r_log.get('E-mail','')}<br>{r_log.get('Telefone','')}"
-                        dh_doc = f"{r_log.get('Data do Contato','')}<br>{r_log.get('Horário','')}"
-                        pr = r_log.get('Preço', 0)
-                        pr_doc = formatar_moeda_simples(pr) if pr > 0 else "-"
-                        html_pdf += f"<tr><td>{nome_doc}</td><td>{fonte_base}</td><td>{cont_doc}</td><td class='center-txt'>{dh_doc}</td><td>{r_log.get('Situação','')}</td><td class='center-txt'>{pr_doc}</td></tr>"
-                    html_pdf += "</tbody></table>"
-
-            html_pdf += "<br><h1>ANEXO II - COMPOSIÇÃO ESTATÍSTICA FINAL</h1>"
-            for _, row in df_validos_tr.iterrows():
-                h_id = gerar_hash_item(row)
-                banco = st.session_state['banco_precos'].get(h_id)
-                if not banco: continue
-                
-                html_pdf += f"<h2>ITEM {row['Item']}: {row['Descrição']}</h2>"
-                html_pdf += f"<p><b>Média Saneada Aplicada:</b> {formatar_moeda_simples(banco['media_saneada'])} | <b>Amostras Válidas:</b> {banco['amostras']}</p>"
-                
-                df_v = banco['df_validos']
-                if not df_v.empty:
-                    html_pdf += "<h2>Preços Válidos Adotados no Cálculo</h2>"
-                    html_pdf += "<table repeat-header='yes'><thead><tr><th width='12%'>Data</th><th width='30%'>Empresa/Órgão</th><th width='18%'>Valor Unit.</th><th width='40%'>Origem (Fundamento)</th></tr></thead><tbody>"
-                    for _, r in df_v.iterrows():
-                        orig_str = str(r['Origem'])[:150] + "..." if len(str(r['Origem'])) > 150 else str(r['Origem'])
-                        html_pdf += f"<tr><td class='center-txt'>{r['Data']}</td><td>{r['Empresa/Órgão']}</td><td class='center-txt'>{formatar_moeda_simples(r['Preço'])}</td><td>{orig_str}</td></tr>"
-                    html_pdf += "</tbody></table>"
-                    
-                df_o = banco['df_outliers']
-                if not df_o.empty:
-                    html_pdf += "<h2>Preços Descartados (Outliers ou Desmarcados Manualmente)</h2>"
-                    html_pdf += "<table repeat-header='yes'><thead><tr><th width='12%'>Data</th><th width='30%'>Empresa/Órgão</th><th width='18%'>Valor Unit.</th><th width='40%'>Origem (Fundamento)</th></tr></thead><tbody>"
-                    for _, r in df_o.iterrows():
-                        orig_str = str(r['Origem'])[:150] + "..." if len(str(r['Origem'])) > 150 else str(r['Origem'])
-                        html_pdf += f"<tr><td class='center-txt'>{r['Data']}</td><td>{r['Empresa/Órgão']}</td><td class='center-txt'>{formatar_moeda_simples(r['Preço'])}</td><td>{orig_str}</td></tr>"
-                    html_pdf += "</tbody></table>"
+            # Anexos: tabelas de válidos/outliers remontadas aqui (thread do script); a renderização vai para o executor
+            anexos_pdf = []
+            for row, h_id, banco in itens_relatorio:
+                if banco['estatistica_pronta']: garantir_tabelas_estatistica(h_id, banco, row['Descrição'])
+                anexos_pdf.append({"item": row['Item'], "descricao": row['Descrição'], "media": banco['media_saneada'], "amostras": banco['amostras'],
+                                   "rastreio": banco['df_manual_rastreio'], "validos": banco['df_validos'], "outliers": banco['df_outliers']})
             
-            html_pdf += "</body></html>"
-            
-            result_pdf = io.BytesIO()
-            pdf = pisa.CreatePDF(src=html_pdf, dest=result_pdf, encoding='utf-8')
-            
-            if not pdf.err:
-                st.download_button(
-                    label="📥 Baixar Arquivo PDF Oficial",
-                    data=result_pdf.getvalue(),
-                    file_name="Analise_de_Mercado_Oficial.pdf",
-                    mime="application/pdf",
-                    type="primary",
-                    use_container_width=True
-                )
-            else:
-                st.error("Erro interno ao gerar o PDF.")
+            contexto_pdf = {"objeto": str(st.session_state['objeto_contratacao']), "metodologias": metodologias_pdf, "valor_total": valor_total_global, "lotes": lotes_pdf}
+            st.session_state['relatorio_pdf'] = obter_executor_relatorios().submit(gerar_pdf_relatorio, obter_modelos_relatorio(), obter_cache_fragmentos(),
+                                                                                  contexto_pdf, anexos_pdf, st.session_state.get('relatorio_pdf_ultimo'))
+        
+        futuro_pdf = st.session_state.get('relatorio_pdf')
+        st.fragment(run_every=1 if futuro_pdf is not None and not futuro_pdf.done() else None)(painel_relatorio_pdf)()
 
 # ==========================================
 # ABA 4: GESTÃO DE PROJETO
 # ==========================================
 with tab_projeto:
     st.markdown("### Salvar / Exportar Projeto")
-    fmt_export = st.selectbox("Formato de Exportação:", ["JSON (Recomendado)", "XLSX (Excel)", "ODS (LibreOffice)", "CSV (ZIP)"])
+    fmt_export = st.selectbox("Formato de Exportação:", list(formatos_exportacao))
     if st.button("Gerar Arquivo de Backup"):
         with st.spinner("Empacotando dados do projeto..."):
-            data, filename, mime = gerar_arquivo_exportacao(fmt_export)
-            st.download_button("📥 Baixar Arquivo de Projeto", data=data, file_name=filename, mime=mime, type="primary")
+            arquivo, filename, mime = gerar_arquivo_exportacao(fmt_export)
+            with arquivo: st.download_button("📥 Baixar Arquivo de Projeto", data=arquivo.read(), file_name=filename, mime=mime, type="primary")
             
+    pendentes_diario = obter_diario_projeto().pendentes(id_projeto_sessao())
+    st.caption(f"💾 Autosalvamento ativo (projeto `{id_projeto_sessao()}`, {pendentes_diario} alterações desde o último instantâneo). Para retomar após reinício do servidor ou trabalhar em conjunto, abra este mesmo endereço.")
+
     st.markdown("---")
     st.markdown("### Carregar / Importar Projeto")
-    up_file = st.file_uploader("Arraste seu arquivo de backup (.json, .xlsx, .ods, .zip)", type=["json", "xlsx", "ods", "zip"])
+    up_file = st.file_uploader("Arraste seu arquivo de backup (.arrow.zip, .ndjson, .json, .xlsx, .ods, .zip)", type=["ndjson", "json", "xlsx", "ods", "zip"])
     if up_file:
         if st.button("Carregar Projeto"):
             with st.spinner("Restaurando ambiente..."):
                 sucesso = carregar_projeto(up_file)
                 if sucesso:
-                    st.success("Projeto restaurado com sucesso!")
-                    time.sleep(1)
-                    st.rerun()
+                    try: compartilhado = compactar_diario(substituir=True)
+                    except Exception as e:
+                        st.error(f"Projeto carregado nesta sessão, mas o instantâneo compartilhado não pôde ser gravado: {e}. Outras sessões e recarregamentos não verão a importação.")
+                    else:
+                        if not compartilhado: st.error("Outra sessão gravou um instantâneo do projeto durante a importação. Carregue o arquivo novamente.")
+                        else:
+                            st.toast("Projeto restaurado com sucesso!", icon="✅")
+                            st.rerun()
+
+    st.markdown("---")
+    st.markdown("### Espelho Local do PNCP")
+    espelho_pncp = obter_espelho_pncp()
+    qtd_editais_esp, qtd_itens_esp, df_sync_esp = espelho_pncp.estatisticas()
+    st.caption(f"Editais espelhados: {qtd_editais_esp} | Itens: {qtd_itens_esp}. Cada sincronização retoma a partir da última data de publicação já copiada para o termo.")
+    if not df_sync_esp.empty: st.dataframe(df_sync_esp, hide_index=True, use_container_width=True)
+    termos_sugeridos = []
+    if st.session_state['tr_itens_salvos']:
+        termos_sugeridos = list(dict.fromkeys(" ".join(str(d).split()[:3]) for d in st.session_state['df_tr'].dropna(subset=["Item", "Descrição"])["Descrição"]))
+    termos_sync = st.text_area("Termos a sincronizar (um por linha):", value="\n".join(termos_sugeridos), height=100)
+    paginas_sync = st.number_input("Máx. de páginas por termo", min_value=1, max_value=100, value=20)
+    if st.button("Sincronizar Espelho"):
+        lista_termos = [t.strip() for t in termos_sync.splitlines() if t.strip()]
+        if lista_termos:
+            job_id = submeter_job(JobPNCP(f"Sincronização do espelho ({len(lista_termos)} termos)", {}, {}), executar_job_sincronizacao, espelho_pncp, lista_termos, paginas_sync, recursos_pncp())
+            st.toast(f"Sincronização enviada para segundo plano (job {job_id}).")
+            # Sem reexecutar, o painel de jobs (já desenhado nesta execução) só mostraria o job no próximo clique
+            st.rerun()
+        else:
+            st.warning("Informe ao menos um termo.")
+
+    st.markdown("---")
+    st.markdown("### Cache Local do PNCP")
+    cache_pncp = obter_cache_pncp()
+    st.caption(f"Respostas armazenadas: {cache_pncp.total()} (buscas expiram em 1h, itens em 7 dias, resultados homologados em 30 dias).")
+    c_cache1, c_cache2, _ = st.columns([1, 1, 3])
+    if c_cache1.button("Remover Expirados"):
+        cache_pncp.limpar(apenas_expirados=True)
+        st.rerun()
+    if c_cache2.button("Limpar Cache"):
+        cache_pncp.limpar(apenas_expirados=False)
+        st.rerun()
 
 # ==========================================
 # ABA 5: MAPEAMENTO DE PROCESSOS (BPM) E BPMN VISUAL